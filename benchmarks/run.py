@@ -0,0 +1,273 @@
+"""Map/reduce throughput benchmarks on the in-memory RealQvarn stand-in.
+
+Usage::
+
+    python benchmarks/run.py --resources 1000 10000 --keys 10 1000 -o results.json
+
+Each scenario runs on a fresh in-memory Qvarn. Test data is created before measurement, then
+pending notifications (or a full resync) are processed and measured. Results are printed as JSON,
+one entry per scenario, dataset size and key cardinality, with wall time, number of Qvarn requests
+by HTTP method and peak memory usage (tracemalloc) of the measured part.
+
+Creating test data goes through the Qvarn API too, so large datasets take a long time to set up.
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import tracemalloc
+import collections
+
+import requests_mock
+
+from qvarnmr.func import item, join, value, sum_combiner
+from qvarnmr.listeners import get_or_create_listeners
+from qvarnmr.processor import MapReduceEngine, get_changes
+from qvarnmr.resync import resync_changed_handlers
+from qvarnmr.testing.realqvarn import RealQvarn
+
+QVARN_BASE_URL = 'https://qvarn-example.tld'
+
+INSTANCE = 'benchmark'
+
+
+def _resource_type(path, type_, fields):
+    return {
+        'path': '/' + path,
+        'type': type_,
+        'versions': [
+            {
+                'version': 'v1',
+                'prototype': dict({
+                    'id': '',
+                    'type': '',
+                    'revision': '',
+                }, **fields),
+            },
+        ],
+    }
+
+
+MAPPED = {
+    '_mr_key': '',
+    '_mr_value': 0,
+    '_mr_source_id': '',
+    '_mr_source_type': '',
+    '_mr_version': 0,
+    '_mr_deleted': False,
+    '_mr_fingerprint': '',
+}
+
+REDUCED = {
+    '_mr_key': '',
+    '_mr_value': 0,
+    '_mr_version': 0,
+    '_mr_timestamp': 0,
+}
+
+SCHEMA = {
+    'bench_sources': _resource_type('bench_sources', 'bench_source', {
+        'group_id': '',
+        'value': 0,
+    }),
+    'bench_groups': _resource_type('bench_groups', 'bench_group', {
+        'name': '',
+    }),
+    'bench_map': _resource_type('bench_map', 'bench_map', MAPPED),
+    'bench_reduce': _resource_type('bench_reduce', 'bench_reduce', REDUCED),
+    'bench_join__map': _resource_type('bench_join__map', 'bench_join__map', dict(MAPPED, **{
+        '_mr_value': '',
+    })),
+    'bench_join': _resource_type('bench_join', 'bench_join', dict(REDUCED, **{
+        '_mr_value': '',
+        'group_name': '',
+        'value': 0,
+    })),
+}
+
+MAP = {
+    'bench_map': {
+        'bench_sources': {
+            'type': 'map',
+            'version': 1,
+            'handler': item('group_id', 'value'),
+        },
+    },
+}
+
+MAP_REDUCE = dict(MAP, **{
+    'bench_reduce': {
+        'bench_map': {
+            'type': 'reduce',
+            'version': 1,
+            'handler': sum,
+            'map': value(),
+        },
+    },
+})
+
+INCREMENTAL_MAP_REDUCE = dict(MAP, **{
+    'bench_reduce': {
+        'bench_map': {
+            'type': 'reduce',
+            'version': 1,
+            'handler': sum,
+            'map': value(),
+            'combine': sum_combiner,
+        },
+    },
+})
+
+JOIN = {
+    'bench_join__map': {
+        'bench_groups': {
+            'type': 'map',
+            'version': 1,
+            'handler': item('id'),
+        },
+        'bench_sources': {
+            'type': 'map',
+            'version': 1,
+            'handler': item('group_id'),
+        },
+    },
+    'bench_join': {
+        'bench_join__map': {
+            'type': 'reduce',
+            'version': 1,
+            'handler': join({
+                'bench_group': {
+                    'name': 'group_name',
+                },
+                'bench_source': {
+                    'value': None,
+                },
+            }),
+        },
+    },
+}
+
+
+class RequestCounter(collections.Counter):
+    """Replacement for requests_mock request history, that only counts requests by method."""
+
+    def append(self, request):
+        self[request.method] += 1
+
+
+def create_data(qvarn, resources, keys):
+    groups = [
+        qvarn.create('bench_groups', {'name': 'group %d' % i})['id']
+        for i in range(keys)
+    ]
+    for i, group in zip(range(resources), itertools.cycle(groups)):
+        qvarn.create('bench_sources', {'group_id': group, 'value': i})
+
+
+def process_notifications(qvarn, engine, config):
+    listeners = get_or_create_listeners(qvarn, INSTANCE, config)
+
+    def run():
+        processed = 0
+        changes_processed = 1
+        while changes_processed > 0:
+            changes = get_changes(qvarn, listeners, skip=engine.retry_scheduler)
+            changes_processed = engine.process_changes(changes)
+            processed += changes_processed
+        return processed
+
+    return listeners, run
+
+
+def resync(qvarn, engine, config):
+    def run():
+        for _ in resync_changed_handlers(qvarn, engine, INSTANCE):
+            pass
+        return 0
+
+    return None, run
+
+
+SCENARIOS = collections.OrderedDict([
+    ('map', (MAP, process_notifications)),
+    ('mapreduce', (MAP_REDUCE, process_notifications)),
+    ('mapreduce-incremental', (INCREMENTAL_MAP_REDUCE, process_notifications)),
+    ('join', (JOIN, process_notifications)),
+    ('resync', (MAP_REDUCE, resync)),
+])
+
+
+def run_scenario(name, resources, keys, workers, batch_size):
+    config, setup = SCENARIOS[name]
+
+    with requests_mock.Mocker() as mock:
+        realqvarn = RealQvarn(mock, QVARN_BASE_URL)
+        realqvarn.add_resource_types(SCHEMA)
+        qvarn = realqvarn.qvarn
+
+        engine = MapReduceEngine(qvarn, config, batch_size=batch_size, workers=workers)
+
+        # Listeners have to exist before data is created, in order to get notifications.
+        listeners, run = setup(qvarn, engine, config)
+        create_data(qvarn, resources, keys)
+
+        counter = mock._adapter.request_history = RequestCounter()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        processed = run()
+        wall_time = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'scenario': name,
+        'resources': resources,
+        'keys': keys,
+        'workers': workers,
+        'batch_size': batch_size,
+        'notifications': processed,
+        'wall_time': round(wall_time, 3),
+        'notifications_per_second': round(processed / wall_time, 1) if processed else None,
+        'resources_per_second': round(resources / wall_time, 1),
+        'requests': sum(counter.values()),
+        'requests_by_method': dict(counter),
+        'peak_memory': peak,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-s', '--scenario', nargs='+', choices=list(SCENARIOS),
+                        default=list(SCENARIOS), help="scenarios to run (default: all)")
+    parser.add_argument('-r', '--resources', nargs='+', type=int, default=[1000],
+                        help="numbers of source resources (default: 1000)")
+    parser.add_argument('-k', '--keys', nargs='+', type=int, default=[10],
+                        help="numbers of distinct reduce keys (default: 10)")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="engine worker threads")
+    parser.add_argument('-b', '--batch-size', type=int, default=100, help="engine batch size")
+    parser.add_argument('-o', '--output', help="write results to a file instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, resources, keys in itertools.product(args.scenario, args.resources, args.keys):
+        print("running %s resources=%d keys=%d" % (name, resources, keys), file=sys.stderr)
+        results.append(run_scenario(name, resources, keys, args.workers, args.batch_size))
+
+    output = json.dumps({
+        'python': platform.python_version(),
+        'results': results,
+    }, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Asyncio variant of ``MapReduceEngine.process_changes``.
+
+This module requires Python 3.5 or newer and is imported only if asyncio is enabled, so the rest of
+the engine still runs on older Python versions.
+"""
+
+import asyncio
+import logging
+import time
+from functools import partial
+
+from qvarnmr.clients.aioqvarn import AsyncQvarnApi
+from qvarnmr.processor import _MapProgress, _map_resource_ids
+from qvarnmr.utils import chunks
+
+logger = logging.getLogger(__name__)
+
+
+async def _aprefetch_map_resources(aqvarn, notifications):
+    """Asyncio variant of ``_prefetch_map_resources``, all resource types are fetched at once."""
+    resource_ids = _map_resource_ids(notifications)
+    results = await asyncio.gather(*(
+        aqvarn.get_multiple(resource_type, ids, return_exceptions=True)
+        for resource_type, ids in resource_ids.items()
+    ))
+    resources = {}
+    for (resource_type, ids), docs in zip(resource_ids.items(), results):
+        for resource_id, resource in zip(ids, docs):
+            resources[(resource_type, resource_id)] = resource
+    return resources
+
+
+async def _aprocess_map_handlers(engine, aqvarn, changes, resync=False):
+    """Asyncio variant of ``MapReduceEngine._process_map_handlers``.
+
+    Source resources of the next batch are fetched while the current batch is processed in a
+    thread, so fetching overlaps with handler execution and writing of results.
+    """
+    loop = asyncio.get_event_loop()
+    state = _MapProgress()
+    batches = chunks(engine.batch_size, changes)
+
+    batch = await loop.run_in_executor(None, next, batches, None)
+    fetch = None
+    if batch is not None:
+        fetch = asyncio.ensure_future(_aprefetch_map_resources(
+            aqvarn, engine._map_prefetch_notifications(batch),
+        ))
+    try:
+        while batch is not None:
+            resources = await fetch
+            fetch = None
+            processing = loop.run_in_executor(None, engine._process_map_batch, batch,
+                                              resources, resync, state)
+            try:
+                batch = await loop.run_in_executor(None, next, batches, None)
+                if batch is not None:
+                    fetch = asyncio.ensure_future(_aprefetch_map_resources(
+                        aqvarn, engine._map_prefetch_notifications(batch),
+                    ))
+            finally:
+                # Never leave a batch being processed behind, even if reading of the next
+                # batch failed.
+                await processing
+    finally:
+        if fetch is not None:
+            fetch.cancel()
+
+    return state.changes_processed, state.errors, state.reduce_changes
+
+
+async def process_changes_async(engine, changes, resync=False):
+    """Asyncio variant of ``MapReduceEngine.process_changes``.
+
+    Map handlers are processed by ``_aprocess_map_handlers``, which fetches source resources of
+    the next batch through ``AsyncQvarnApi``, while the current batch is being processed. Handlers
+    themselves still use the synchronous ``QvarnApi`` and run in threads, so the event loop is
+    never blocked by them.
+    """
+    logger.info('processing changes resync=%r asyncio=True', resync)
+    start = time.time()
+    loop = asyncio.get_event_loop()
+    aqvarn = AsyncQvarnApi(engine.qvarn)
+    changes = engine._iter_changes(changes)
+    with engine.qvarn.cache_scope(engine.cache_size):
+        try:
+            mapped, errors, reduce_changes = await _aprocess_map_handlers(
+                engine, aqvarn, changes, resync,
+            )
+            reduced, errors = await loop.run_in_executor(None, partial(
+                engine.process_reduce_handlers, reduce_changes, errors=errors, resync=resync,
+            ))
+        finally:
+            engine._flush()
+    logger.info('done processing changes resync=%r mapped=%d reduced=%d errors=%d '
+                'time=%.2fs concurrency=%d', resync, mapped, reduced, errors,
+                time.time() - start, engine.qvarn.concurrency_limit)
+    return mapped + reduced
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+from copy import deepcopy
+from functools import partial
+
+from qvarnmr.clients.qvarn import QvarnError
+from qvarnmr.clients.qvarn import QvarnResourceConflict
+from qvarnmr.clients.qvarn import QvarnResultDict
+from qvarnmr.clients.qvarn import QvarnUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncQvarnApi(object):
+    """Asyncio interface to Qvarn, methods are coroutines mirroring ``QvarnApi`` methods.
+
+    Requests are sent through the wrapped ``QvarnApi`` and share its client, concurrency limiter,
+    circuit breaker, retry settings, revision cache, request cache (see ``QvarnApi.cache_scope``)
+    and metrics. Coroutines wait for responses without blocking the event loop, so any number of
+    them can run concurrently, while the number of requests actually sent at once is still limited
+    by the concurrency limiter.
+
+    Parameters
+    ----------
+    qvarn : QvarnApi
+
+    """
+
+    def __init__(self, qvarn):
+        self.qvarn = qvarn
+        self.client = qvarn.client
+
+    async def _send(self, request):
+        future = self.qvarn._send(request, block=False)
+        if future is None:
+            # Wait for a free slot in a thread, without blocking the event loop.
+            loop = asyncio.get_event_loop()
+            future = await loop.run_in_executor(None, self.qvarn._send, request)
+        return future
+
+    async def _request(self, request, idempotent=True):
+        """Send a request and wait for its response, see ``QvarnApi._resolve_future``."""
+        retry = request if idempotent else None
+        future = await self._send(request)
+        attempt = 0
+        while True:
+            await asyncio.wait([asyncio.wrap_future(future)])
+            try:
+                return self.qvarn._resolve_response(future)
+            except QvarnUnavailable as e:
+                delay = self.qvarn._retry_delay(e, attempt, retry)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                future = await self._send(retry)
+
+    async def _gather(self, coros, return_exceptions):
+        result = await asyncio.gather(*coros, return_exceptions=True)
+        for item in result:
+            if isinstance(item, Exception) and not isinstance(item, QvarnError):
+                raise item
+        return self.qvarn._raise_or_return(result, return_exceptions)
+
+    async def _cached(self, key, load):
+        """Return a copy of cached response or await ``load()`` to get it."""
+        cache = self.qvarn._cache
+        if cache is None:
+            return await load()
+        hit, result = cache.lookup(key)
+        if hit:
+            return result
+        version = cache.version(key[1])
+        result = await load()
+        cache.store(key, result, version)
+        return deepcopy(result)
+
+    def _invalidate(self, resource):
+        self.qvarn._invalidate(resource)
+
+    async def get(self, resource, id, subresources=()):
+        """Retrieve a resource and one or more subresources."""
+        if not subresources:
+            return await self._cached(('get', resource, id), partial(self._get, resource, id))
+        doc, *data = await asyncio.gather(self._get(resource, id), *(
+            self._request(self.client.resource(resource).single(id).subresource(subresource).get)
+            for subresource in subresources
+        ))
+        doc.update(zip(subresources, data))
+        return doc
+
+    async def _get(self, resource, id):
+        doc = await self._request(self.client.resource(resource).single(id).get)
+        self.qvarn._remember_revision(resource, doc)
+        return doc
+
+    async def get_multiple(self, resource, ids, return_exceptions=False):
+        """Retrieve multiple resources concurrently. Does not fetch subresources.
+
+        If ``return_exceptions`` is true, ``QvarnError`` instances are returned in place of
+        resources that could not be retrieved.
+        """
+        return await self._gather((self.get(resource, id) for id in ids), return_exceptions)
+
+    async def search(self, resource, show=(), show_all=False, **query):
+        """Perform search, see ``QvarnApi.search``."""
+        criteria = self.qvarn._parse_query(query)
+        key = ('search', resource, tuple(show), show_all, repr(criteria))
+        return await self._cached(key, partial(self._search, resource, show, show_all, criteria))
+
+    async def _search(self, resource, show, show_all, criteria):
+        request = self.qvarn._search_request(resource, show, show_all, criteria)
+        resp = await self._request(request)
+        return self.qvarn._list_result(resp, not (show_all or show), resource)
+
+    async def create(self, resource, payload, subresources=(), files=()):
+        try:
+            subresources = self.qvarn._pop_subresource_data(payload, subresources)
+            files = self.qvarn._pop_subresource_data(payload, files)
+            created = await self._request(partial(self.client.resource(resource).post, payload),
+                                          idempotent=False)
+            logger.info('%r resource created with id: %r', resource, created['id'])
+            self.qvarn._remember_revision(resource, created)
+            await self._update_subresources(resource, created, subresources, files)
+            return QvarnResultDict(created)
+        finally:
+            self._invalidate(resource)
+
+    async def update(self, resource, id, payload, subresources=(), files=()):
+        """Update a resource, missing revision is taken the same way as in ``QvarnApi.update``."""
+        try:
+            cached = False
+            if not payload.get('revision'):
+                revision = self.qvarn._get_revision(resource, id)
+                cached = revision is not None
+                if revision is None:
+                    # Revision is never taken from the request cache, it might be outdated.
+                    revision = (await self._get(resource, id))['revision']
+                payload['revision'] = revision
+
+            subresources = self.qvarn._pop_subresource_data(payload, subresources)
+            files = self.qvarn._pop_subresource_data(payload, files)
+            request = partial(self.client.resource(resource).single(id).put, payload)
+            try:
+                updated = await self._request(request)
+            except QvarnResourceConflict:
+                if not cached:
+                    raise
+                logger.debug('cached revision of %r resource with id: %r is outdated',
+                             resource, id)
+                self._invalidate(resource)
+                payload['revision'] = (await self._get(resource, id))['revision']
+                updated = await self._request(request)
+            logger.info('%r resource with id: %r has been updated', resource, id)
+            self.qvarn._remember_revision(resource, updated)
+            await self._update_subresources(resource, updated, subresources, files)
+            return QvarnResultDict(updated)
+        finally:
+            self._invalidate(resource)
+
+    async def _update_subresources(self, resource, doc, subresources, files):
+        # Each subresource update changes revision of the resource, so they are done one by one.
+        for subresource, payload in subresources.items():
+            payload['revision'] = doc['revision']
+            response = await self._request(partial(
+                self.client.resource(resource).single(doc['id']).subresource(subresource).put,
+                payload,
+            ))
+            doc['revision'] = response['revision']
+            doc[subresource] = response
+        for subresource, payload in files.items():
+            response = await self._request(partial(
+                self.client.resource(resource).single(doc['id']).filesubresource(subresource).put,
+                payload['body'], payload['content_type'], doc['revision'],
+            ))
+            doc['revision'] = response['revision']
+        self.qvarn._remember_revision(resource, doc)
+
+    async def delete(self, resource, id):
+        try:
+            result = await self._request(self.client.resource(resource).single(id).delete)
+            logger.info('%r resource with id: %r has been deleted', resource, id)
+            self.qvarn._forget_revision(resource, id)
+            return result
+        finally:
+            self._invalidate(resource)
@@ -1,5 +1,12 @@
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict, defaultdict
+from contextlib import contextmanager
+from copy import copy, deepcopy
+from functools import partial, wraps
+import json
 import logging
+import threading
+import time
+import urllib.parse
 
 from concurrent import futures
 
@@ -7,10 +14,20 @@ import requests
 
 from qvarnclient import QvarnRequests, QvarnClient
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from qvarnmr.metrics import RequestMetrics
+
 logger = logging.getLogger(__name__)
 
 NO_DEFAULT = object()
 
+# Responses of the proxy in front of Qvarn, when Qvarn is down or overloaded.
+TRANSIENT_STATUS_CODES = (502, 503, 504)
+
 
 class QvarnError(Exception):
     pass
@@ -32,6 +49,10 @@ class QvarnResourceConflict(QvarnError):
     pass
 
 
+class QvarnUnavailable(QvarnError):
+    """Raised on transient failures, when Qvarn can't be reached or is overloaded."""
+
+
 class QvarnResultDict(dict):
     """Dict wrapper to help extract data from Qvarn results."""
 
@@ -64,26 +85,529 @@ class QvarnResultDict(dict):
         return items
 
 
+class QvarnResultList(list):
+    """List of search results, each wrapped into ``QvarnResultDict`` on first access.
+
+    Search responses can have tens of thousands of rows, so rows are not copied into
+    ``QvarnResultDict`` until they are used. Only indexing and iteration wrap rows, other list
+    methods return plain dicts.
+    """
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        item = super().__getitem__(index)
+        if type(item) is dict:
+            item = QvarnResultDict(item)
+            # Wrapped row is stored, so that changes done by the caller are not lost.
+            super().__setitem__(index, item)
+        return item
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _loads(content):
+    """Decode JSON response body, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content.decode('utf-8'))
+
+
 QvarnCapabilities = namedtuple('QvarnCapabilities',
                                ['extended_project_fields'])
 
 
-class QvarnApi(object):
-    """Wrapper around Tilaajavastuu Qvarn client."""
+class CircuitBreaker(object):
+    """Stop sending requests to Qvarn, when it is clearly down.
+
+    After ``threshold`` consecutive transient failures the circuit is open and requests fail
+    immediately with ``QvarnUnavailable`` for ``reset_timeout`` seconds. After that requests are
+    let through again, a successful response closes the circuit and another failure opens it for
+    ``reset_timeout`` seconds again.
+
+    Parameters
+    ----------
+    threshold : int
+        Number of consecutive transient failures opening the circuit, 0 disables the breaker.
+    reset_timeout : float
+        Number of seconds the circuit stays open.
+
+    """
+
+    def __init__(self, threshold=10, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """Return number of seconds until requests are let through again, 0 if circuit is closed."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(self._opened_at + self.reset_timeout - time.time(), 0)
+
+    def is_open(self):
+        return self.remaining() > 0
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info('Qvarn is available again, closing circuit breaker')
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.threshold and self._failures >= self.threshold:
+                if self._opened_at is None:
+                    logger.warning('%d consecutive Qvarn failures, opening circuit breaker for '
+                                   '%.1fs', self._failures, self.reset_timeout)
+                self._opened_at = time.time()
+
+
+class ConcurrencyLimiter(object):
+    """Adapt number of concurrent Qvarn requests to Qvarn response times (AIMD).
+
+    The limit grows by one for each ``limit`` fast responses and is multiplied by
+    ``decrease_factor`` on a slow response (slower than ``latency_target`` seconds) or a transient
+    failure. Responses of requests sent before the last decrease do not decrease the limit again,
+    so a burst of slow responses is counted only once. Response time is taken from
+    ``response.elapsed``, so time spent waiting for a free thread of the session executor is not
+    counted, see ``_latency``.
+
+    Parameters
+    ----------
+    min_limit : int
+        Minimal number of concurrent requests.
+    max_limit : int
+        Maximal and initial number of concurrent requests.
+    latency_target : float
+        Response time in seconds, above which the limit is decreased.
+    decrease_factor : float
+        Multiplier of the limit on a slow response or a failure.
+
+    """
+
+    def __init__(self, min_limit=1, max_limit=100, latency_target=1.0, decrease_factor=0.5):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self._limit = float(max_limit)
+        self._in_flight = 0
+        self._decreased_at = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def submit(self, request, block=True):
+        """Send a request, once number of pending requests is below the limit.
+
+        ``request`` is a function sending a request and returning a future. The slot is released
+        once the future is done, no matter if it is ever resolved. If ``block`` is false and the
+        limit is reached, the request is not sent and None is returned instead of waiting.
+        """
+        with self._cond:
+            while self._in_flight >= self.limit:
+                if not block:
+                    return None
+                self._cond.wait()
+            self._in_flight += 1
+
+        sent_at = time.monotonic()
+        try:
+            future = request()
+        except Exception:
+            self._release(sent_at, None)
+            raise
+        future.add_done_callback(lambda fut: self._release(sent_at, fut))
+        return future
+
+    def _release(self, sent_at, future):
+        latency = _latency(future, sent_at)
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+            if future is None or future.cancelled():
+                return
+
+            limit = self._limit
+            if _is_transient(future) or latency > self.latency_target:
+                if sent_at >= self._decreased_at:
+                    self._decreased_at = time.monotonic()
+                    self._limit = max(self._limit * self.decrease_factor, self.min_limit)
+            else:
+                self._limit = min(self._limit + 1 / self._limit, self.max_limit)
+
+            if int(limit) != self.limit:
+                logger.debug('Qvarn concurrency limit changed from %d to %d', limit, self.limit)
+
+
+def _latency(future, sent_at):
+    """Return response time of a done requests-futures future in seconds.
+
+    Requests wait in the session executor queue, until a thread is free. ``response.elapsed``
+    measures only time since the request was actually sent, time since ``sent_at`` is used only if
+    there is no response.
+    """
+    if future is not None and not future.cancelled() and future.exception() is None:
+        elapsed = getattr(future.result(), 'elapsed', None)
+        if elapsed is not None:
+            return elapsed.total_seconds()
+    return time.monotonic() - sent_at
+
+
+def _is_transient(future):
+    """Check if done requests-futures future failed because of a transient failure."""
+    if future.exception() is not None:
+        return isinstance(future.exception(), (requests.exceptions.ConnectionError,
+                                               requests.exceptions.Timeout))
+    return future.result().status_code in TRANSIENT_STATUS_CODES
+
+
+class RequestCache(object):
+    """Read-through cache of GET and search responses with single-flight deduplication.
+
+    Concurrent requests with the same key are collapsed into a single request, all callers get a
+    copy of the same response. Errors are not cached.
+
+    Keys are tuples with resource type as the second item. ``invalidate`` drops all cached
+    responses of a resource type, responses of requests sent before invalidation are not cached.
+
+    Parameters
+    ----------
+    max_entries : int
+        Maximum number of cached responses, least recently used responses are dropped first.
+
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._pending = {}
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def lookup(self, key):
+        """Return a tuple of a flag telling if response is cached and a copy of the response."""
+        with self._lock:
+            if key not in self._results:
+                return False, None
+            self.hits += 1
+            self._results.move_to_end(key)
+            result = self._results[key]
+        return True, deepcopy(result)
+
+    def version(self, resource):
+        """Return invalidation counter of a resource type, to be passed to ``store``."""
+        with self._lock:
+            return self._versions[resource]
+
+    def store(self, key, result, version):
+        """Cache a response, unless resource type was invalidated since ``version``."""
+        with self._lock:
+            if self._versions[key[1]] != version:
+                return
+            self._results[key] = result
+            self._results.move_to_end(key)
+            if len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def get(self, key, load):
+        """Return a copy of cached response or call ``load`` to get it."""
+        with self._lock:
+            if key in self._results:
+                self.hits += 1
+                self._results.move_to_end(key)
+                return deepcopy(self._results[key])
+            future = self._pending.get(key)
+            if future is None:
+                self.misses += 1
+                future = self._pending[key] = futures.Future()
+                version = self._versions[key[1]]
+            else:
+                # Same request is already in flight, wait for its response.
+                self.hits += 1
+                version = None
+
+        if version is None:
+            return deepcopy(future.result())
+
+        try:
+            result = load()
+        except Exception as e:
+            self._done(key, future)
+            future.set_exception(e)
+            raise
+        self._done(key, future)
+        self.store(key, result, version)
+        future.set_result(result)
+        return deepcopy(result)
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def invalidate(self, resource):
+        with self._lock:
+            self._versions[resource] += 1
+            for key in [key for key in self._results if key[1] == resource]:
+                del self._results[key]
+            # Requests in flight are not shared with new callers, since they can be outdated.
+            for key in [key for key in self._pending if key[1] == resource]:
+                del self._pending[key]
+
+
+def _invalidates_cache(method):
+    """Invalidate cached responses of a resource type, given as first argument, after a write."""
+    @wraps(method)
+    def wrapper(self, resource, *args, **kwargs):
+        try:
+            return method(self, resource, *args, **kwargs)
+        finally:
+            self._invalidate(resource)
+    return wrapper
 
-    def __init__(self, qvarn_client, qvarn_capabilities=None):
+
+class QvarnApi(object):
+    """Wrapper around Tilaajavastuu Qvarn client.
+
+    Parameters
+    ----------
+    qvarn_client : QvarnClient
+    qvarn_capabilities : QvarnCapabilities
+    revision_cache_size : int
+        Number of last seen resource revisions kept in memory. Cached revisions are used by
+        ``update`` if payload does not have a revision, instead of fetching the resource. Set to 0
+        to disable the cache.
+    max_in_flight : int
+        Maximum number of pending requests of ``create_multiple``, ``update_multiple`` and
+        ``iter_*`` methods. By default it is the number of threads of the ``qvarn_client`` session
+        executor (100 if it is unknown), more requests would only wait in the executor queue.
+    retries : int
+        Number of retries of idempotent requests (GET, PUT and DELETE) failed with
+        ``QvarnUnavailable``. POST requests are never retried.
+    retry_backoff : float
+        Delay of the first retry in seconds, each subsequent delay is doubled.
+    retry_backoff_max : float
+        Maximum delay between retries in seconds.
+    circuit_breaker : CircuitBreaker
+        Circuit breaker shared by all requests, ``CircuitBreaker()`` by default.
+    concurrency_limiter : ConcurrencyLimiter
+        Limiter of concurrent requests shared by all requests,
+        ``ConcurrencyLimiter(max_limit=max_in_flight)`` by default.
+    search_page_size : int
+        Number of results fetched at once by ``iter_search`` and ``iter_list``.
+    metrics : qvarnmr.metrics.MetricsSink
+        Receiver of measurements of all completed requests, ``RequestMetrics()`` by default.
+
+    """
+
+    def __init__(self, qvarn_client, qvarn_capabilities=None, revision_cache_size=10000,
+                 max_in_flight=None, retries=3, retry_backoff=0.1, retry_backoff_max=2.0,
+                 circuit_breaker=None, concurrency_limiter=None, search_page_size=1000,
+                 metrics=None):
         self.client = qvarn_client
+        self.metrics = metrics or RequestMetrics()
+        if max_in_flight is None:
+            max_in_flight = _get_max_workers(qvarn_client) or 100
+        self.max_in_flight = max_in_flight
+        self.search_page_size = search_page_size
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.concurrency_limiter = concurrency_limiter or ConcurrencyLimiter(
+            max_limit=max_in_flight,
+        )
         if qvarn_capabilities:
             self.caps = qvarn_capabilities
         else:
             self.caps = QvarnCapabilities(extended_project_fields=False)
 
-    def _resolve_future(self, future):
-        """Resolve requests-futures future and handle exceptions."""
-        resp = future.result()
+        self._cache = None
+
+        self.revision_cache_size = revision_cache_size
+        self._revisions = OrderedDict()
+        self._revisions_lock = threading.Lock()
+
+    def _remember_revision(self, resource, doc):
+        """Remember revision of a resource document, if it has one."""
+        if not self.revision_cache_size or not isinstance(doc, dict):
+            return
+        if not doc.get('id') or not doc.get('revision'):
+            return
+        key = (resource, doc['id'])
+        with self._revisions_lock:
+            self._revisions[key] = doc['revision']
+            self._revisions.move_to_end(key)
+            if len(self._revisions) > self.revision_cache_size:
+                self._revisions.popitem(last=False)
+
+    def _forget_revision(self, resource, id):
+        with self._revisions_lock:
+            self._revisions.pop((resource, id), None)
+
+    def _get_revision(self, resource, id):
+        """Return cached revision of a resource or None."""
+        with self._revisions_lock:
+            return self._revisions.get((resource, id))
+
+    def copy(self):
+        """Return a ``QvarnApi`` sharing client, limits, caches of revisions and metrics.
+
+        Only the request cache of ``cache_scope`` is not shared, so copies can be used by threads
+        doing independent work, each with its own scope.
+        """
+        qvarn = copy(self)
+        qvarn._cache = None
+        return qvarn
+
+    @contextmanager
+    def cache_scope(self, max_entries=10000):
+        """Cache GET and search responses until the end of the with block.
+
+        Responses are cached by ``get`` (without subresources), ``get_multiple``, ``search`` and
+        ``search_one``. Writes done through this ``QvarnApi`` invalidate cached responses of the
+        written resource type, but changes done by others are not seen until the end of the block.
+
+        Nested scopes use the outer cache. If ``max_entries`` is 0, nothing is cached. The cache
+        is shared by all threads using this ``QvarnApi``, so threads doing independent work with
+        their own scopes have to use separate copies, see ``copy``.
+
+        Yields
+        ------
+        Optional[RequestCache]
+
+        """
+        if self._cache is not None or not max_entries:
+            yield self._cache
+            return
+        self._cache = RequestCache(max_entries)
+        try:
+            yield self._cache
+        finally:
+            logger.debug('request cache hits=%d misses=%d', self._cache.hits, self._cache.misses)
+            self._cache = None
+
+    def _invalidate(self, resource):
+        cache = self._cache
+        if cache is not None:
+            cache.invalidate(resource)
+
+    @property
+    def concurrency_limit(self):
+        """Current number of concurrent requests allowed by the concurrency limiter."""
+        return self.concurrency_limiter.limit
+
+    def _send(self, request, block=True):
+        """Send a request, waiting until the concurrency limiter allows it. Return a future.
+
+        If ``block`` is false, None is returned instead of waiting, see
+        ``ConcurrencyLimiter.submit``. While circuit breaker is open, the request is not sent and
+        the returned future fails with ``QvarnUnavailable``.
+        """
+        if self.circuit_breaker.is_open():
+            future = futures.Future()
+            future.set_exception(QvarnUnavailable('Qvarn is unavailable, circuit breaker is open'))
+            return future
+        future = self.concurrency_limiter.submit(request, block)
+        if future is None:
+            return None
+        # Used to measure latency of requests failed without a response.
+        future.sent_at = time.monotonic()
+        return future
+
+    def _record(self, future):
+        """Pass measurements of a completed request to the metrics sink."""
+        error = future.exception()
+        if error is None:
+            resp = future.result()
+            request, status, size = resp.request, resp.status_code, len(resp.content or b'')
+            latency = resp.elapsed.total_seconds()
+            error = str(status) if status >= 400 else None
+        else:
+            request, status, size = getattr(error, 'request', None), None, 0
+            latency = time.monotonic() - getattr(future, 'sent_at', time.monotonic())
+            error = type(error).__name__
+        if request is None:
+            operation, resource = 'unknown', ''
+        else:
+            operation, resource = _classify_request(request.method, request.url)
+        self.metrics.record(operation, resource, status, latency, size, error)
+
+    def _request(self, request, idempotent=True):
+        """Send a request and resolve its future, see ``_resolve_future``."""
+        return self._resolve_future(self._send(request), request if idempotent else None)
+
+    def _resolve_future(self, future, retry=None):
+        """Resolve requests-futures future and handle exceptions.
+
+        ``retry`` is a function sending the same request again. It should be given only for
+        idempotent requests, which are then retried with exponential backoff on transient failures.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._resolve_response(future)
+            except QvarnUnavailable as e:
+                delay = self._retry_delay(e, attempt, retry)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                future = self._send(retry)
+
+    def _retry_delay(self, error, attempt, retry):
+        """Return seconds to wait before retrying a failed request or None if it is not retried."""
+        if retry is None or attempt >= self.retries or self.circuit_breaker.is_open():
+            return None
+        delay = min(self.retry_backoff * 2 ** attempt, self.retry_backoff_max)
+        logger.warning('%s, retrying in %.2fs', error, delay)
+        return delay
+
+    def _resolve_response(self, future):
+        if not future.done() and self.circuit_breaker.is_open() and future.cancel():
+            # Request was still waiting in the queue, it is not sent while circuit is open. Requests
+            # already being sent are always resolved, so that they are never sent twice.
+            raise QvarnUnavailable('Qvarn is unavailable, circuit breaker is open')
+        if isinstance(future.exception(), QvarnUnavailable):
+            # Request was not sent at all, see ``_send``.
+            raise future.exception()
+        self._record(future)
+        try:
+            resp = future.result()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            self.circuit_breaker.record_failure()
+            raise QvarnUnavailable('Connection error: {}'.format(e))
+        if resp.status_code in TRANSIENT_STATUS_CODES:
+            self.circuit_breaker.record_failure()
+            raise QvarnUnavailable('Service unavailable ({}): {}'.format(resp.status_code,
+                                                                         resp.text))
+        self.circuit_breaker.record_success()
+
         if resp.status_code in [requests.codes.ok, requests.codes.created]:
             if resp.headers.get('content-type').lower() == 'application/json':
-                return QvarnResultDict(resp.json())
+                # Qvarn always responds with UTF-8, decoding bytes directly avoids encoding
+                # detection done by ``resp.json()``.
+                return QvarnResultDict(_loads(resp.content))
             else:
                 return resp.text
         else:
@@ -96,77 +620,305 @@ class QvarnApi(object):
             else:
                 raise QvarnError('Unknown error: {}'.format(resp.text))
 
-    def _resolve_futures(self, futs):
-        """Resolve multiple futures. Return a list of dicts."""
+    def _resolve_futures(self, futs, return_exceptions=False, retries=None):
+        """Resolve multiple futures. Return a list of dicts.
+
+        If ``return_exceptions`` is true, errors are returned in place of failed results instead of
+        being raised, so that one failed request does not abort the whole batch.
+
+        ``retries`` is a list of functions resending requests of idempotent futures, see
+        ``_resolve_future``.
+        """
         futures.wait(futs)
-        return [self._resolve_future(fut) for fut in futs]
+        retries = retries or [None] * len(futs)
+        return [self._resolve_item(fut, retry, return_exceptions=return_exceptions)
+                for fut, retry in zip(futs, retries)]
 
-    def _resolve_list_future(self, fut, *, flatten_list=True):
-        resp = self._resolve_future(fut)
+    def _request_multiple(self, requests, return_exceptions=False):
+        """Send idempotent requests in parallel and return their results.
+
+        ``requests`` is an iterable of functions, each sending one request and returning a future.
+        """
+        requests = list(requests)
+        futs = [self._send(request) for request in requests]
+        return self._resolve_futures(futs, return_exceptions, retries=requests)
+
+    def _iter_requests(self, requests, return_exceptions=False, window=None, idempotent=True):
+        """Send requests in parallel and yield their responses in order.
+
+        ``requests`` is an iterable of functions, each sending one request and returning a future.
+        It is consumed lazily, at most ``window`` (``max_in_flight`` by default) requests are
+        pending at once. Requests are retried on transient failures if ``idempotent`` is true.
+
+        If ``return_exceptions`` is true, ``QvarnError`` instances are yielded in place of failed
+        results.
+        """
+        window = window or self.max_in_flight
+        pending = deque()
+        try:
+            for request in requests:
+                pending.append((self._send(request), request if idempotent else None))
+                if len(pending) >= window:
+                    fut, retry = pending.popleft()
+                    yield self._resolve_item(fut, retry, return_exceptions=return_exceptions)
+            while pending:
+                fut, retry = pending.popleft()
+                yield self._resolve_item(fut, retry, return_exceptions=return_exceptions)
+        finally:
+            # Stop requests, that are not yet sent, if iteration was interrupted.
+            for fut, request in pending:
+                fut.cancel()
+
+    def _resolve_item(self, fut, retry=None, *, return_exceptions):
+        try:
+            return self._resolve_future(fut, retry)
+        except QvarnError as e:
+            if return_exceptions:
+                return e
+            raise
+
+    def _resolve_list_future(self, fut, *, flatten_list=True, resource=None, retry=None):
+        return self._list_result(self._resolve_future(fut, retry), flatten_list, resource)
+
+    def _list_result(self, resp, flatten_list=True, resource=None):
         if flatten_list:
             return [item['id'] for item in resp['resources']]
         else:
-            return list(map(QvarnResultDict, resp['resources']))
+            rows = resp['resources']
+            if resource is not None:
+                for doc in rows:
+                    self._remember_revision(resource, doc)
+            return QvarnResultList(rows)
 
     def get(self, resource, id, subresources=()):
         """Retrieve a resource and one or more subresources."""
-        fut = self.client.resource(resource).single(id).get()
-        doc = self._resolve_future(fut)
-
+        cache = self._cache
+        if cache is not None and not subresources:
+            return cache.get(('get', resource, id), partial(self._get, resource, id))
+        doc = self._get(resource, id)
         for subresource in subresources:
             doc[subresource] = self._get_subresource(resource, subresource, id)
         return doc
 
+    def _get(self, resource, id):
+        doc = self._request(self.client.resource(resource).single(id).get)
+        self._remember_revision(resource, doc)
+        return doc
+
     def get_file(self, resource, subresource, id):
-        future = self.client.resource(resource).single(id).filesubresource(subresource).get()
-        return self._resolve_future(future)
+        request = self.client.resource(resource).single(id).filesubresource(subresource).get
+        return self._request(request)
 
     def _get_subresource(self, resource, subresource, id):
-        return self._resolve_future(
-            self.client.resource(resource).single(id).subresource(subresource).get()
-        )
+        request = self.client.resource(resource).single(id).subresource(subresource).get
+        return self._request(request)
 
     def get_list(self, resource):
         """Retrieve a list of IDs."""
-        return self._resolve_list_future(self.client.resource(resource).get())
+        request = self.client.resource(resource).get
+        return self._resolve_list_future(self._send(request), retry=request)
+
+    def iter_list(self, resource, page_size=None, after=None):
+        """Retrieve IDs of all resources page by page and yield them lazily, see ``iter_search``."""
+        return self.iter_search(resource, page_size=page_size, after=after)
+
+    def get_list_multiple(self, resources):
+        """Retrieve lists of IDs of multiple resources in parallel."""
+        requests = [self.client.resource(resource).get for resource in resources]
+        futs = [self._send(request) for request in requests]
+        futures.wait(futs)
+        return [self._resolve_list_future(fut, retry=request)
+                for fut, request in zip(futs, requests)]
 
-    def get_multiple(self, resource, ids):
+    def get_multiple(self, resource, ids, return_exceptions=False):
         """Retrieve multiple resources in parallel. Does not fetch subresources.
+
+        If ``return_exceptions`` is true, ``QvarnError`` instances are returned in place of
+        resources that could not be retrieved.
         """
-        futs = [self.client.resource(resource).single(id).get() for id in ids]
-        return self._resolve_futures(futs)
+        cache = self._cache
+        if cache is None:
+            return self._get_multiple(resource, ids, return_exceptions)
+
+        ids = list(ids)
+        result = [None] * len(ids)
+        missing = []
+        for i, id in enumerate(ids):
+            hit, result[i] = cache.lookup(('get', resource, id))
+            if not hit:
+                missing.append(i)
+
+        version = cache.version(resource)
+        docs = self._get_multiple(resource, [ids[i] for i in missing], return_exceptions=True)
+        for i, doc in zip(missing, docs):
+            result[i] = doc
+            if not isinstance(doc, Exception):
+                cache.store(('get', resource, ids[i]), doc, version)
+                result[i] = deepcopy(doc)
+        return self._raise_or_return(result, return_exceptions)
+
+    def _get_multiple(self, resource, ids, return_exceptions=False):
+        result = self._request_multiple(
+            (self.client.resource(resource).single(id).get for id in ids), return_exceptions,
+        )
+        for doc in result:
+            self._remember_revision(resource, doc)
+        return result
+
+    def iter_get_multiple(self, resource, ids, return_exceptions=False, window=None):
+        """Retrieve multiple resources in parallel and yield them in order.
+
+        Unlike ``get_multiple``, ids are consumed lazily and at most ``window`` requests are
+        pending at once, so arbitrarily large lists of ids are processed in constant memory.
+        """
+        requests = (self.client.resource(resource).single(id).get for id in ids)
+        for doc in self._iter_requests(requests, return_exceptions, window):
+            self._remember_revision(resource, doc)
+            yield doc
 
     def get_multiple_subresources(self, resource, subresource, ids):
-        futs = [self.client.resource(resource).single(id).subresource(subresource).get()
-                for id in ids]
-        return self._resolve_futures(futs)
+        return self._request_multiple(
+            self.client.resource(resource).single(id).subresource(subresource).get for id in ids
+        )
 
     def get_version(self):
-        fut = self.client.resource('version').get()
-        return self._resolve_future(fut)
+        request = self.client.resource('version').get
+        return self._request(request)
 
+    @_invalidates_cache
     def create(self, resource, payload, subresources=(), files=()):
         subresources = self._pop_subresource_data(payload, subresources)
         files = self._pop_subresource_data(payload, files)
-        created = self._resolve_future(self.client.resource(resource).post(payload))
+        created = self._request(partial(self.client.resource(resource).post, payload),
+                                idempotent=False)
         logger.info('%r resource created with id: %r', resource, created['id'])
+        self._remember_revision(resource, created)
         self._update_subresources(resource, created, subresources)
         self._update_files(resource, created, files)
         return QvarnResultDict(created)
 
+    @_invalidates_cache
     def update(self, resource, id, payload, subresources=(), files=()):
+        """Update a resource.
+
+        If payload does not have a revision, then cached revision is used, or the resource is
+        fetched if there is no cached revision. If cached revision turns out to be outdated, the
+        resource is fetched and update is retried once.
+        """
+        cached = False
         if not payload.get('revision'):
-            doc = self.get(resource, id)
-            payload['revision'] = doc['revision']
+            revision = self._get_revision(resource, id)
+            cached = revision is not None
+            if revision is None:
+                # Revision is never taken from the request cache, because it might be outdated.
+                revision = self._get(resource, id)['revision']
+            payload['revision'] = revision
 
         subresources = self._pop_subresource_data(payload, subresources)
         files = self._pop_subresource_data(payload, files)
-        updated = self._resolve_future(self.client.resource(resource).single(id).put(payload))
+        request = partial(self.client.resource(resource).single(id).put, payload)
+        try:
+            updated = self._request(request)
+        except QvarnResourceConflict:
+            if not cached:
+                raise
+            logger.debug('cached revision of %r resource with id: %r is outdated', resource, id)
+            self._invalidate(resource)
+            payload['revision'] = self._get(resource, id)['revision']
+            updated = self._request(request)
         logger.info('%r resource with id: %r has been updated', resource, id)
+        self._remember_revision(resource, updated)
         self._update_subresources(resource, updated, subresources)
         self._update_files(resource, updated, files)
         return QvarnResultDict(updated)
 
+    @_invalidates_cache
+    def create_multiple(self, resource, payloads, return_exceptions=False):
+        """Create multiple resources in parallel. Does not create subresources.
+
+        If ``return_exceptions`` is true, ``QvarnError`` instances are returned in place of
+        resources that could not be created.
+        """
+        result = list(self._iter_requests(
+            (partial(self.client.resource(resource).post, payload) for payload in payloads),
+            return_exceptions=True, idempotent=False,
+        ))
+        for created in result:
+            if not isinstance(created, Exception):
+                logger.info('%r resource created with id: %r', resource, created['id'])
+                self._remember_revision(resource, created)
+        return self._raise_or_return(result, return_exceptions)
+
+    @_invalidates_cache
+    def update_multiple(self, resource, ids, payloads, return_exceptions=False):
+        """Update multiple resources in parallel. Does not update subresources.
+
+        Revisions missing in payloads are taken the same way as in ``update``.
+
+        If ``return_exceptions`` is true, ``QvarnError`` instances are returned in place of
+        resources that could not be updated.
+        """
+        ids = list(ids)
+        payloads = list(payloads)
+        result = [None] * len(ids)
+
+        cached = set()
+        missing = []
+        for i, (id, payload) in enumerate(zip(ids, payloads)):
+            if not payload.get('revision'):
+                revision = self._get_revision(resource, id)
+                if revision is None:
+                    missing.append(i)
+                else:
+                    payload['revision'] = revision
+                    cached.add(i)
+        self._fetch_revisions(resource, ids, payloads, missing, result)
+
+        pending = [i for i in range(len(ids)) if result[i] is None]
+        self._put_multiple(resource, ids, payloads, pending, result)
+
+        conflicts = [
+            i for i in pending
+            if i in cached and isinstance(result[i], QvarnResourceConflict)
+        ]
+        if conflicts:
+            logger.debug('%d cached revisions of %r resources are outdated', len(conflicts),
+                         resource)
+            self._invalidate(resource)
+            self._fetch_revisions(resource, ids, payloads, conflicts, result)
+            self._put_multiple(resource, ids, payloads, [
+                i for i in conflicts if isinstance(result[i], QvarnResourceConflict)
+            ], result)
+
+        return self._raise_or_return(result, return_exceptions)
+
+    def _fetch_revisions(self, resource, ids, payloads, indexes, result):
+        docs = self.get_multiple(resource, [ids[i] for i in indexes], return_exceptions=True)
+        for i, doc in zip(indexes, docs):
+            if isinstance(doc, Exception):
+                result[i] = doc
+            else:
+                payloads[i]['revision'] = doc['revision']
+
+    def _put_multiple(self, resource, ids, payloads, indexes, result):
+        updated = self._iter_requests(
+            (partial(self.client.resource(resource).single(ids[i]).put, payloads[i])
+             for i in indexes),
+            return_exceptions=True,
+        )
+        for i, doc in zip(indexes, updated):
+            result[i] = doc
+            if not isinstance(doc, Exception):
+                logger.info('%r resource with id: %r has been updated', resource, ids[i])
+                self._remember_revision(resource, doc)
+
+    def _raise_or_return(self, result, return_exceptions):
+        if not return_exceptions:
+            for item in result:
+                if isinstance(item, Exception):
+                    raise item
+        return result
+
     def _pop_subresource_data(self, payload, subresources):
         return {subresource: payload.pop(subresource) for subresource in subresources}
 
@@ -181,32 +933,84 @@ class QvarnApi(object):
             # revision which are present in doc anyway.
             self.update_file(resource, subresource, doc, ct, body)
 
+    @_invalidates_cache
     def update_subresource(self, resource, subresource, doc, payload):
         payload['revision'] = doc['revision']
-        request = self.client.resource(resource).single(doc['id']).subresource(subresource)
-        response = self._resolve_future(request.put(payload))
+        request = partial(
+            self.client.resource(resource).single(doc['id']).subresource(subresource).put, payload,
+        )
+        response = self._request(request)
         doc['revision'] = response['revision']
+        self._remember_revision(resource, doc)
         logger.info('%r subresource of %r resource with id: %r has been updated',
                     subresource, resource, doc['id'])
         return response
 
+    @_invalidates_cache
     def update_file(self, resource, subresource, doc, content_type, body: bytes):
-        request = self.client.resource(resource).single(doc['id']).filesubresource(subresource)
-        future = request.put(body, content_type, doc['revision'])
-        response = self._resolve_future(future)
+        request = partial(
+            self.client.resource(resource).single(doc['id']).filesubresource(subresource).put,
+            body, content_type, doc['revision'],
+        )
+        response = self._request(request)
         doc['revision'] = response['revision']
+        self._remember_revision(resource, doc)
         logger.info('%r subresource of %r resource with id: %r has been updated',
                     subresource, resource, doc['id'])
         return response
 
+    @_invalidates_cache
     def delete(self, resource, id):
-        result = self._resolve_future(self.client.resource(resource).single(id).delete())
+        request = self.client.resource(resource).single(id).delete
+        result = self._request(request)
         logger.info('%r resource with id: %r has been deleted', resource, id)
+        self._forget_revision(resource, id)
         return result
 
-    def delete_multiple(self, resource, ids):
-        futs = [self.client.resource(resource).single(id).delete() for id in ids]
-        return self._resolve_futures(futs)
+    @_invalidates_cache
+    def delete_multiple(self, resource, ids, return_exceptions=False):
+        """Delete multiple resources in parallel.
+
+        If ``return_exceptions`` is true, ``QvarnError`` instances are returned in place of
+        resources that could not be deleted.
+        """
+        result = self._request_multiple(
+            (self.client.resource(resource).single(id).delete for id in ids), return_exceptions,
+        )
+        for id in ids:
+            self._forget_revision(resource, id)
+        return result
+
+    def iter_delete_multiple(self, resource, ids, return_exceptions=False, window=None):
+        """Delete multiple resources in parallel and yield results in order.
+
+        Ids are consumed lazily and at most ``window`` requests are pending at once.
+        """
+        ids = iter(ids)
+        deleted = deque()
+
+        def requests():
+            for id in ids:
+                deleted.append(id)
+                yield self.client.resource(resource).single(id).delete
+
+        for result in self._iter_requests(requests(), return_exceptions, window):
+            self._forget_revision(resource, deleted.popleft())
+            self._invalidate(resource)
+            yield result
+
+    def _parse_query(self, query):
+        criteria = []
+        for key, value in query.items():
+            if '__' not in key:
+                field, method = key, 'exact'
+            else:
+                try:
+                    field, method = key.split('__')
+                except ValueError:
+                    raise ValueError('Invalid search query {}'.format(key))
+            criteria.append((method, field, value))
+        return sorted(criteria)
 
     def search(self, resource, show=(), show_all=False, **query):
         """Perform search using Django ORM style syntax.
@@ -242,17 +1046,53 @@ class QvarnApi(object):
             Returns a list of Qvarn IDs or QvarnResultDict's if either show or show_all is given.
 
         """
-        criteria = []
-        for key, value in query.items():
-            if '__' not in key:
-                field, method = key, 'exact'
-            else:
-                try:
-                    field, method = key.split('__')
-                except ValueError:
-                    raise ValueError('Invalid search query {}'.format(key))
-            criteria.append((method, field, value))
+        criteria = self._parse_query(query)
+
+        cache = self._cache
+        if cache is not None:
+            key = ('search', resource, tuple(show), show_all, repr(criteria))
+            return cache.get(key, partial(self._search, resource, show, show_all, criteria))
+        return self._search(resource, show, show_all, criteria)
+
+    def iter_search(self, resource, show=(), show_all=False, page_size=None, after=None,
+                    **query):
+        """Perform search like ``search``, but fetch results page by page and yield them lazily.
+
+        Results are sorted by id. Each page is requested with Qvarn's ``sort`` and ``limit``
+        search conditions and starts after the last id of the previous page, so that large
+        resource types are never fetched at once and resources created or deleted during iteration
+        do not shift pages. Results are not cached by ``cache_scope``.
+
+        Parameters
+        ----------
+        page_size : int
+            Number of results fetched at once, ``search_page_size`` by default.
+        after : str
+            If given, only resources with ids greater than ``after`` are returned, so that an
+            interrupted iteration can be resumed from the last seen id.
+
+        """
+        page_size = page_size or self.search_page_size
+        criteria = self._parse_query(query)
+        last_id = after
+        while True:
+            page_criteria = criteria
+            if last_id is not None:
+                page_criteria = criteria + [('gt', 'id', last_id)]
+            page = self._search(resource, show, show_all, page_criteria, page_size)
+            yield from page
+            if len(page) < page_size:
+                break
+            last_id = page[-1] if not (show or show_all) else page[-1]['id']
+
+    def _search(self, resource, show, show_all, criteria, limit=None):
+        request = self._search_request(resource, show, show_all, criteria, limit)
+        flatten_list = not (show_all or show)
+        return self._resolve_list_future(self._send(request), flatten_list=flatten_list,
+                                         resource=resource, retry=request)
 
+    def _search_request(self, resource, show, show_all, criteria, limit=None):
+        """Build a search request, return a function sending it."""
         search = self.client.resource(resource).search()
         if show_all:
             search = search.show_all()
@@ -260,7 +1100,7 @@ class QvarnApi(object):
             for field in show:
                 search = search.show(field)
 
-        for method, field, value in sorted(criteria):
+        for method, field, value in criteria:
             if isinstance(value, (tuple, list)):
                 # Handle ``resource_id__exact=(person_id, organisation_id)`` case.
                 for value_i in value:
@@ -269,8 +1109,10 @@ class QvarnApi(object):
                 # Handle ``resource_id__exact=person_id`` case, where ``exact`` is a ``method``.
                 search = getattr(search, method)(field, str(value))
 
-        flatten_list = not (show_all or show)
-        return self._resolve_list_future(search.get(), flatten_list=flatten_list)
+        if limit is not None:
+            search = _sort_and_limit(search, 'id', limit)
+
+        return search.get
 
     def search_one(self, resource, *, default=NO_DEFAULT, subresources=(), show=(), show_all=False,
                    **query):
@@ -329,9 +1171,42 @@ class QvarnApi(object):
 
         Tries to access all the requested resources.  Raises if anything fails.
         """
-        futs = [self.client.resource(resource).search().exact('id', '*statuscheck*').get()
-                for resource in resources]
-        self._resolve_futures(futs)
+        self._request_multiple(
+            self.client.resource(resource).search().exact('id', '*statuscheck*').get
+            for resource in resources
+        )
+
+
+def _get_max_workers(qvarn_client):
+    """Return number of threads sending requests of a ``QvarnClient``, None if it is unknown."""
+    qvarn_requests = getattr(qvarn_client, '_requests', None)
+    executor = getattr(getattr(qvarn_requests, '_session', None), 'executor', None)
+    return getattr(executor, '_max_workers', None)
+
+
+def _classify_request(method, url):
+    """Return operation and resource type of a Qvarn request."""
+    path = [part for part in urllib.parse.urlparse(url).path.split('/') if part]
+    resource = path[0] if path else ''
+    if len(path) > 1 and path[1] == 'listeners':
+        resource += '/listeners'
+
+    if method == 'GET':
+        if len(path) > 1 and path[1] == 'search':
+            operation = 'search'
+        elif len(path) == 1 or path[-1] in ('listeners', 'notifications'):
+            operation = 'list'
+        else:
+            operation = 'get'
+    else:
+        operation = {'POST': 'create', 'PUT': 'update', 'DELETE': 'delete'}.get(method, method)
+    return operation, resource
+
+
+def _sort_and_limit(search, field, limit):
+    """Add ``sort`` and ``limit`` search conditions, which are not supported by qvarnclient."""
+    url = '{}/sort/{}/limit/{}'.format(search._url, field, limit)
+    return type(search)(url, search._requests)
 
 
 def setup_qvarn_client(config):
@@ -350,9 +1225,31 @@ def setup_qvarn_client(config):
     return qvarn_client
 
 
+def get_qvarn_api_options(config):
+    """Return ``QvarnApi`` options from ``[qvarn]`` config section."""
+    max_limit = config.getint('qvarn', 'concurrency_max',
+                              fallback=config.getint('qvarn', 'threads', fallback=1))
+    return {
+        'search_page_size': config.getint('qvarn', 'search_page_size', fallback=1000),
+        'concurrency_limiter': ConcurrencyLimiter(
+            min_limit=config.getint('qvarn', 'concurrency_min', fallback=1),
+            max_limit=max_limit,
+            latency_target=config.getfloat('qvarn', 'latency_target', fallback=1.0),
+        ),
+        'retries': config.getint('qvarn', 'retries', fallback=3),
+        'retry_backoff': config.getfloat('qvarn', 'retry_backoff', fallback=0.1),
+        'retry_backoff_max': config.getfloat('qvarn', 'retry_backoff_max', fallback=2.0),
+        'circuit_breaker': CircuitBreaker(
+            threshold=config.getint('qvarn', 'circuit_breaker_threshold', fallback=10),
+            reset_timeout=config.getfloat('qvarn', 'circuit_breaker_timeout', fallback=30),
+        ),
+    }
+
+
 def setup_qvarn_api(config):
     qvarn_capabilities = QvarnCapabilities(
         extended_project_fields=config.getboolean('qvarn', 'extended_project_fields',
                                                   fallback=False)
     )
-    return QvarnApi(setup_qvarn_client(config), qvarn_capabilities)
+    return QvarnApi(setup_qvarn_client(config), qvarn_capabilities,
+                    **get_qvarn_api_options(config))
@@ -1,7 +1,15 @@
+from collections import namedtuple, defaultdict
 from collections.abc import Iterator
 from functools import wraps
 
 
+# Incremental reducer contract, see ``combine`` reduce handler option.
+#
+# initial() returns reduced value for a key without any values, merge(state, value) returns reduced
+# value with an added value and retract(state, value) returns reduced value with a removed value.
+Combiner = namedtuple('Combiner', ['initial', 'merge', 'retract'])
+
+
 class Func:
 
     def __init__(self, func, *args, **kwargs):
@@ -47,6 +55,20 @@ def count(items):
     return sum(1 for x in items)
 
 
+count_combiner = Combiner(
+    initial=lambda: 0,
+    merge=lambda state, value: state + 1,
+    retract=lambda state, value: state - 1,
+)
+
+
+sum_combiner = Combiner(
+    initial=lambda: 0,
+    merge=lambda state, value: state + value,
+    retract=lambda state, value: state - value,
+)
+
+
 @mr_func()
 def item(context, resource, key, value=None):
     if value is None:
@@ -62,9 +84,24 @@ def value(context, resource, key='_mr_value'):
 
 @mr_func()
 def join(context, resources, mapping):
+    resources = context.qvarn.get_multiple(context.source_resource_type, resources)
+
+    # Fetch source resources in parallel, one batch per source resource type.
+    source_ids = defaultdict(list)
+    for resource in resources:
+        source_ids[resource['_mr_source_type']].append(resource['_mr_source_id'])
+    sources = {
+        (source_type, source['id']): source
+        for source_type, ids in source_ids.items()
+        for source in context.qvarn.get_multiple(source_type, ids)
+    }
+
+    # Mapped resources come in no particular order, so if several sources set the same field, the
+    # source with the greatest id wins, whatever the order is.
+    resources = sorted(resources, key=lambda r: (r['_mr_source_type'], r['_mr_source_id']))
     result = {}
-    for resource in context.qvarn.get_multiple(context.source_resource_type, resources):
-        source = context.qvarn.get(resource['_mr_source_type'], resource['_mr_source_id'])
+    for resource in resources:
+        source = sources[(resource['_mr_source_type'], resource['_mr_source_id'])]
         for key, name in mapping.get(source['type'], {}).items():
             name = name or key
             result[name] = source[key]
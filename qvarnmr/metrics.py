@@ -0,0 +1,125 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# Upper bounds of latency histogram buckets in seconds, the last bucket is unbounded.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class MetricsSink:
+    """Receiver of Qvarn request measurements.
+
+    ``QvarnApi`` calls ``record`` once for each completed HTTP request, including retries. It can
+    be called from request pool threads, so implementations have to be thread safe and fast.
+    """
+
+    def record(self, operation, resource, status, latency, size, error):
+        """Record a completed request.
+
+        Parameters
+        ----------
+        operation : str
+            One of ``get``, ``list``, ``search``, ``create``, ``update`` and ``delete``.
+        resource : str
+            Resource type, ``<resource type>/listeners`` for listeners and their notifications.
+        status : Optional[int]
+            HTTP status code or None if no response was received.
+        latency : float
+            Response time in seconds.
+        size : int
+            Response body size in bytes.
+        error : Optional[str]
+            Error class, HTTP status code for error responses or exception name if no response
+            was received, None if request succeeded.
+
+        """
+
+
+class RequestMetrics(MetricsSink):
+    """Collect request counts, latency histograms, response sizes and errors in memory.
+
+    Measurements are grouped by ``(operation, resource)``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, operation, resource, status, latency, size, error):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, latency)
+        with self._lock:
+            stats = self._stats.get((operation, resource))
+            if stats is None:
+                stats = self._stats[(operation, resource)] = {
+                    'count': 0,
+                    'bytes': 0,
+                    'latency': 0.0,
+                    'latency_max': 0.0,
+                    'latency_buckets': [0] * len(LATENCY_BUCKETS),
+                    'errors': defaultdict(int),
+                }
+            stats['count'] += 1
+            stats['bytes'] += size
+            stats['latency'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+            stats['latency_buckets'][bucket] += 1
+            if error is not None:
+                stats['errors'][error] += 1
+
+    def snapshot(self, reset=False):
+        """Return collected measurements.
+
+        Returns
+        -------
+        Dict[Tuple[str, str], dict]
+            Measurements by ``(operation, resource)``: ``count``, ``bytes``, total ``latency``,
+            ``latency_max``, ``latency_buckets`` (number of requests by bucket upper bound, see
+            ``LATENCY_BUCKETS``) and ``errors`` (number of requests by error class).
+
+        """
+        with self._lock:
+            stats, snapshot = self._stats, {}
+            for key, value in stats.items():
+                snapshot[key] = dict(
+                    value,
+                    latency_buckets=dict(zip(LATENCY_BUCKETS, value['latency_buckets'])),
+                    errors=dict(value['errors']),
+                )
+            if reset:
+                self._stats = {}
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+def summarize(snapshot):
+    """Return totals of a ``RequestMetrics`` snapshot.
+
+    Returns
+    -------
+    dict
+        ``requests``, ``errors``, ``bytes``, total and maximal ``latency`` of all requests.
+
+    """
+    return {
+        'requests': sum(x['count'] for x in snapshot.values()),
+        'errors': sum(sum(x['errors'].values()) for x in snapshot.values()),
+        'bytes': sum(x['bytes'] for x in snapshot.values()),
+        'latency': sum(x['latency'] for x in snapshot.values()),
+        'latency_max': max((x['latency_max'] for x in snapshot.values()), default=0.0),
+    }
+
+
+def latency_quantile(latency_buckets, q):
+    """Estimate a latency quantile from histogram buckets, return bucket upper bound."""
+    total = sum(latency_buckets.values())
+    if total == 0:
+        return 0.0
+    seen = 0
+    for bound in sorted(latency_buckets):
+        seen += latency_buckets[bound]
+        if seen >= q * total:
+            return bound
+    return float('inf')
@@ -1,15 +1,20 @@
+import json
 import time
+import datetime
+import hashlib
 import logging
 
+from concurrent import futures
 from operator import itemgetter
 from itertools import groupby
-from collections import namedtuple
+from collections import namedtuple, defaultdict, OrderedDict
 
-from qvarnmr.clients.qvarn import QvarnResourceNotFound
+from qvarnmr.clients.qvarn import QvarnResourceNotFound, QvarnUnavailable
 from qvarnmr.exceptions import HandlerVersionError
 from qvarnmr.func import run
 from qvarnmr.handlers import get_handlers
-from qvarnmr.utils import is_empty
+from qvarnmr.retry import RetryScheduler
+from qvarnmr.utils import is_empty, chunks, KeySet
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +36,12 @@ FailedNotification = namedtuple('FailedNotification', Notification._fields + (
     'processed_at',
 ))
 
+# Resource type, where notifications are stored after all retries are exhausted.
+DEAD_LETTERS = 'qvarnmr_dead_letters'
+
+# Marker for values, that can't be computed.
+NO_VALUE = object()
+
 Context = namedtuple('Context', [
     'qvarn',
     'source_resource_type',
@@ -46,28 +57,124 @@ def _same_version(version, resources):
 
 
 def _clean_existing_resources(qvarn, target_resource_type, resources):
-    qvarn.delete_multiple(target_resource_type, [x['id'] for x in resources])
+    for _ in qvarn.iter_delete_multiple(target_resource_type, (x['id'] for x in resources)):
+        pass
+
+
+def _record_written(written, target_resource_type, resource_change, resource):
+    """Record a mapped resource written by the engine as a generated reduce change."""
+    if written is not None:
+        written.append(((target_resource_type, resource['_mr_key']), Notification(
+            resource_type=target_resource_type,
+            resource_change=resource_change,
+            resource_id=resource['id'],
+            notification_id=None,
+            listener_id=None,
+            generated=True,
+        )))
+
+
+def _mark_deleted(qvarn, target_resource_type, resource_ids, written=None):
+    resources = qvarn.get_multiple(target_resource_type, resource_ids)
+    for resource in resources:
+        # Until reduce was not yet processed, we don't want to delete this resource. Because
+        # reduce handlers need to know the key.
+        # All resources marked for deletion will be cleaned up after each update cycle.
+        resource['_mr_deleted'] = True
+    qvarn.update_multiple(target_resource_type, [x['id'] for x in resources], resources)
+    for resource in resources:
+        _record_written(written, target_resource_type, UPDATED, resource)
+    return len(resources)
+
+
+def _map_result_resource(handler, resource, source_resource_type, key, value):
+    if isinstance(value, dict):
+        value['_mr_value'] = None
+    else:
+        value = {'_mr_value': value}
+
+    value['_mr_key'] = key
+    value['_mr_source_id'] = resource['id']
+    value['_mr_source_type'] = source_resource_type
+    value['_mr_deleted'] = False
+    value['_mr_version'] = handler['version']
+    return value
+
+
+def _fingerprint(value):
+    """Return a stable content fingerprint of a mapped resource."""
+    data = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
 
 
 def _save_map_results(qvarn, handler, resource, target_resource_type, source_resource_type,
-                      results):
+                      results, written=None):
+    values = [
+        _map_result_resource(handler, resource, source_resource_type, key, value)
+        for key, value in results
+    ]
+    for created in qvarn.create_multiple(target_resource_type, values):
+        _record_written(written, target_resource_type, CREATED, created)
+    return len(values)
+
+
+def _save_map_results_diff(qvarn, handler, resource, target_resource_type, source_resource_type,
+                           results, existing_resources, soft_delete=False, written=None):
+    """Save map results, writing only resources, that actually changed.
+
+    Each mapped resource carries a ``_mr_fingerprint`` of its content. Existing resources with the
+    same fingerprint as a new result are left untouched, outdated existing resources are reused for
+    changed results, the rest is created or deleted.
+
+    If ``soft_delete`` is true, outdated resources are not reused, but marked as deleted, because
+    incremental reduce handlers need old values to retract them.
+    """
     resources_updated = 0
 
-    for key, value in results:
-        if isinstance(value, dict):
-            value['_mr_value'] = None
+    existing = defaultdict(list)
+    outdated = []
+    for existing_resource in existing_resources:
+        if existing_resource['_mr_deleted'] or not existing_resource['_mr_fingerprint']:
+            outdated.append(existing_resource)
         else:
-            value = {'_mr_value': value}
+            existing[existing_resource['_mr_fingerprint']].append(existing_resource)
 
-        value['_mr_key'] = key
-        value['_mr_source_id'] = resource['id']
-        value['_mr_source_type'] = source_resource_type
-        value['_mr_deleted'] = False
-        value['_mr_version'] = handler['version']
+    changed = []
+    for key, value in results:
+        value = _map_result_resource(handler, resource, source_resource_type, key, value)
+        fingerprint = _fingerprint(value)
+        if existing[fingerprint]:
+            # Same (key, value) pair is already saved, nothing to do.
+            existing[fingerprint].pop()
+        else:
+            value['_mr_fingerprint'] = fingerprint
+            changed.append(value)
+
+    outdated.extend(x for resources in existing.values() for x in resources)
+
+    if soft_delete:
+        for created in qvarn.create_multiple(target_resource_type, changed):
+            _record_written(written, target_resource_type, CREATED, created)
+            resources_updated += 1
+        resources_updated += _mark_deleted(qvarn, target_resource_type, [
+            x['id'] for x in outdated if not x['_mr_deleted']
+        ], written)
+        return resources_updated
+
+    reused = list(zip(changed, outdated))
+    for value, existing_resource in reused:
+        value['revision'] = existing_resource['revision']
+    for updated in qvarn.update_multiple(target_resource_type, [x['id'] for _, x in reused],
+                                         [value for value, _ in reused]):
+        _record_written(written, target_resource_type, UPDATED, updated)
+        resources_updated += 1
 
-        qvarn.create(target_resource_type, value)
+    for created in qvarn.create_multiple(target_resource_type, changed[len(outdated):]):
+        _record_written(written, target_resource_type, CREATED, created)
         resources_updated += 1
 
+    _clean_existing_resources(qvarn, target_resource_type, outdated[len(changed):])
+
     return resources_updated
 
 
@@ -96,11 +203,19 @@ def _save_reduce_result(qvarn, handler, resource, target_resource_type, key, val
         qvarn.update(target_resource_type, resource['id'], value)
 
 
-def _process_map(qvarn, source_resource_type, resource_change, resource_id, handlers, resync=False):
+def _process_map(qvarn, source_resource_type, resource_change, resource_id, handlers, resync=False,
+                 resource=None, soft_delete_targets=(), written=None):
+    """Process map handlers of a single source resource change.
+
+    If ``written`` list is given, all mapped resources created or updated by map handlers are
+    appended to it as ``((target_resource_type, key), notification)`` reduce changes with generated
+    notifications.
+    """
     resources_updated = 0
     context = Context(qvarn, source_resource_type)
     if resource_change in (CREATED, UPDATED):
-        resource = qvarn.get(source_resource_type, resource_id)
+        if resource is None:
+            resource = qvarn.get(source_resource_type, resource_id)
         for target_resource_type, handler in handlers:
             logger.info('processing map handler source=%s target=%s change=%s resource=%s '
                         'handler=%r version=%s resync=%r', source_resource_type,
@@ -108,8 +223,18 @@ def _process_map(qvarn, source_resource_type, resource_change, resource_id, hand
                         handler['version'], resync)
             start = time.time()
 
+            # Resources of targets used by incremental reduce handlers are marked as deleted
+            # instead of deleting them, because reduce handlers need to retract old values.
+            soft_delete = target_resource_type in soft_delete_targets
+
+            if handler.get('fingerprint'):
+                show = ('revision', '_mr_version', '_mr_deleted', '_mr_fingerprint')
+            elif soft_delete:
+                show = ('_mr_version', '_mr_deleted')
+            else:
+                show = ('_mr_version',)
             existing_resources = qvarn.search(target_resource_type, _mr_source_id=resource['id'],
-                                              show=('_mr_version',))
+                                              show=show)
 
             if resync and _same_version(handler['version'], existing_resources):
                 # If we are doning full resync, skip resources that are already resynced.
@@ -119,11 +244,28 @@ def _process_map(qvarn, source_resource_type, resource_change, resource_id, hand
             # If handler fails, nothing will be updated.
             results = list(run(handler['handler'], context, resource))
 
-            # We have to clean all existing resources produced by map handler previously, because we
-            # can't easily identify previously generated (key, value) pairs with the new ones.
-            _clean_existing_resources(qvarn, target_resource_type, existing_resources)
-            resources_updated += _save_map_results(qvarn, handler, resource, target_resource_type,
-                                                   source_resource_type, results)
+            if handler.get('fingerprint'):
+                # Previously generated (key, value) pairs are identified by fingerprints, so only
+                # changed resources are written.
+                resources_updated += _save_map_results_diff(
+                    qvarn, handler, resource, target_resource_type, source_resource_type, results,
+                    existing_resources, soft_delete, written,
+                )
+            elif soft_delete:
+                resources_updated += _mark_deleted(qvarn, target_resource_type, [
+                    x['id'] for x in existing_resources if not x['_mr_deleted']
+                ], written)
+                resources_updated += _save_map_results(qvarn, handler, resource,
+                                                       target_resource_type, source_resource_type,
+                                                       results, written)
+            else:
+                # We have to clean all existing resources produced by map handler previously,
+                # because we can't easily identify previously generated (key, value) pairs with the
+                # new ones.
+                _clean_existing_resources(qvarn, target_resource_type, existing_resources)
+                resources_updated += _save_map_results(qvarn, handler, resource,
+                                                       target_resource_type, source_resource_type,
+                                                       results, written)
             logger.info('done processing map handler source=%s target=%s change=%s resource=%s '
                         'handler=%r version=%s resync=%r output=%d time=%.2fs',
                         source_resource_type, target_resource_type, resource_change, resource_id,
@@ -138,14 +280,11 @@ def _process_map(qvarn, source_resource_type, resource_change, resource_id, hand
                         handler['version'], resync)
             start = time.time()
 
-            resources = qvarn.search(target_resource_type, _mr_source_id=resource_id)
-            for resource in qvarn.get_multiple(target_resource_type, resources):
-                # Until reduce was not yet processed, we don't want to delete this resource. Because
-                # reduce handlers need to know the key.
-                # All resources marked for deletion will be cleaned up after each update cycle.
-                resource['_mr_deleted'] = True
-                qvarn.update(target_resource_type, resource['id'], resource)
-                resources_updated += 1
+            resources = qvarn.search(target_resource_type, _mr_source_id=resource_id,
+                                     show=('_mr_deleted',))
+            resources_updated += _mark_deleted(qvarn, target_resource_type, [
+                x['id'] for x in resources if not x['_mr_deleted']
+            ], written)
 
             logger.info('done processing map handler source=%s target=%s change=%s resource=%s '
                         'handler=%r version=%s resync=%r time=%.2fs', source_resource_type,
@@ -158,16 +297,84 @@ def _process_map(qvarn, source_resource_type, resource_change, resource_id, hand
     return resources_updated
 
 
+def _is_retry(notification):
+    """Check if notification is a retried or a replayed dead letter notification."""
+    return isinstance(notification, FailedNotification) or (
+        notification.listener_id is None and not notification.generated
+    )
+
+
+def _coalesce_notifications(notifications):
+    """Collapse notifications of a single resource into one effective change.
+
+    Notifications must be given in arrival order. Any number of updates becomes one update, created
+    followed by updates stays created, anything followed by deleted becomes deleted and created
+    followed by deleted cancels out.
+
+    Returns
+    -------
+    Optional[Notification]
+        Last notification with the effective change, or None if changes cancel out.
+
+    """
+    first = notifications[0].resource_change
+    last = notifications[-1].resource_change
+    if first == CREATED and last == DELETED:
+        # A retried notification might have left some mapped resources behind, so in that case
+        # deletion still has to be processed.
+        if not any(_is_retry(n) for n in notifications):
+            return None
+        change = DELETED
+    elif last == DELETED:
+        change = DELETED
+    elif first == CREATED:
+        change = CREATED
+    else:
+        change = UPDATED
+    return notifications[-1]._replace(resource_change=change)
+
+
+def _prefetch_map_resources(qvarn, notifications):
+    """Fetch source resources for a batch of notifications.
+
+    Resources are grouped by resource type and fetched in parallel, one ``get_multiple`` call per
+    resource type.
+
+    Returns
+    -------
+    Dict[Tuple[str, str], Union[QvarnResultDict, QvarnError]]
+        Fetched resources by ``(resource_type, resource_id)``. If a resource could not be fetched,
+        then an exception is returned instead of the resource, so that the error can be reported
+        for that single notification.
+
+    """
+    resources = {}
+    for resource_type, ids in _map_resource_ids(notifications).items():
+        results = qvarn.get_multiple(resource_type, ids, return_exceptions=True)
+        for resource_id, resource in zip(ids, results):
+            resources[(resource_type, resource_id)] = resource
+    return resources
+
+
+def _map_resource_ids(notifications):
+    """Return unique ids of resources to be fetched for map handlers, by resource type."""
+    resource_ids = defaultdict(OrderedDict)
+    for notification in notifications:
+        if notification.resource_change in (CREATED, UPDATED):
+            resource_ids[notification.resource_type][notification.resource_id] = None
+    return OrderedDict((resource_type, list(ids)) for resource_type, ids in resource_ids.items())
+
+
 def _map_reduce_resources(context, resources, handler):
-    resources = context.qvarn.get_multiple(context.source_resource_type, resources)
+    resources = context.qvarn.iter_get_multiple(context.source_resource_type, resources)
     for resource in resources:
         for value in run(handler, context, resource):
             yield value
 
 
 def _iter_reduce_resource_ids(qvarn, config, source_resource_type, key):
-    resources = qvarn.search(source_resource_type, _mr_key=key,
-                             show=('_mr_source_type', '_mr_version', '_mr_deleted'))
+    resources = qvarn.iter_search(source_resource_type, _mr_key=key,
+                                  show=('_mr_source_type', '_mr_version', '_mr_deleted'))
     for resource in resources:
         if not resource['_mr_deleted']:
             map_handler = config[source_resource_type][resource['_mr_source_type']]
@@ -189,16 +396,121 @@ def _get_and_ensure_single_resource(qvarn, resource_type, key):
         return resources[0]
 
 
-def _process_reduce(qvarn, config, source_resource_type, key, handlers, resync=False):
+def _get_reduce_changes(qvarn, source_resource_type, notifications):
+    """Get changed mapped resources and their changes from reduce notifications.
+
+    Returns
+    -------
+    Optional[List[Tuple[QvarnResultDict, Set[str]]]]
+        List of changed mapped resources with all changes seen for each resource, or None if changes
+        can't be applied incrementally.
+
+    """
+    changes = OrderedDict()
+    for notification in notifications:
+        if notification.resource_id is None or _is_retry(notification):
+            # Generated or retried notifications, we can't know what was already reduced.
+            return None
+        changes.setdefault(notification.resource_id, set()).add(notification.resource_change)
+
+    resources = qvarn.get_multiple(source_resource_type, list(changes), return_exceptions=True)
+    if any(isinstance(resource, Exception) for resource in resources):
+        # Mapped resource was already deleted, so we can't retract its value.
+        return None
+
+    return list(zip(resources, changes.values()))
+
+
+def _reduce_values(context, handler, resource):
+    if 'map' in handler:
+        return run(handler['map'], context, resource)
+    else:
+        return [resource['id']]
+
+
+def _combine_reduce_changes(context, config, key, handler, target_resource, changes):
+    """Apply changed mapped resources to the reduced value using handler combiner.
+
+    Returns new reduced value or NO_VALUE if reduced value has to be fully recomputed.
+    """
+    combiner = handler['combine']
+
+    if target_resource is None:
+        state = combiner.initial()
+    elif target_resource['_mr_version'] != handler['version']:
+        return NO_VALUE
+    else:
+        state = target_resource['_mr_value']
+
+    for resource, resource_changes in changes:
+        if resource['_mr_key'] != key:
+            return NO_VALUE
+
+        if CREATED in resource_changes:
+            if resource['_mr_deleted']:
+                # Resource was created and deleted before it was reduced.
+                continue
+            map_handler = config[context.source_resource_type][resource['_mr_source_type']]
+            if map_handler['version'] != resource['_mr_version']:
+                raise HandlerVersionError(key)
+            for value in _reduce_values(context, handler, resource):
+                state = combiner.merge(state, value)
+
+        elif resource['_mr_deleted'] and target_resource is not None:
+            for value in _reduce_values(context, handler, resource):
+                state = combiner.retract(state, value)
+
+        else:
+            # Resource was updated, but we don't know its previous value.
+            return NO_VALUE
+
+    return state
+
+
+def _process_reduce(qvarn, config, source_resource_type, key, handlers, resync=False,
+                    notifications=()):
+    """Process reduce handlers of a single key.
+
+    If all handlers have combiners, reduced values are updated incrementally, from changed mapped
+    resources given in ``notifications`` only. Otherwise, or if changes can't be applied
+    incrementally, reduced values are recomputed from all mapped resources of the key.
+
+    Returns
+    -------
+    bool
+        True if reduced values were updated incrementally.
+
+    """
     context = Context(qvarn, source_resource_type)
-    for target_resource_type, handler in handlers:
+    targets = [
+        (target_resource_type, handler,
+         _get_and_ensure_single_resource(qvarn, target_resource_type, key))
+        for target_resource_type, handler in handlers
+    ]
+
+    if not resync and notifications and all('combine' in handler for _, handler in handlers):
+        changes = _get_reduce_changes(qvarn, source_resource_type, notifications)
+        if changes is not None:
+            values = [
+                _combine_reduce_changes(context, config, key, handler, target_resource, changes)
+                for target_resource_type, handler, target_resource in targets
+            ]
+            if all(value is not NO_VALUE for value in values):
+                for (target_resource_type, handler, target_resource), value in zip(targets, values):
+                    logger.info('processing reduce handler incrementally source=%s target=%s '
+                                'key=%s handler=%r version=%s changes=%d', source_resource_type,
+                                target_resource_type, key, handler['handler'], handler['version'],
+                                len(changes))
+                    _save_reduce_result(qvarn, handler, target_resource, target_resource_type, key,
+                                        value)
+                return True
+
+    for target_resource_type, handler, target_resource in targets:
         logger.info('processing reduce handler source=%s target=%s key=%s handler=%r '
                     'version=%s resync=%r', source_resource_type, target_resource_type, key,
                     handler['handler'], handler['version'], resync)
         start = time.time()
 
-        target_resource = _get_and_ensure_single_resource(qvarn, target_resource_type, key)
-
         if resync and target_resource and _same_version(handler['version'], [target_resource]):
             # If we are doning full resync, skip resources that are already resynced.
             continue
@@ -226,6 +538,18 @@ def _process_reduce(qvarn, config, source_resource_type, key, handlers, resync=F
                         target_resource_type, key, handler['handler'], handler['version'], resync,
                         time.time() - start)
 
+    return False
+
+
+class _MapProgress:
+    """Counters and reduce changes collected while processing map handlers."""
+
+    def __init__(self):
+        self.changes_processed = 0
+        self.errors = 0
+        self.reduce_changes = []
+        self.progress = 0
+
 
 class MapReduceEngine:
     EVENTS = (
@@ -233,10 +557,24 @@ class MapReduceEngine:
         'reduce_handler_processed',
     )
 
-    def __init__(self, qvarn, config, raise_errors=False):
+    # Maximum number of tracked notifications of mapped resources written by the engine.
+    MAX_ECHOES = 100000
+
+    def __init__(self, qvarn, config, raise_errors=False, batch_size=100, workers=1,
+                 retry_scheduler=None, dead_letters=True, cache_size=10000):
         self.qvarn = qvarn
         self.config = config
         self.raise_errors = raise_errors
+        # Number of notifications processed together, source resources of a whole batch are
+        # fetched from Qvarn in parallel.
+        self.batch_size = batch_size
+        # Number of threads used to run handlers concurrently, 1 means, that everything is
+        # processed in the calling thread.
+        self.workers = workers
+        self._executor = futures.ThreadPoolExecutor(workers) if workers > 1 else None
+        # Maximum number of Qvarn responses cached during a single ``process_changes`` call, 0
+        # disables the cache.
+        self.cache_size = cache_size
         self.mappers, self.reducers = get_handlers(config)
         self.callbacks = {event: [] for event in self.EVENTS}
         self.reduce_handler_sources = {
@@ -245,130 +583,515 @@ class MapReduceEngine:
             for source, handler in sources.items()
             if handler['type'] == 'reduce'
         }
+        # Map targets used by incremental reduce handlers.
+        self.soft_delete_targets = {
+            source
+            for source, handlers in self.reducers.items()
+            if any('combine' in handler for _, handler in handlers)
+        }
 
-        self._failed_notifications = {}
+        # Failed notifications waiting for a retry, by notification id.
+        # Empty scheduler is falsy, so it is compared to None.
+        self.retry_scheduler = RetryScheduler() if retry_scheduler is None else retry_scheduler
+        # If True, notifications are stored in qvarnmr_dead_letters, after all retries are
+        # exhausted, otherwise they are just deleted.
+        self.dead_letters = dead_letters
+
+        # Notifications to be stored as dead letters.
+        self._dead_letters = []
+
+        # Mapped resource types, whose resources written by resync are not reduced, but their
+        # keys are collected for reducing later, see ``defer_reduce``.
+        self.deferred_reduce_sources = set()
+        self._deferred_keys = None
+        # Reduce changes of mapped resources written by resync, not yet collected by
+        # ``collect_deferred_reduce``.
+        self._deferred_writes = []
+
+        # Processed notifications waiting to be deleted.
+        self._acknowledged = []
+
+        # Notifications expected for mapped resources written by the engine itself, by
+        # (resource_type, resource_id, resource_change). Values are lists of [key, expected,
+        # reduced, failed], where expected is number of notifications not yet received, reduced is
+        # number of those, that are already reduced and failed is number of those, whose reduce
+        # failed.
+        self._echoes = OrderedDict()
+        # Ids of received notifications of written mapped resources, that were not yet reduced
+        # together with their generated notifications, so they can be reduced incrementally.
+        self._unreduced_echoes = set()
+
+    def copy(self):
+        """Return a new engine with the same handlers and options, but with its own state.
+
+        Copies are used to process independent work, like resync shards, in parallel threads.
+        Callbacks are not copied. Each copy uses its own copy of ``QvarnApi``, so that request
+        caches of concurrent ``process_changes`` calls do not interfere.
+        """
+        engine = MapReduceEngine(self.qvarn.copy(), self.config, raise_errors=self.raise_errors,
+                                 batch_size=self.batch_size, dead_letters=self.dead_letters,
+                                 cache_size=self.cache_size)
+        # Resources written by a copy are collected by ``collect_deferred_reduce`` of this engine.
+        engine.deferred_reduce_sources = set(self.deferred_reduce_sources)
+        return engine
+
+    def defer_reduce(self, source_resource_types):
+        """Defer reduce of mapped resources of given types written by resync.
+
+        Keys of mapped resources written by ``process_changes(resync=True)`` are collected by
+        ``collect_deferred_reduce`` and returned by ``pop_deferred_reduce``, instead of reducing
+        them. This is used by resync, when map handlers writing these resource types and all their
+        reduce handlers are resynced together, so that each key is reduced once, after map resync
+        is done. Changes not made by resync are reduced as usual.
+        """
+        self.deferred_reduce_sources.update(source_resource_types)
+        if self._deferred_keys is None:
+            self._deferred_keys = KeySet()
+
+    def collect_deferred_reduce(self, engine):
+        """Collect keys of mapped resources written by resync, see ``defer_reduce``.
+
+        ``engine`` is this engine or its copy, which did the resync. This has to be called from
+        the thread processing notifications, before notifications of written resources are
+        processed.
+        """
+        written, engine._deferred_writes = engine._deferred_writes, []
+        for key, generated in written:
+            self._deferred_keys.add(key)
+            # Notifications of written resources are acknowledged without reducing them, because
+            # their keys will be reduced by ``pop_deferred_reduce`` caller.
+            self._expect_echo(key[1], generated)
+            self._update_echo(generated, reduced=True)
+
+    def pop_deferred_reduce(self):
+        """Stop deferring reduce, return a ``KeySet`` of deferred ``(resource_type, key)`` pairs.
+
+        Caller is responsible for closing the returned set.
+        """
+        self.deferred_reduce_sources.clear()
+        keys, self._deferred_keys = self._deferred_keys, None
+        return keys if keys is not None else KeySet()
+
+    def _submit(self, func, *args):
+        """Run func in the worker pool and return a future.
+
+        If there is no worker pool, then func is called immediately and an already resolved future
+        is returned.
+        """
+        if self._executor is not None:
+            return self._executor.submit(func, *args)
+
+        future = futures.Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _acknowledge(self, notification):
+        """Queue notification for deletion, queued notifications are deleted by ``_flush``."""
+        if not notification.generated:
+            self._acknowledged.append(notification)
+
+    def _flush(self):
+        """Store dead letters and delete all acknowledged notifications at once."""
+        # Dead letters are stored first, so that nothing is lost, if storing fails.
+        dead_letters, self._dead_letters = self._dead_letters, []
+        for dead_letter in dead_letters:
+            self.qvarn.create(DEAD_LETTERS, dead_letter)
+
+        acknowledged, self._acknowledged = self._acknowledged, []
+        _delete_notifications(self.qvarn, acknowledged)
 
     def _run_callbacks(self, event):
         for callback in self.callbacks[event]:
             callback()
 
+    def _expect_echo(self, key, notification):
+        """Remember, that a notification will come for a mapped resource written by the engine."""
+        echo_key = (notification.resource_type, notification.resource_id,
+                    notification.resource_change)
+        echo = self._echoes.setdefault(echo_key, [key, 0, 0, 0])
+        echo[0] = key
+        echo[1] += 1
+        if len(self._echoes) > self.MAX_ECHOES:
+            # Forgotten notifications will be simply processed as any other notification.
+            self._echoes.popitem(last=False)
+
+    def _update_echo(self, notification, reduced):
+        """Update echo state, once generated notification of a written resource is reduced."""
+        echo_key = (notification.resource_type, notification.resource_id,
+                    notification.resource_change)
+        echo = self._echoes.get(echo_key)
+        if echo is None or echo[1] <= echo[2] + echo[3]:
+            # Notification was already received and reduced together with the generated one.
+            return
+        if reduced:
+            echo[2] += 1
+        else:
+            # Reduce failed, received notification will be retried, as if its reduce failed.
+            echo[3] += 1
+
+    def _consume_echo(self, notification):
+        """Check if notification is an echo of a write done by the engine itself.
+
+        Returns
+        -------
+        Tuple[bool, bool, bool, Any]
+            Tuple of flags telling if notification is an echo, if it is already reduced and if its
+            reduce failed, and a key of the written mapped resource.
+
+        """
+        echo_key = (notification.resource_type, notification.resource_id,
+                    notification.resource_change)
+        echo = self._echoes.get(echo_key)
+        if echo is None:
+            return False, False, False, None
+
+        key, expected, reduced, failed = echo
+        echo[1] -= 1
+        if reduced > 0:
+            echo[2] -= 1
+        elif failed > 0:
+            echo[3] -= 1
+        if echo[1] == 0:
+            del self._echoes[echo_key]
+        return True, reduced > 0, reduced == 0 and failed > 0, key
+
+    def _qvarn_down(self, error):
+        """Check if error is caused by Qvarn being down, in that case processing is aborted.
+
+        Notifications are left in Qvarn and processed again once Qvarn is available, without
+        using up their retries.
+        """
+        return isinstance(error, QvarnUnavailable) and self.qvarn.circuit_breaker.is_open()
+
     def _report_success(self, notifications):
         for notification in notifications:
-            if notification.notification_id in self._failed_notifications:
-                del self._failed_notifications[notification.notification_id]
-            _delete_notification(self.qvarn, notification)
+            if notification.generated:
+                self._update_echo(notification, reduced=True)
+            self._acknowledge(notification)
 
-    def _report_error(self, notifications):
+    def _report_error(self, notifications, error=None):
+        now = time.time()
         for notification in notifications:
-            key = notification.notification_id
-            error = self._failed_notifications.get(key, None)
-            if error is None:
-                self._failed_notifications[key] = FailedNotification(**dict(
-                    notification._asdict(),
-                    retries=0,
-                    processed_at=time.time(),
-                ))
+            if notification.generated:
+                # Generated notifications are not delivered again, so there is nothing to retry.
+                self._update_echo(notification, reduced=False)
+                continue
+
+            if isinstance(notification, FailedNotification):
+                retries = notification.retries + 1
+                failed_at = notification.processed_at
             else:
-                if error.retries > 1:
-                    del self._failed_notifications[key]
-                    _delete_notification(self.qvarn, notification)
-                else:
-                    self._failed_notifications[key] = FailedNotification(**dict(
-                        notification._asdict(),
-                        retries=error.retries + 1,
-                        processed_at=error.processed_at,
-                    ))
+                retries = 0
+                failed_at = now
+
+            if self.retry_scheduler.exhausted(retries):
+                logger.warning("giving up retries of notification=%s resource_type=%s "
+                               "resource_id=%s retries=%d", notification.notification_id,
+                               notification.resource_type, notification.resource_id, retries)
+                self._give_up(notification, retries, failed_at, error)
+            elif not self.retry_scheduler.schedule(
+                notification.notification_id,
+                FailedNotification(**dict(
+                    zip(Notification._fields, notification),
+                    retries=retries,
+                    processed_at=failed_at,
+                )),
+                retries,
+                failed_at,
+            ):
+                # Retry scheduler is full. Notification left unacknowledged would be retried on
+                # each cycle without any backoff and would never reach dead letters.
+                logger.warning("giving up notification=%s resource_type=%s resource_id=%s, too "
+                               "many failed notifications", notification.notification_id,
+                               notification.resource_type, notification.resource_id)
+                self._give_up(notification, retries, failed_at, error)
+
+    def _give_up(self, notification, retries, failed_at, error):
+        """Move failed notification to dead letters, if enabled, and acknowledge it."""
+        if self.dead_letters:
+            self._dead_letters.append({
+                'resource_type': notification.resource_type,
+                'resource_change': notification.resource_change,
+                'resource_id': notification.resource_id,
+                'notification_id': notification.notification_id,
+                'listener_id': notification.listener_id,
+                'retries': retries,
+                'failed_at': datetime.datetime.utcfromtimestamp(failed_at).isoformat(),
+                'error': repr(error) if error is not None else '',
+            })
+        self._acknowledge(notification)
 
     def _iter_changes(self, changes):
-        for notification in changes:
-
-            # Retry failed notifications.
-            if notification.notification_id in self._failed_notifications:
-                now = time.time()
-                notification = self._failed_notifications[notification.notification_id]
-                if notification.retries == 0 and now - notification.processed_at < 0.25:
-                    logger.debug('retry 0.25 (skip): %s', now - notification.processed_at)
-                    continue
-                elif notification.retries == 1 and now - notification.processed_at < 1.5:
-                    logger.debug('retry 1.5 (skip): %s', now - notification.processed_at)
-                    continue
-                elif notification.retries > 1:
-                    logger.debug('retry > 1 (abort)')
-                    del self._failed_notifications[notification.notification_id]
-                    _delete_notification(self.qvarn, notification)
-                    continue
-                logger.debug("retrying failed notification, resource: %s id: %s, retry: %s "
-                             "delay: %s", notification.resource_type, notification.resource_id,
-                             notification.retries, now - notification.processed_at)
+        # Due retries are taken from the retry scheduler, notifications waiting for a retry are
+        # skipped.
+        retries = self.retry_scheduler.pop_due(time.time())
+        retried = set()
+        for notification in retries:
+            logger.debug("retrying failed notification, resource: %s id: %s, retry: %s",
+                         notification.resource_type, notification.resource_id,
+                         notification.retries)
+            retried.add(notification.notification_id)
+            yield notification
 
+        for notification in changes:
+            if notification.notification_id in retried:
+                continue
+            if notification.notification_id in self.retry_scheduler:
+                logger.debug("skip notification waiting for a retry: %s",
+                             notification.notification_id)
+                continue
             yield notification
 
+    def _map_notification(self, notification, resources, resync):
+        """Process map handlers of a single notification.
+
+        Returns
+        -------
+        Tuple[bool, Optional[QvarnResultDict], list]
+            Tuple of flag telling if notification should be passed to reduce handlers, mapped
+            resource with ``_mr_key`` field or None if mapped resource was not found and a list of
+            reduce changes for mapped resources written by map handlers.
+
+        """
+        handlers = self.mappers[notification.resource_type]
+        # Mapped resources written by the engine are passed to reduce handlers directly, without
+        # waiting for Qvarn notifications. Except resync, where reduce handlers skip keys, that
+        # already have the latest handler version, or reduce is deferred, see ``defer_reduce``.
+        written = None if resync and not self.deferred_reduce_sources else []
+        if handlers:
+            resource = resources.get((notification.resource_type, notification.resource_id))
+            if isinstance(resource, Exception):
+                raise resource
+            _process_map(
+                self.qvarn, notification.resource_type, notification.resource_change,
+                notification.resource_id, handlers, resync, resource, self.soft_delete_targets,
+                written,
+            )
+        reduced = self.deferred_reduce_sources if resync else self.reduce_handler_sources
+        written = [
+            (key, generated) for key, generated in written or ()
+            if generated.resource_type in reduced
+        ]
+
+        should_reduce = (
+            notification.resource_type in self.reduce_handler_sources and
+
+            # We ignore all delete notifications, since we don't delete mapped resources, we mark
+            # then as deleted first (and that generates UPDATED notification) and only then mapped
+            # resources are deleted (cleaned) completely. And once they are deleted for real, we are
+            # no longer interested in them.
+            notification.resource_change != DELETED
+        )
+        if should_reduce:
+            return True, self.qvarn.search_one(notification.resource_type,
+                                               id=notification.resource_id,
+                                               show=('_mr_key',), default=None), written
+        else:
+            return False, None, written
+
+    def _map_notifications(self, notifications, resources, resync):
+        """Process map handlers of coalesced notifications of a single resource.
+
+        This can be called from a worker thread, so all the bookkeeping is left to the caller.
+
+        Returns
+        -------
+        Tuple[Optional[Notification], tuple, Optional[Exception]]
+            Effective notification or None if changes cancel out, ``_map_notification`` result and
+            an error if there was one.
+
+        """
+        notification = _coalesce_notifications(notifications)
+        if notification is None:
+            return None, (False, None, []), None
+        try:
+            return notification, self._map_notification(notification, resources, resync), None
+        except Exception as e:
+            return notification, (False, None, []), e
+
+    def _map_prefetch_notifications(self, batch):
+        """Return effective notifications of a batch, whose resources are needed by map handlers.
+
+        Only resource types without map handlers are affected by echo handling in
+        ``_process_map_batch``, so the result does not depend on the engine state.
+        """
+        groups = OrderedDict()
+        for notification in batch:
+            if self.mappers[notification.resource_type]:
+                key = (notification.resource_type, notification.resource_id)
+                groups.setdefault(key, []).append(notification)
+        return [
+            notification for notification in map(_coalesce_notifications, groups.values())
+            if notification is not None
+        ]
+
     def _process_map_handlers(self, changes, resync=False):
-        changes_processed = 0
-        errors = 0
-        reduce_changes = []
-        progress = 0
+        state = _MapProgress()
 
         # Run through all changes, process map handlers immediately and collect changes that have
         # reduce handlers for processing in groups in the next step.
-        for notification in changes:
-            try:
-                handlers = self.mappers[notification.resource_type]
-                if handlers:
-                    _process_map(
-                        self.qvarn, notification.resource_type, notification.resource_change,
-                        notification.resource_id, handlers, resync,
-                    )
-
-            except Exception:
+        for batch in chunks(self.batch_size, changes):
+            # Fetch all source resources of the batch at once, instead of fetching them one by one.
+            resources = _prefetch_map_resources(self.qvarn, self._map_prefetch_notifications(batch))
+            self._process_map_batch(batch, resources, resync, state)
+
+        return state.changes_processed, state.errors, state.reduce_changes
+
+    def _process_map_batch(self, batch, resources, resync, state):
+        """Process map handlers of a batch of notifications.
+
+        ``resources`` are prefetched source resources, see ``_map_prefetch_notifications``.
+        Counters and collected reduce changes are accumulated in ``state``.
+        """
+        # Notifications of mapped resources written by the engine itself are already passed
+        # to reduce handlers, so they are just acknowledged.
+        notifications = []
+        for notification in batch:
+            echo, reduced, failed, key = (False, False, False, None)
+            if not self.mappers[notification.resource_type]:
+                echo, reduced, failed, key = self._consume_echo(notification)
+            if not echo:
+                notifications.append(notification)
+                continue
+            elif reduced:
+                self._report_success([notification])
+                state.changes_processed += 1
+            elif failed:
+                # Reduce of the written resource already failed once, so this notification is
+                # retried later, the same way as any other failed notification.
+                self._report_error([notification])
+            else:
+                # Written resource is not yet reduced, so this notification can be reduced
+                # together with the generated one.
+                self._unreduced_echoes.add(notification.notification_id)
+                state.reduce_changes.append(((notification.resource_type, key), notification))
+            self._run_callbacks('map_handler_processed')
+        batch = notifications
+
+        # Notifications of the same resource are coalesced into a single effective change, so
+        # that a resource changed many times in a row is processed only once. Notifications of
+        # different resources are processed concurrently.
+        groups = OrderedDict()
+        for notification in batch:
+            key = (notification.resource_type, notification.resource_id)
+            groups.setdefault(key, []).append(notification)
+        groups = list(groups.values())
+
+        futs = [self._submit(self._map_notifications, group, resources, resync)
+                for group in groups]
+
+        for group, fut in zip(groups, futs):
+            notification, (should_reduce, resource, written), error = fut.result()
+            if len(group) > 1:
+                logger.debug("coalesced %d notifications of %r into %r", len(group), (
+                    group[0].resource_type, group[0].resource_id,
+                ), notification and notification.resource_change)
+
+            if error is not None and self._qvarn_down(error):
+                raise error
+
+            elif error is not None:
                 # XXX: probably errors should be handler inside _process_map and another
-                #      exception could be rerised with information about which handler failed.
-                logger.exception("error while processing map handlers for %r", (
+                #      exception could be rerised with information about which handler
+                #      failed.
+                logger.error("error while processing map handlers for %r", (
                     notification.resource_type, notification.resource_change,
                     notification.resource_id,
-                ))
-                self._report_error([notification])
-                errors += 1
+                ), exc_info=(type(error), error, error.__traceback__))
+                self._report_error(group, error)
+                state.errors += len(group)
                 if self.raise_errors:
-                    raise
-
-            else:
-                should_reduce = (
-                    notification.resource_type in self.reduce_handler_sources and
-
-                    # We ignore all delete notifications, since we don't delete mapped resources, we
-                    # mark then as deleted first (and that generates UPDATED notification) and only
-                    # then mapped resources are deleted (cleaned) completely. And once they are
-                    # deleted for real, we are no longer interested in them.
-                    notification.resource_change != DELETED
+                    raise error
+
+            elif should_reduce and resource is None:
+                logger.warning(
+                    "can't find resource (%s, %s) specified in notificaton, the resource "
+                    "could be deleted or not yet replicated", notification.resource_type,
+                    notification.resource_id)
+                self._report_error(group)
+                state.errors += len(group)
+
+            elif should_reduce:
+                # Collect all changes that have reduce handlers and process them later,
+                # grouped by key. This will lower number of reduce handler calls.
+                key = (notification.resource_type, resource['_mr_key'])
+                state.reduce_changes.append((key, notification))
+                # Superseded notifications are acknowledged together with the effective one.
+                state.reduce_changes.extend(
+                    (key, superseded._replace(resource_change=notification.resource_change))
+                    for superseded in group[:-1]
                 )
-                if should_reduce:
-                    resource = self.qvarn.search_one(notification.resource_type,
-                                                     id=notification.resource_id,
-                                                     show=('_mr_key',), default=None)
-                    if resource is None:
-                        logger.warning(
-                            "can't find resource (%s, %s) specified in notificaton, the resource "
-                            "could be deleted or not yet replicated", notification.resource_type,
-                            notification.resource_id)
-                        self._report_error([notification])
-                        errors += 1
-                    else:
-                        # Collect all changes that have reduce handlers and process them later,
-                        # grouped by key. This will lower number of reduce handler calls.
-                        reduce_changes.append(((notification.resource_type, resource['_mr_key']),
-                                               notification))
-                else:
-                    self._report_success([notification])
-                    changes_processed += 1
-
-            self._run_callbacks('map_handler_processed')
 
-            progress += 1
-            if progress % 100 == 0:
-                logger.info('processed %d notifications', progress)
-
-        return changes_processed, errors, reduce_changes
+            else:
+                self._report_success(group)
+                state.changes_processed += len(group)
+
+            if error is None and resync:
+                self._deferred_writes.extend(written)
+            elif error is None:
+                for key, generated in written:
+                    state.reduce_changes.append((key, generated))
+                    self._expect_echo(key[1], generated)
+
+            for _ in group:
+                self._run_callbacks('map_handler_processed')
+
+            state.progress += len(group)
+            if state.progress % 100 < len(group):
+                logger.info('processed %d notifications', state.progress)
+
+        self._flush()
+
+    def _iter_completed(self, func, items):
+        """Call ``func(*item)`` for each item in the worker pool and yield items as they complete.
+
+        At most two tasks per worker are pending at once, so that a large number of items does not
+        flood the pool.
+
+        Yields
+        ------
+        Tuple[tuple, concurrent.futures.Future]
+            Item and resolved future.
+
+        """
+        pending = {}
+        for item in items:
+            pending[self._submit(func, *item)] = item
+            if len(pending) >= self.workers * 2:
+                done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for fut in done:
+                    yield pending.pop(fut), fut
+        for fut in futures.as_completed(list(pending)):
+            yield pending.pop(fut), fut
+
+    def _reduce_group(self, source_resource_type, key, notifications, resync):
+        """Process reduce handlers of a single key.
+
+        This can be called from a worker thread, so all the bookkeeping is left to the caller.
+        """
+        if not all(notification.generated or
+                   notification.notification_id in self._unreduced_echoes
+                   for notification in notifications):
+            # Notification of a mapped resource, that was not written by this engine, for example
+            # before a restart, or its echo was forgotten. It might be already reduced, so
+            # merging it again would count it twice, and the key is fully recomputed instead.
+            notifications = ()
+        incremental = _process_reduce(self.qvarn, self.config, source_resource_type, key,
+                                      self.reducers[source_resource_type], resync=resync,
+                                      notifications=notifications)
+
+        # Delete processed mapped resources if they where marked for deletion.
+        resource_ids = self.qvarn.iter_search(source_resource_type, _mr_key=key, _mr_deleted=True)
+        if incremental:
+            # Values of other resources marked for deletion are not yet retracted, they will be
+            # deleted, when their notifications are processed.
+            changed = {notification.resource_id for notification in notifications}
+            resource_ids = (resource_id for resource_id in resource_ids if resource_id in changed)
+        for _ in self.qvarn.iter_delete_multiple(source_resource_type, resource_ids):
+            pass
 
     def process_reduce_handlers(self, changes, *, errors=0, resync=False):
         changes_processed = 0
@@ -376,48 +1099,59 @@ class MapReduceEngine:
 
         # Process all changes with reduce handlers in groups.
         changes = sorted(changes, key=itemgetter(0))
-        grouped = [(key, list(group)) for key, group in groupby(changes, key=itemgetter(0))]
+        grouped = OrderedDict(
+            (key, list(group)) for key, group in groupby(changes, key=itemgetter(0))
+        )
         if grouped:
             logger.info("grouped %d changes into %d groups", len(changes), len(grouped))
-        for (source_resource_type, key), group in grouped:
+
+        # Groups are processed concurrently. Each key has exactly one group, so the same key is
+        # never reduced concurrently.
+        tasks = (
+            (source_resource_type, key, [notification for _, notification in group], resync)
+            for (source_resource_type, key), group in grouped.items()
+        )
+        for (source_resource_type, key, notifications, resync), fut in self._iter_completed(
+                self._reduce_group, tasks):
             try:
-                _process_reduce(self.qvarn, self.config, source_resource_type, key,
-                                self.reducers[source_resource_type], resync=resync)
+                fut.result()
 
             except HandlerVersionError as e:
                 # If we end up here, it means, that this key has inconsistent versions in mapped
                 # resources. In that case we postpone notification by leaving undeleted.
                 logger.debug("incompatible mapped resource versions for key=%r of %r resource.",
                              e.key, source_resource_type)
-                self._report_error([notification for _, notification in group])
+                self._report_error(notifications, e)
 
-            except Exception:
+            except Exception as e:
+                if self._qvarn_down(e):
+                    raise
                 # XXX: probably errors should be handler inside _process_reduce and another
                 #      exception could be rerised with information about which handler failed.
                 logger.exception("error while processing reduce handlers for %r, key=%r",
                                  source_resource_type, key)
-                notifications = [notification for _, notification in group]
-                self._report_error(notifications)
+                self._report_error(notifications, e)
                 errors += len(notifications)
                 if self.raise_errors:
                     raise
 
             else:
-                # Delete processed mapped resources if they where marked for deletion.
-                for resource_id in self.qvarn.search(source_resource_type, _mr_key=key,
-                                                     _mr_deleted=True):
-                    self.qvarn.delete(source_resource_type, resource_id)
-
-                notifications = [notification for _, notification in group]
                 self._report_success(notifications)
                 changes_processed += len(notifications)
 
+            self._unreduced_echoes.difference_update(
+                notification.notification_id for notification in notifications
+            )
+
             progress += 1
             if progress % 100 == 0:
                 logger.info('processed %d/%d reduce handlers', progress, len(grouped))
+                self._flush()
 
             self._run_callbacks('reduce_handler_processed')
 
+        self._flush()
+
         return changes_processed, errors
 
     def add_callback(self, event, callback):
@@ -427,45 +1161,105 @@ class MapReduceEngine:
         logger.info('processing changes resync=%r', resync)
         start = time.time()
         changes = self._iter_changes(changes)
-        mapped, errors, reduce_changes = self._process_map_handlers(changes, resync)
-        reduced, errors = self.process_reduce_handlers(reduce_changes, errors=errors, resync=resync)
+        # The same documents and searches are requested by many handlers and notifications, so
+        # responses are cached for the whole cycle. Cache is invalidated by engine's own writes.
+        with self.qvarn.cache_scope(self.cache_size):
+            try:
+                mapped, errors, reduce_changes = self._process_map_handlers(changes, resync)
+                reduced, errors = self.process_reduce_handlers(reduce_changes, errors=errors,
+                                                               resync=resync)
+            finally:
+                # Make sure, that all processed notifications are deleted, even if processing was
+                # interrupted by an error.
+                self._flush()
         logger.info('done processing changes resync=%r mapped=%d reduced=%d errors=%d '
-                    'time=%.2fs', resync, mapped, reduced, errors, time.time() - start)
+                    'time=%.2fs concurrency=%d', resync, mapped, reduced, errors,
+                    time.time() - start, self.qvarn.concurrency_limit)
         return mapped + reduced
 
 
-def get_changes(qvarn, listeners):
+def _get_listener_notifications_path(resource_type, listener_id):
+    return resource_type + '/listeners/' + listener_id + '/notifications'
+
+
+def get_changes(qvarn, listeners, batch_size=100, skip=()):
+    """Get pending notifications of all listeners.
+
+    Notifications with ids in ``skip`` are not fetched, this is used to skip notifications waiting
+    for a retry (``skip=engine.retry_scheduler``).
+    """
     l = list(listeners)  # create a new copy of listeners
-    for resource_type, listener, state in l:
-        path = resource_type + '/listeners/' + listener['id'] + '/notifications'
-        notifications = qvarn.get_list(path)
+
+    # Poll all listeners at once.
+    paths = [_get_listener_notifications_path(resource_type, listener['id'])
+             for resource_type, listener, state in l]
+    notification_ids = qvarn.get_list_multiple(paths)
+
+    for (resource_type, listener, state), path, notifications in zip(l, paths, notification_ids):
         if notifications:
             logger.info("there are %d pending notifications for source=%s",
                         len(notifications), resource_type)
-        for notification_id in notifications:
-            try:
-                notification = qvarn.get(path, notification_id)
-            except QvarnResourceNotFound:
-                logger.warning("master:   notification has been deleted (probably after giving up "
-                               "retries): notification=%s resource_type=%s", notification_id,
-                               resource_type)
-                # continue loop withouth yielding
-                continue
+        notifications = [x for x in notifications if x not in skip]
+        for batch in chunks(batch_size, notifications):
+            for notification_id, notification in zip(batch, qvarn.get_multiple(
+                    path, batch, return_exceptions=True)):
+                if isinstance(notification, QvarnResourceNotFound):
+                    logger.warning("master:   notification has been deleted (probably after giving "
+                                   "up retries): notification=%s resource_type=%s",
+                                   notification_id, resource_type)
+                    # continue loop withouth yielding
+                    continue
+                elif isinstance(notification, Exception):
+                    raise notification
+                yield Notification(
+                    resource_type=resource_type,
+                    resource_change=notification['resource_change'],
+                    resource_id=notification['resource_id'],
+                    notification_id=notification['id'],
+                    listener_id=listener['id'],
+                    generated=False,
+                )
+
+
+def get_dead_letter_changes(qvarn, batch_size=100):
+    """Get notifications stored in qvarnmr_dead_letters for replay.
+
+    Returned notifications can be passed to ``MapReduceEngine.process_changes``, dead letters are
+    deleted once processed successfully and stored again if processing fails again.
+    """
+    for batch in chunks(batch_size, qvarn.iter_list(DEAD_LETTERS)):
+        for dead_letter in qvarn.get_multiple(DEAD_LETTERS, batch):
             yield Notification(
-                resource_type=resource_type,
-                resource_change=notification['resource_change'],
-                resource_id=notification['resource_id'],
-                notification_id=notification['id'],
-                listener_id=listener['id'],
+                resource_type=dead_letter['resource_type'],
+                resource_change=dead_letter['resource_change'],
+                resource_id=dead_letter['resource_id'],
+                notification_id=dead_letter['id'],
+                listener_id=None,
                 generated=False,
             )
 
 
-def _delete_notification(qvarn, notification):
-    if not notification.generated:
-        logger.debug("delete notification for resource type=%s change=%s resource=%s",
-                     notification.resource_type, notification.resource_change,
-                     notification.resource_id)
-
-        path = notification.resource_type + '/listeners/' + notification.listener_id + '/notifications'
-        qvarn.delete(path, notification.notification_id)
+def _delete_notifications(qvarn, notifications):
+    """Delete multiple notifications in parallel."""
+    paths = OrderedDict()
+    for notification in notifications:
+        if not notification.generated:
+            logger.debug("delete notification for resource type=%s change=%s resource=%s",
+                         notification.resource_type, notification.resource_change,
+                         notification.resource_id)
+            if notification.listener_id is None:
+                # Replayed dead letter.
+                path = DEAD_LETTERS
+            else:
+                path = _get_listener_notifications_path(notification.resource_type,
+                                                        notification.listener_id)
+            paths.setdefault(path, []).append(notification.notification_id)
+
+    for path, notification_ids in paths.items():
+        results = qvarn.iter_delete_multiple(path, notification_ids, return_exceptions=True)
+        for notification_id, result in zip(notification_ids, results):
+            if isinstance(result, QvarnResourceNotFound):
+                logger.warning("notification is already deleted: notification=%s path=%s",
+                               notification_id, path)
+            elif isinstance(result, Exception):
+                raise result
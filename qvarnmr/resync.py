@@ -1,19 +1,34 @@
 import time
 import logging
+from concurrent import futures
+from itertools import islice
 
 from qvarnmr.clients.qvarn import QvarnApi
 from qvarnmr.processor import UPDATED, Notification, MapReduceEngine
-from qvarnmr.utils import chunks
+from qvarnmr.utils import KeySet, chunks
 
 logger = logging.getLogger(__name__)
 
+# Number of resources or keys processed between two resync checkpoints.
+RESYNC_CHUNK_SIZE = 100
+
 
 def _no_action():
     pass
 
 
-def iter_map_resync_changes(qvarn: QvarnApi, source_resource_type: str):
-    for resource_id in qvarn.get_list(source_resource_type):
+def iter_map_resync_changes(qvarn: QvarnApi, source_resource_type: str, after: str=None,
+                            start: str=None, end: str=None):
+    """Yield resync changes of source resources sorted by id.
+
+    Only resources with ids after ``after`` and in ``[start, end)`` range are included, if given.
+    """
+    query = {}
+    if start is not None:
+        query['id__ge'] = start
+    if end is not None:
+        query['id__lt'] = end
+    for resource_id in qvarn.iter_search(source_resource_type, after=after, **query):
         yield Notification(
             resource_type=source_resource_type,
             resource_change=UPDATED,
@@ -24,19 +39,29 @@ def iter_map_resync_changes(qvarn: QvarnApi, source_resource_type: str):
         )
 
 
-def iter_reduce_resync_keys(qvarn: QvarnApi, source_resource_type: str, batch_size=1000):
-    reduced_keys = set()
-    # qvarn.search(source_resource_type, show=('_mr_key',)) should in theory be
-    # faster (it asks for less data), but unfortunately Qvarn takes so long
-    # to process it for larger tables (on the order of 20 thousand rows) that
-    # HAProxy times out and we get a failure, making it impossible to resync
-    # QvarnMR data altogether.
-    resource_ids = qvarn.get_list(source_resource_type)
-    for batch in range(0, len(resource_ids), batch_size):
-        for resource in qvarn.get_multiple(source_resource_type,
-                                           resource_ids[batch:batch+batch_size]):
+def iter_reduce_resync_keys(qvarn: QvarnApi, source_resource_type: str, batch_size=1000,
+                            after: str=None):
+    for _, change in _iter_reduce_resync_keys(qvarn, source_resource_type, batch_size, after):
+        yield change
+
+
+def _iter_reduce_resync_keys(qvarn, source_resource_type, batch_size=1000, after=None):
+    """Yield reduce resync changes together with id of the mapped resource, where key was found.
+
+    Mapped resources are iterated in id order, so the id can be used as a resync checkpoint.
+    """
+    # Mapped resource tables can have tens of millions of rows, so already seen keys are tracked
+    # in a set, that is moved to disk when it gets large.
+    reduced_keys = KeySet()
+    # Unpaginated qvarn.search(source_resource_type, show=('_mr_key',)) takes so long for larger
+    # tables (on the order of 20 thousand rows) that HAProxy times out, so keys are searched page
+    # by page, batch_size resources at once.
+    resources = qvarn.iter_search(source_resource_type, show=('_mr_key',), page_size=batch_size,
+                                  after=after)
+    try:
+        for resource in resources:
             key = resource['_mr_key']
-            if key not in reduced_keys:
+            if reduced_keys.add(key):
                 notification = Notification(
                     resource_type=source_resource_type,
                     resource_change=UPDATED,
@@ -45,84 +70,476 @@ def iter_reduce_resync_keys(qvarn: QvarnApi, source_resource_type: str, batch_si
                     listener_id=None,
                     generated=True,
                 )
-                yield (source_resource_type, key), notification
-                reduced_keys.add(key)
+                yield resource['id'], ((source_resource_type, key), notification)
+    finally:
+        reduced_keys.close()
 
 
-def update_handler_version(qvarn, instance, target_resource_type, source_resource_type, version):
-    state = qvarn.search_one(
+class VersionIndex:
+    """Local index of resources, whose target resources already have a handler version.
+
+    An id or a key is current if exactly one target resource was found for it and that resource
+    has the given version, the same way as resync skips resources in ``_process_map`` and
+    ``_process_reduce``. Ids are kept in ``KeySet``s, so memory use stays flat for large targets.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self._seen = KeySet()
+        self._current = KeySet()
+        self._multiple = KeySet()
+
+    def add(self, id, version):
+        if not self._seen.add(id):
+            self._multiple.add(id)
+        if version == self.version:
+            self._current.add(id)
+
+    def __contains__(self, id):
+        return id in self._current and id not in self._multiple
+
+    def close(self):
+        self._seen.close()
+        self._current.close()
+        self._multiple.close()
+
+
+def load_map_version_index(qvarn: QvarnApi, target_resource_type: str, source_resource_type: str,
+                           version, start: str=None, end: str=None, batch_size=1000):
+    """Return ``VersionIndex`` of source resource ids in ``[start, end)`` range.
+
+    Target resources are scanned page by page, instead of searching them for each source resource.
+    """
+    index = VersionIndex(version)
+    query = {'_mr_source_type': source_resource_type}
+    if start is not None:
+        query['_mr_source_id__ge'] = start
+    if end is not None:
+        query['_mr_source_id__lt'] = end
+    resources = qvarn.iter_search(target_resource_type, show=('_mr_source_id', '_mr_version'),
+                                  page_size=batch_size, **query)
+    for resource in resources:
+        index.add(resource['_mr_source_id'], resource['_mr_version'])
+    return index
+
+
+def load_reduce_version_index(qvarn: QvarnApi, target_resource_type: str, version,
+                              batch_size=1000):
+    """Return ``VersionIndex`` of reduced keys, see ``load_map_version_index``."""
+    index = VersionIndex(version)
+    resources = qvarn.iter_search(target_resource_type, show=('_mr_key', '_mr_version'),
+                                  page_size=batch_size)
+    for resource in resources:
+        index.add(resource['_mr_key'], resource['_mr_version'])
+    return index
+
+
+def get_handler_state(qvarn, target_resource_type, source_resource_type):
+    return qvarn.search_one(
         'qvarnmr_handlers',
         target=target_resource_type,
         source=source_resource_type,
         default=None,
     )
 
+
+def _save_handler_state(qvarn, state, instance, target_resource_type, source_resource_type,
+                        **fields):
+    payload = {
+        'instance': instance,
+        'target': target_resource_type,
+        'source': source_resource_type,
+        # Handler is not considered synced until full resync is done.
+        'version': state['version'] if state else None,
+    }
+    if state is not None and 'resync_version' in state:
+        # Checkpoint fields are written only if qvarnmr_handlers resource type has them, so that
+        # deployments without resync checkpoints do not need to update the resource type.
+        payload['resync_version'] = None
+        payload['resync_shards'] = []
+    payload.update(fields)
+
     if state is None:
-        qvarn.create('qvarnmr_handlers', {
-            'instance': instance,
-            'target': target_resource_type,
-            'source': source_resource_type,
-            'version': version,
-        })
+        qvarn.create('qvarnmr_handlers', payload)
     else:
-        qvarn.update('qvarnmr_handlers', state['id'], {
-            'revision': state['revision'],
-            'instance': instance,
-            'target': target_resource_type,
-            'source': source_resource_type,
-            'version': version,
-        })
+        payload['revision'] = state['revision']
+        qvarn.update('qvarnmr_handlers', state['id'], payload)
+
+
+def update_handler_version(qvarn, instance, target_resource_type, source_resource_type, version):
+    """Mark handler as synced with ``version`` and clear resync checkpoint."""
+    state = get_handler_state(qvarn, target_resource_type, source_resource_type)
+    _save_handler_state(qvarn, state, instance, target_resource_type, source_resource_type,
+                        version=version)
+
+
+def save_resync_checkpoint(qvarn, instance, target_resource_type, source_resource_type, version,
+                           shards):
+    """Remember progress of resync of handler ``version``, ``shards`` is a list of ResyncShard.
+
+    Resync of a new handler, that has no state yet, is not checkpointed, because a state without a
+    synced version would make the handler look changed to everything else reading the state.
+    """
+    state = get_handler_state(qvarn, target_resource_type, source_resource_type)
+    if state is None:
+        return
+    _save_handler_state(qvarn, state, instance, target_resource_type, source_resource_type,
+                        resync_version=version,
+                        resync_shards=[shard.to_state() for shard in shards])
+
+
+def get_resync_shards(qvarn, target_resource_type, source_resource_type, version):
+    """Return shards of an interrupted resync of handler ``version`` or None."""
+    state = get_handler_state(qvarn, target_resource_type, source_resource_type)
+    if state is None or state.get('resync_version') != version or not state.get('resync_shards'):
+        return None
+    return [ResyncShard.from_state(shard) for shard in state['resync_shards']]
+
+
+def get_id_prefix(qvarn, resource_type):
+    """Return resource type prefix of ids of ``resource_type``, for example ``'81c0-'``.
+
+    Qvarn ids look like ``81c0-<32 random hex digits>-<checksum>``, where the first four hex digits
+    are derived from resource type, so all ids of a resource type have the same prefix. The prefix
+    is taken from an existing id, an empty string is returned if there are no resources.
+    """
+    for resource_id in qvarn.iter_search(resource_type, page_size=1):
+        prefix, sep, _ = resource_id.partition('-')
+        return prefix + sep
+    return ''
+
+
+def split_id_range(shards, prefix=''):
+    """Split resource id space into ``shards`` consecutive ``(start, end)`` ranges.
+
+    The space is split by four hex digits following ``prefix``, see ``get_id_prefix``. These digits
+    are random in Qvarn ids, which gives shards of roughly equal size. None means, that range is
+    not bounded on that side, so all ids are covered, whatever their format is.
+    """
+    bounds = ['%s%04x' % (prefix, i * 0x10000 // shards) for i in range(1, shards)]
+    bounds = [None] + bounds + [None]
+    return list(zip(bounds, bounds[1:]))
+
+
+class ResyncShard:
+    """Resync progress of a range of source resource ids.
+
+    ``cursor`` is id of the last resynced resource, shard is ``done`` when all resources in the
+    range are resynced. A shard is ``failed`` if resync of it was aborted by an error, then it is
+    resumed from the last checkpoint on next worker start.
+    """
+
+    def __init__(self, start=None, end=None, cursor=None, done=False):
+        self.start = start
+        self.end = end
+        self.cursor = cursor
+        self.done = done
+        self.failed = False
+        self._changes = None
+        self._index = None
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['start'] or None, state['end'] or None, state['cursor'] or None,
+                   state['done'])
+
+    def to_state(self):
+        return {
+            'start': self.start or '',
+            'end': self.end or '',
+            'cursor': self.cursor or '',
+            'done': self.done,
+        }
+
+    def __repr__(self):
+        return '[%s, %s)' % (self.start or '', self.end or '')
+
+
+class _HandlerResync:
+    """Full resync of a single handler, split into shards, which can be processed in parallel."""
+
+    def __init__(self, qvarn, handler_type, target_resource_type, source_resource_type, handler,
+                 shards):
+        self.qvarn = qvarn
+        self.handler_type = handler_type
+        self.target = target_resource_type
+        self.source = source_resource_type
+        self.handler = handler
+        self.shards = shards
+        self.start = time.time()
+
+    @property
+    def finished(self):
+        return all(shard.done or shard.failed for shard in self.shards)
+
+    def step(self, shard, engine):
+        """Resync next chunk of a shard, return True if the whole shard is done.
+
+        This is called from resync worker threads, but never concurrently for the same shard.
+        """
+        if shard._changes is None:
+            # Resources and keys, that are already resynced, for example by an interrupted
+            # resync, are skipped using a local index, without any Qvarn requests for each of
+            # them.
+            start = time.time()
+            if self.handler_type == 'map':
+                shard._index = load_map_version_index(self.qvarn, self.target, self.source,
+                                                      self.handler['version'], shard.start,
+                                                      shard.end)
+                shard._changes = (
+                    (change.resource_id, change) for change in iter_map_resync_changes(
+                        self.qvarn, self.source, after=shard.cursor, start=shard.start,
+                        end=shard.end,
+                    )
+                    if change.resource_id not in shard._index
+                )
+            else:
+                shard._index = load_reduce_version_index(self.qvarn, self.target,
+                                                         self.handler['version'])
+                shard._changes = (
+                    (resource_id, change) for resource_id, change in _iter_reduce_resync_keys(
+                        self.qvarn, self.source, after=shard.cursor,
+                    )
+                    if change[0][1] not in shard._index
+                )
+            logger.info("loaded version index source=%s target=%s shard=%r time=%.2fs",
+                        self.source, self.target, shard, time.time() - start)
+        chunk = list(islice(shard._changes, RESYNC_CHUNK_SIZE))
+        if chunk and self.handler_type == 'map':
+            engine.process_changes([change for _, change in chunk], resync=True)
+        elif chunk:
+            engine.process_reduce_handlers([change for _, change in chunk], resync=True)
+        if chunk:
+            shard.cursor = chunk[-1][0]
+        if len(chunk) < RESYNC_CHUNK_SIZE:
+            shard._index.close()
+            return True
+        return False
+
+
+def _iter_resync_tasks(resyncs, limit):
+    """Return up to ``limit`` ``(resync, shard)`` pairs to be processed next.
+
+    Handlers using a resource type, as a source or as a target, used by an earlier unfinished
+    handler wait for it, so that only independent handlers are resynced in parallel.
+    """
+    tasks = []
+    busy = set()
+    for resync in resyncs:
+        if resync.finished:
+            continue
+        if resync.source in busy or resync.target in busy:
+            continue
+        busy.update((resync.source, resync.target))
+        for shard in resync.shards:
+            if len(tasks) < limit and not (shard.done or shard.failed):
+                tasks.append((resync, shard))
+    return tasks
+
+
+def _run_resyncs(qvarn, engine, instance, resyncs, workers=1, checkpoints=False):
+    """Process handler resyncs, one chunk of up to ``workers`` shards at a time.
+
+    Shards are processed in a thread pool by copies of ``engine``, or by ``engine`` itself in the
+    calling thread if ``workers`` is 1. Progress is saved after each round if ``checkpoints`` is
+    true, then this generator yields, so that the caller can process new changes in between.
+    """
+    pool = futures.ThreadPoolExecutor(workers) if workers > 1 else None
+    engines = {}
+    try:
+        while True:
+            tasks = _iter_resync_tasks(resyncs, workers)
+            if not tasks:
+                break
+
+            if pool is None:
+                results = [_run_resync_task(engine, resync, shard) for resync, shard in tasks]
+            else:
+                futs = []
+                for resync, shard in tasks:
+                    if id(shard) not in engines:
+                        engines[id(shard)] = engine.copy()
+                    futs.append(pool.submit(_run_resync_task, engines[id(shard)], resync, shard))
+                results = [fut.result() for fut in futs]
+
+            for (resync, shard), (done, error) in zip(tasks, results):
+                if error is not None and engine._qvarn_down(error):
+                    raise error
+                elif error is not None:
+                    # Failed shard is left for the next worker start, other shards continue.
+                    logger.error("resync shard failed source=%s target=%s shard=%r cursor=%s",
+                                 resync.source, resync.target, shard, shard.cursor,
+                                 exc_info=(type(error), error, error.__traceback__))
+                    shard.failed = True
+                else:
+                    shard.done = done
+                    logger.info("resync progress source=%s target=%s shard=%r cursor=%s "
+                                "done=%r", resync.source, resync.target, shard, shard.cursor,
+                                done)
+
+            # Keys of mapped resources written by resync are collected before their notifications
+            # are processed by the caller, see ``MapReduceEngine.defer_reduce``.
+            if pool is None:
+                engine.collect_deferred_reduce(engine)
+            else:
+                for resync, shard in tasks:
+                    engine.collect_deferred_reduce(engines[id(shard)])
+
+            for resync in {resync for resync, _ in tasks}:
+                _save_resync_progress(qvarn, instance, resync, checkpoints)
+
+            if pool is not None:
+                # Engine copies do not run callbacks, so they are run here in the calling thread.
+                engine._run_callbacks(tasks[0][0].handler_type + '_handler_processed')
+
+            yield
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def _run_resync_task(engine, resync, shard):
+    try:
+        return resync.step(shard, engine), None
+    except Exception as e:
+        return False, e
+
+
+def _save_resync_progress(qvarn, instance, resync, checkpoints):
+    version = resync.handler['version']
+    if all(shard.done for shard in resync.shards):
+        # Update handler version only when full resync is successfully done.
+        update_handler_version(qvarn, instance, resync.target, resync.source, version)
+        logger.info("done full %s resync source=%s target=%s handler=%r version=%s time=%.2fs",
+                    resync.handler_type, resync.source, resync.target, resync.handler['handler'],
+                    version, time.time() - resync.start)
+    else:
+        if checkpoints:
+            # Progress is saved after each chunk, so that an interrupted resync is resumed from
+            # the last checkpoint instead of starting over.
+            save_resync_checkpoint(qvarn, instance, resync.target, resync.source, version,
+                                   resync.shards)
+        if resync.finished:
+            logger.warning("full %s resync source=%s target=%s version=%s is incomplete, %d "
+                           "failed shards will be %s on next start", resync.handler_type,
+                           resync.source, resync.target, version,
+                           sum(shard.failed for shard in resync.shards),
+                           'resumed' if checkpoints else 'resynced again')
+
+
+def _plan_resyncs(qvarn, config, handler_type, shards, checkpoints=False):
+    resyncs = []
+    for target_resource_type, source_resource_type, handler in iter_changed_handlers(
+            qvarn, config, handler_type):
+        logger.info("full %s resync source=%s target=%s handler=%r version=%s", handler_type,
+                    source_resource_type, target_resource_type, handler['handler'],
+                    handler['version'])
+        resumed = None
+        if checkpoints:
+            resumed = get_resync_shards(qvarn, target_resource_type, source_resource_type,
+                                        handler['version'])
+        if resumed is not None:
+            logger.info("resuming %s resync source=%s target=%s from checkpoints %s",
+                        handler_type, source_resource_type, target_resource_type,
+                        ', '.join('%r after %s' % (x, x.cursor) for x in resumed))
+        elif handler_type == 'map':
+            prefix = get_id_prefix(qvarn, source_resource_type) if shards > 1 else ''
+            resumed = [ResyncShard(start, end) for start, end in split_id_range(shards, prefix)]
+        else:
+            # The same key can be found in any range of mapped resources, so reduce resync is
+            # not split into shards.
+            resumed = [ResyncShard()]
+        resyncs.append(_HandlerResync(qvarn, handler_type, target_resource_type,
+                                      source_resource_type, handler, resumed))
+    return resyncs
 
 
 def iter_changed_handlers(qvarn: QvarnApi, config: dict, handler_type: str):
     for target_resource_type, handlers in config.items():
         for source_resource_type, handler in handlers.items():
             if handler['type'] == handler_type:
-                state = qvarn.search_one(
-                    'qvarnmr_handlers',
-                    target=target_resource_type,
-                    source=source_resource_type,
-                    default=None,
-                )
+                state = get_handler_state(qvarn, target_resource_type, source_resource_type)
                 if state is None or state['version'] != handler['version']:
                     yield target_resource_type, source_resource_type, handler
 
 
-def resync_changed_handlers(qvarn: QvarnApi, engine: MapReduceEngine, instance: str):
-    # First resync all map handlers.
-    handlers = iter_changed_handlers(qvarn, engine.config, 'map')
-    for target_resource_type, source_resource_type, handler in handlers:
-        logger.info("full map resync source=%s target=%s handler=%r version=%s",
-                    source_resource_type, target_resource_type, handler['handler'],
-                    handler['version'])
-        start = time.time()
+def _deferred_reduce_sources(config, map_resyncs, reduce_handlers):
+    """Return mapped resource types, whose reduce can be deferred until map resync is done.
+
+    Map resync rewrites mapped resources and each written key would be reduced again and again,
+    once per chunk, and then once more by reduce resync, if reduce handlers changed too. Reduce of
+    a mapped resource type is deferred, if a map handler writing it is resynced together with all
+    reduce handlers reading it.
+    """
+    mapped = {resync.target for resync in map_resyncs}
+    changed = {(target, source) for target, source, handler in reduce_handlers}
+    deferred = set()
+    for source_resource_type in mapped:
+        reducers = {
+            (target_resource_type, source_resource_type)
+            for target_resource_type, handlers in config.items()
+            if handlers.get(source_resource_type, {}).get('type') == 'reduce'
+        }
+        if reducers and reducers <= changed:
+            deferred.add(source_resource_type)
+    return deferred
+
 
-        for changes in chunks(100, iter_map_resync_changes(qvarn, source_resource_type)):
-            engine.process_changes(changes, resync=True)
+def _reduce_deferred_keys(engine):
+    """Reduce keys collected while map resync was running, yield after each chunk."""
+    keys = engine.pop_deferred_reduce()
+    try:
+        logger.info("reducing %d keys deferred during map resync", len(keys))
+        changes = (
+            ((source_resource_type, key), Notification(
+                resource_type=source_resource_type,
+                resource_change=UPDATED,
+                resource_id=None,
+                notification_id=None,
+                listener_id=None,
+                generated=True,
+            ))
+            for source_resource_type, key in keys
+        )
+        for chunk in chunks(RESYNC_CHUNK_SIZE, changes):
+            engine.process_reduce_handlers(chunk)
             yield
-        # Update handler version only when full resync is successfully done.
-        update_handler_version(qvarn, instance, target_resource_type, source_resource_type,
-                               handler['version'])
-        logger.info("done full map resync source=%s target=%s handler=%r version=%s time=%.2fs",
-                    source_resource_type, target_resource_type, handler['handler'],
-                    handler['version'], time.time() - start)
+    finally:
+        keys.close()
+
+
+def resync_changed_handlers(qvarn: QvarnApi, engine: MapReduceEngine, instance: str, shards=1,
+                            workers=1, checkpoints=False):
+    """Resync all handlers with changed versions, yield after each chunk of processed resources.
+
+    Source resource ids of each map handler are split into ``shards`` ranges. Up to ``workers``
+    shards of independent handlers are processed in parallel. If ``checkpoints`` is true, resync
+    progress is saved to ``qvarnmr_handlers`` and an interrupted resync is resumed from it, this
+    requires ``resync_version`` and ``resync_shards`` fields of the resource type.
+    """
+    map_resyncs = _plan_resyncs(qvarn, engine.config, 'map', shards, checkpoints)
+    deferred = _deferred_reduce_sources(
+        engine.config, map_resyncs, iter_changed_handlers(qvarn, engine.config, 'reduce'),
+    )
+
+    # First resync all map handlers. Keys of mapped resources written by map resync, that will be
+    # reduced by reduce resync anyway, are collected and reduced only once, after map resync is
+    # done. If worker stops before that, these keys are reduced by reduce resync on next start.
+    if deferred:
+        logger.info("reduce of %s is deferred until map resync is done",
+                    ', '.join(sorted(deferred)))
+        engine.defer_reduce(deferred)
+    try:
+        yield from _run_resyncs(qvarn, engine, instance, map_resyncs, workers, checkpoints)
+    except BaseException:
+        engine.pop_deferred_reduce().close()
+        raise
+    if deferred:
+        yield from _reduce_deferred_keys(engine)
 
     # Resync reduce handlers separately, because in order to resync reduce handlers, we don't need
-    # to resync map handlers. And by the way, `process_changes` automatically calls
-    # `process_reduce`, so here we might have some duplication if both, map and related reduce
-    # handlers where updated. That is something, that could be optimized.
-    handlers = iter_changed_handlers(qvarn, engine.config, 'reduce')
-    for target_resource_type, source_resource_type, handler in handlers:
-        logger.info("full reduce resync source=%s target=%s handler=%r version=%s",
-                    source_resource_type, target_resource_type, handler['handler'],
-                    handler['version'])
-        start = time.time()
-        for changes in chunks(100, iter_reduce_resync_keys(qvarn, source_resource_type)):
-            engine.process_reduce_handlers(changes, resync=True)
-            yield
-        # Update handler version only when full resync is successfully done.
-        update_handler_version(qvarn, instance, target_resource_type, source_resource_type,
-                               handler['version'])
-        logger.info("done full reduce resync source=%s target=%s handler=%r version=%s time=%.2fs",
-                    source_resource_type, target_resource_type, handler['handler'],
-                    handler['version'], time.time() - start)
+    # to resync map handlers. Keys reduced above already have the new reduce handler version, so
+    # they are skipped here.
+    yield from _run_resyncs(qvarn, engine, instance,
+                            _plan_resyncs(qvarn, engine.config, 'reduce', shards, checkpoints),
+                            workers, checkpoints)
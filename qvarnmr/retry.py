@@ -0,0 +1,115 @@
+import heapq
+import random
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RetryScheduler:
+    """Schedule retries of failed notifications.
+
+    Scheduled notifications are kept in a priority queue ordered by the time of the next attempt,
+    so due retries are found without looking at notifications that are still waiting.
+
+    The n-th retry (counting from 0) is due ``backoff * factor ** n`` seconds after the first
+    failure, with default values retries are done after 0.25 and 1.5 seconds.
+
+    Parameters
+    ----------
+    max_retries : int
+        Number of retries, after that, notification is given up.
+    backoff : float
+        Delay of the first retry in seconds.
+    factor : float
+        Multiplier of the delay for each subsequent retry.
+    jitter : float
+        Maximum random deviation of a delay, as a fraction of the delay, 0.1 means +/- 10%.
+    max_entries : int
+        Maximum number of scheduled notifications kept in memory.
+
+    """
+
+    def __init__(self, max_retries=2, backoff=0.25, factor=6, jitter=0.0, max_entries=10000):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.factor = factor
+        self.jitter = jitter
+        self.max_entries = max_entries
+
+        # Heap of (due, seq, key) entries and scheduled items by key.
+        self._queue = []
+        self._entries = {}
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def delay(self, retries):
+        """Return delay of a retry since the first failure."""
+        delay = self.backoff * self.factor ** retries
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return delay
+
+    def exhausted(self, retries):
+        """Check if no retries are left after given number of retries."""
+        return retries >= self.max_retries
+
+    def schedule(self, key, item, retries, failed_at):
+        """Schedule a retry.
+
+        Parameters
+        ----------
+        key : Hashable
+            Unique key of the scheduled item.
+        item : Any
+            Item returned by ``pop_due`` once the retry is due.
+        retries : int
+            Number of retries already done.
+        failed_at : float
+            Time of the first failure.
+
+        Returns
+        -------
+        bool
+            False if the scheduler is full and the retry was not scheduled.
+
+        """
+        if key not in self._entries and len(self._entries) >= self.max_entries:
+            logger.warning("too many failed notifications, retry of %r is not scheduled", key)
+            return False
+        due = failed_at + self.delay(retries)
+        self._entries[key] = (due, item)
+        heapq.heappush(self._queue, (due, next(self._seq), key))
+        return True
+
+    def cancel(self, key):
+        """Remove scheduled retry, if there is one."""
+        self._entries.pop(key, None)
+
+    def next_due(self):
+        """Return time of the next due retry or None if nothing is scheduled."""
+        self._discard_stale()
+        return self._queue[0][0] if self._queue else None
+
+    def pop_due(self, now):
+        """Remove and return all items, that are due at given time, in due order."""
+        items = []
+        while self._discard_stale() and self._queue[0][0] <= now:
+            due, seq, key = heapq.heappop(self._queue)
+            items.append(self._entries.pop(key)[1])
+        return items
+
+    def _discard_stale(self):
+        # Canceled and rescheduled items are left in the heap and skipped here.
+        while self._queue:
+            due, seq, key = self._queue[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == due:
+                return True
+            heapq.heappop(self._queue)
+        return False
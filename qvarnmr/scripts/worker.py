@@ -1,13 +1,18 @@
 import argparse
+import asyncio
 import time
 import sys
 import logging
 import datetime
 
 from qvarnmr.config import get_config, set_config
-from qvarnmr.clients.qvarn import QvarnApi, setup_qvarn_client
+from qvarnmr.clients.qvarn import (
+    QvarnApi, QvarnUnavailable, get_qvarn_api_options, setup_qvarn_client,
+)
 from qvarnmr.handlers import import_handlers_config
-from qvarnmr.processor import MapReduceEngine, get_changes
+from qvarnmr.metrics import RequestMetrics, summarize, latency_quantile
+from qvarnmr.processor import MapReduceEngine, get_changes, get_dead_letter_changes
+from qvarnmr.retry import RetryScheduler
 from qvarnmr.resync import resync_changed_handlers
 from qvarnmr.exceptions import BusyListenerError
 from qvarnmr.listeners import (
@@ -24,11 +29,31 @@ LISTENER_TIMEOUT = 60  # seconds
 logger = logging.getLogger(__name__)
 
 
+def log_qvarn_metrics(qvarn, changes_processed):
+    """Log Qvarn requests done since the last call, if any changes were processed."""
+    if not isinstance(qvarn.metrics, RequestMetrics):
+        return
+    snapshot = qvarn.metrics.snapshot(reset=True)
+    if not snapshot or changes_processed == 0:
+        return
+    totals = summarize(snapshot)
+    logger.info("qvarn requests=%d errors=%d bytes=%d latency=%.2fs latency_max=%.2fs",
+                totals['requests'], totals['errors'], totals['bytes'], totals['latency'],
+                totals['latency_max'])
+    for (operation, resource), stats in sorted(snapshot.items()):
+        logger.debug("qvarn requests operation=%s resource=%s count=%d errors=%r bytes=%d "
+                     "latency=%.2fs p95<=%.3fs", operation, resource, stats['count'],
+                     stats['errors'], stats['bytes'], stats['latency'],
+                     latency_quantile(stats['latency_buckets'], 0.95))
+
+
 def main(argv: list=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('handlers', help="python dotted path to map/reduce handlers config")
     parser.add_argument('-c', '--config', required=True, help="app config file")
     parser.add_argument('-f', '--forever', action='store_true', default=False, help="process changes forever")
+    parser.add_argument('--replay-dead-letters', action='store_true', default=False,
+                        help="process notifications stored in qvarnmr_dead_letters and exit")
     args = parser.parse_args(argv)
 
     now = datetime.datetime.utcnow()
@@ -38,13 +63,41 @@ def main(argv: list=None):
     config = get_config()
 
     client = setup_qvarn_client(config)
-    qvarn = QvarnApi(client)
+    qvarn = QvarnApi(client, **get_qvarn_api_options(config))
 
     listeners = None
 
     try:
         handlers = import_handlers_config(args.handlers)
-        engine = MapReduceEngine(qvarn, handlers)
+        retry_scheduler = RetryScheduler(
+            max_retries=config.getint('qvarnmr', 'retry_max', fallback=2),
+            backoff=config.getfloat('qvarnmr', 'retry_backoff', fallback=0.25),
+            factor=config.getfloat('qvarnmr', 'retry_backoff_factor', fallback=6),
+            jitter=config.getfloat('qvarnmr', 'retry_jitter', fallback=0.0),
+            max_entries=config.getint('qvarnmr', 'retry_max_entries', fallback=10000),
+        )
+        engine = MapReduceEngine(qvarn, handlers,
+                                 workers=config.getint('qvarnmr', 'workers', fallback=1),
+                                 retry_scheduler=retry_scheduler,
+                                 dead_letters=config.getboolean('qvarnmr', 'dead_letters',
+                                                                fallback=True),
+                                 cache_size=config.getint('qvarnmr', 'cache_size',
+                                                          fallback=10000))
+
+        if config.getboolean('qvarnmr', 'asyncio', fallback=False):
+            # Imported only here, because asyncio support requires Python 3.5 or newer.
+            from qvarnmr.aioprocessor import process_changes_async
+
+            loop = asyncio.new_event_loop()
+
+            def process_changes(changes):
+                return loop.run_until_complete(process_changes_async(engine, changes))
+        else:
+            process_changes = engine.process_changes
+
+        if args.replay_dead_letters:
+            process_changes(get_dead_letter_changes(qvarn))
+            return
 
         listeners = get_or_create_listeners(qvarn, config['qvarnmr']['instance'], handlers)
 
@@ -64,18 +117,35 @@ def main(argv: list=None):
             engine.add_callback(event, keep_alive)
 
         # Do automatic full resync for new or changed map/reduce handlers.
-        for _ in resync_changed_handlers(qvarn, engine, config['qvarnmr']['instance']):
+        resync = resync_changed_handlers(
+            qvarn, engine, config['qvarnmr']['instance'],
+            shards=config.getint('qvarnmr', 'resync_shards', fallback=1),
+            workers=config.getint('qvarnmr', 'resync_workers', fallback=1),
+            checkpoints=config.getboolean('qvarnmr', 'resync_checkpoints', fallback=False),
+        )
+        for _ in resync:
             # We don't want to suspend whole map/reduce engine while full resync is in progress.
             # That is why, we continue to process newest changes, while full resync is in progress.
-            changes = get_changes(qvarn, listeners)
-            engine.process_changes(changes)
+            changes = get_changes(qvarn, listeners, skip=retry_scheduler)
+            log_qvarn_metrics(qvarn, process_changes(changes))
 
         logger.info("entering the main loop")
 
         # Watch notifications and process map/reduce handlers forever.
         while True:
-            changes = get_changes(qvarn, listeners)
-            changes_processed = engine.process_changes(changes)
+            try:
+                changes = get_changes(qvarn, listeners, skip=retry_scheduler)
+                changes_processed = process_changes(changes)
+            except QvarnUnavailable as e:
+                if not args.forever or not qvarn.circuit_breaker.is_open():
+                    raise
+                # Qvarn is down, instead of going through all pending changes and failing each of
+                # them, wait until circuit breaker lets requests through again.
+                logger.warning("%s, pausing for %.1fs", e, qvarn.circuit_breaker.remaining())
+                time.sleep(qvarn.circuit_breaker.remaining())
+                continue
+
+            log_qvarn_metrics(qvarn, changes_processed)
 
             if args.forever:
                 if changes_processed == 0:
@@ -447,6 +447,43 @@ RESOURCE_TYPES = {
                     'source': '',
                     # Handler version, is used to check if full resync is needed.
                     'version': 0,
+                    # Checkpoint of an unfinished resync: handler version being resynced and
+                    # progress of each range of source resource ids, cursor is id of the last
+                    # resynced resource.
+                    'resync_version': 0,
+                    'resync_shards': [
+                        {
+                            'start': '',
+                            'end': '',
+                            'cursor': '',
+                            'done': False,
+                        },
+                    ],
+                },
+            },
+        ],
+    },
+    'qvarnmr_dead_letters': {
+        'path': '/qvarnmr_dead_letters',
+        'type': 'qvarnmr_dead_letter',
+        'versions': [
+            {
+                'version': 'v1',
+                'prototype': {
+                    'id': '',
+                    'type': '',
+                    'revision': '',
+                    # Notification, that failed after all retries.
+                    'resource_type': '',
+                    'resource_change': '',
+                    'resource_id': '',
+                    'notification_id': '',
+                    'listener_id': '',
+                    # Number of retries and date and time of the first failure.
+                    'retries': 0,
+                    'failed_at': '',
+                    # Last error.
+                    'error': '',
                 },
             },
         ],
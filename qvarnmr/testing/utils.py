@@ -7,34 +7,38 @@ def cleaned(resource):
     return {k: v for k, v in resource.items() if k not in ('id', 'revision', '_mr_timestamp')}
 
 
-def get_mapped_data(qvarn, target, expect_n_resources=None):
-    resources = qvarn.get_list(target)
+def _check_n_resources(n_resources, expect_n_resources):
     if expect_n_resources is not None:
-        assert len(resources) == expect_n_resources, 'expected %d, got %d' % (expect_n_resources,
-                                                                              len(resources))
+        assert n_resources == expect_n_resources, 'expected %d, got %d' % (expect_n_resources,
+                                                                           n_resources)
+
+
+def get_mapped_data(qvarn, target, expect_n_resources=None):
     result = dict()
-    for r in qvarn.get_multiple(target, resources):
+    n_resources = 0
+    for r in qvarn.iter_get_multiple(target, qvarn.iter_list(target)):
         assert r['_mr_source_id'] not in result
         result[r['_mr_source_id']] = cleaned(r)
+        n_resources += 1
+    _check_n_resources(n_resources, expect_n_resources)
     return result
 
 
 def get_reduced_data(qvarn, target, expect_n_resources=None):
-    resources = qvarn.get_list(target)
-    if expect_n_resources is not None:
-        assert len(resources) == expect_n_resources, 'expected %d, got %d' % (expect_n_resources,
-                                                                              len(resources))
     result = dict()
-    for r in qvarn.get_multiple(target, resources):
+    n_resources = 0
+    for r in qvarn.iter_get_multiple(target, qvarn.iter_list(target)):
         assert r['_mr_key'] not in result
         result[r['_mr_key']] = cleaned(r)
+        n_resources += 1
+    _check_n_resources(n_resources, expect_n_resources)
     return result
 
 
 def get_resource_values(qvarn, target, field, sort=None):
     result = []
-    resources = qvarn.get_list(target)
-    for r in qvarn.get_multiple(target, resources):
+    resources = qvarn.iter_list(target)
+    for r in qvarn.iter_get_multiple(target, resources):
         if isinstance(field, tuple):
             result.append(tuple(r[x] for x in field))
         else:
@@ -86,6 +90,6 @@ def process(qvarn, listeners, config_or_engine, limit=10, raise_errors=True):
     counter = count()
     changes_processed = 1
     while changes_processed > 0:
-        changes = get_changes(qvarn, listeners)
+        changes = get_changes(qvarn, listeners, skip=engine.retry_scheduler)
         changes_processed = engine.process_changes(changes)
         assert next(counter) < limit
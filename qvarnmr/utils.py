@@ -1,5 +1,6 @@
-from itertools import chain
-from types import GeneratorType
+import json
+import sqlite3
+from itertools import chain, islice
 
 from qvarnmr.func import Func
 
@@ -19,13 +20,12 @@ def get_handler_identifier(handler):
 
 
 def chunks(size, items):
-    if not isinstance(items, GeneratorType):
-        items = iter(items)
+    items = iter(items)
     while True:
-        yield chain(
-            [next(items)],
-            (next(items) for i in range(size - 1)),
-        )
+        chunk = list(islice(items, size))
+        if not chunk:
+            break
+        yield chunk
 
 
 def is_empty(items):
@@ -35,3 +35,64 @@ def is_empty(items):
         return iter([]), True
     else:
         return chain([item], items), False
+
+
+class KeySet:
+    """Set of JSON serializable keys (including unhashable ones) with bounded memory use.
+
+    Up to ``memory_limit`` keys are kept in memory, after that all keys are moved to a temporary
+    sqlite database on disk, which is removed by ``close``.
+    """
+
+    def __init__(self, memory_limit=10000):
+        self.memory_limit = memory_limit
+        self._keys = set()
+        self._db = None
+
+    def add(self, key):
+        """Add a key, return True if it was not in the set yet."""
+        key = json.dumps(key, sort_keys=True)
+        if self._db is None:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            if len(self._keys) > self.memory_limit:
+                self._spill()
+            return True
+        cursor = self._db.execute('INSERT OR IGNORE INTO keys VALUES (?)', (key,))
+        return cursor.rowcount == 1
+
+    def __contains__(self, key):
+        key = json.dumps(key, sort_keys=True)
+        if self._db is None:
+            return key in self._keys
+        cursor = self._db.execute('SELECT 1 FROM keys WHERE key = ?', (key,))
+        return cursor.fetchone() is not None
+
+    def __iter__(self):
+        """Yield all keys sorted by their JSON representation."""
+        if self._db is None:
+            keys = sorted(self._keys)
+        else:
+            keys = (key for key, in self._db.execute('SELECT key FROM keys ORDER BY key'))
+        for key in keys:
+            yield json.loads(key)
+
+    def __len__(self):
+        if self._db is None:
+            return len(self._keys)
+        return self._db.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+
+    def _spill(self):
+        # Empty file name creates a private temporary database, deleted when it is closed.
+        # Resync steps can run in different worker threads, but never concurrently.
+        self._db = sqlite3.connect('', check_same_thread=False)
+        self._db.execute('CREATE TABLE keys (key TEXT PRIMARY KEY) WITHOUT ROWID')
+        self._db.executemany('INSERT INTO keys VALUES (?)', ((key,) for key in self._keys))
+        self._keys = set()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        self._keys = set()
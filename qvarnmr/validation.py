@@ -34,8 +34,8 @@ def validate_handlers(config):
         'reduce': {'type', 'version', 'handler'},
     }
     optional_handler_fields = {
-        'map': set(),
-        'reduce': {'map'},
+        'map': {'fingerprint'},
+        'reduce': {'map', 'combine'},
     }
     for target_resource_type, sources in config.items():
         for source_resource_type, handler in sources.items():
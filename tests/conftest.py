@@ -1,3 +1,4 @@
+import sys
 import datetime
 
 import pytest
@@ -10,6 +11,10 @@ from qvarnmr.testing.realqvarn import RealQvarn
 
 QVARN_BASE_URL = 'https://qvarn-example.tld'
 
+# Asyncio support uses ``async def`` syntax, which requires Python 3.5.
+if sys.version_info < (3, 5):
+    collect_ignore = ['test_aioqvarn.py', 'test_aioprocessor.py']
+
 CONFIG = {
     'qvarn': {
         'verify_requests': 'false',
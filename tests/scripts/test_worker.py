@@ -3,8 +3,10 @@ from copy import deepcopy
 
 import pytest
 
+from qvarnmr import processor
 from qvarnmr.scripts import worker
 from qvarnmr.func import item, value
+from qvarnmr.testing import realqvarn as realqvarn_module
 from qvarnmr.testing.utils import get_reduced_data, get_resource_values, update_resource
 
 
@@ -161,6 +163,233 @@ def test_auto_resync(realqvarn, qvarn, mocker, config):
     assert reduced[1]['_mr_value'] == 2
 
 
+def test_resync_is_resumed_after_interruption(realqvarn, qvarn, mocker, config):
+    mocker.patch('qvarnmr.scripts.worker.set_config')
+    mocker.patch('qvarnmr.scripts.worker.setup_qvarn_client', return_value=qvarn.client)
+    mocker.patch('qvarnmr.resync.RESYNC_CHUNK_SIZE', 1)
+    config['qvarnmr']['resync_checkpoints'] = 'true'
+
+    realqvarn.add_resource_types(SCHEMA)
+
+    config_ = deepcopy(CONFIG)
+    mocker.patch('qvarnmr.testing.config', config_, create=True)
+
+    ids = sorted(qvarn.create('source', {'key': 1, 'value': i})['id'] for i in range(1, 4))
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+
+    calls = []
+
+    def new_map_handler(resource):
+        if len(calls) == 2 and crash:
+            raise KeyboardInterrupt
+        calls.append(resource['id'])
+        return resource['key'], resource['value'] * 2
+
+    config_['map_target']['source'] = {
+        'type': 'map',
+        'version': 2,
+        'handler': new_map_handler,
+    }
+
+    # Worker is stopped in the middle of resync.
+    crash = True
+    with pytest.raises(KeyboardInterrupt):
+        worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+    assert calls == ids[:2]
+
+    # Next worker continues from the last checkpoint.
+    crash = False
+    calls.clear()
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+    assert calls == ids[2:]
+    reduced = get_reduced_data(qvarn, 'reduce_target', 1)
+    assert reduced[1]['_mr_value'] == 12
+
+    state = qvarn.search_one('qvarnmr_handlers', target='map_target', source='source')
+    assert (state['version'], state['resync_shards']) == (2, [])
+
+
+def test_new_handler_resync_is_not_checkpointed(realqvarn, qvarn, mocker, config):
+    mocker.patch('qvarnmr.scripts.worker.set_config')
+    mocker.patch('qvarnmr.scripts.worker.setup_qvarn_client', return_value=qvarn.client)
+    mocker.patch('qvarnmr.resync.RESYNC_CHUNK_SIZE', 1)
+    config['qvarnmr']['resync_checkpoints'] = 'true'
+
+    realqvarn.add_resource_types(SCHEMA)
+
+    def map_handler(resource):
+        if crash and resource['value'] == 2:
+            raise KeyboardInterrupt
+        return resource['key'], resource['value']
+
+    config_ = deepcopy(CONFIG)
+    config_['map_target']['source']['handler'] = map_handler
+    mocker.patch('qvarnmr.testing.config', config_, create=True)
+
+    for i in range(1, 4):
+        qvarn.create('source', {'key': 1, 'value': i})
+
+    # Worker is stopped in the middle of the initial resync.
+    crash = True
+    with pytest.raises(KeyboardInterrupt):
+        worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+    assert qvarn.search('qvarnmr_handlers', target='map_target', source='source') == []
+
+    crash = False
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+    state = qvarn.search_one('qvarnmr_handlers', target='map_target', source='source')
+    assert state['version'] == 1
+    reduced = get_reduced_data(qvarn, 'reduce_target', 1)
+    assert reduced[1]['_mr_value'] == 6
+
+
+def test_resync_without_checkpoint_fields(mock_requests, mocker, config):
+    # Resource type of a deployment, that does not use resync checkpoints.
+    resource_types = deepcopy(realqvarn_module.RESOURCE_TYPES)
+    prototype = resource_types['qvarnmr_handlers']['versions'][0]['prototype']
+    del prototype['resync_version'], prototype['resync_shards']
+    mocker.patch.object(realqvarn_module, 'RESOURCE_TYPES', resource_types)
+    realqvarn = realqvarn_module.RealQvarn(mock_requests, config.get('qvarn', 'base_url'))
+    qvarn = realqvarn.qvarn
+
+    mocker.patch('qvarnmr.scripts.worker.set_config')
+    mocker.patch('qvarnmr.scripts.worker.setup_qvarn_client', return_value=qvarn.client)
+    mocker.patch('qvarnmr.resync.RESYNC_CHUNK_SIZE', 1)
+
+    realqvarn.add_resource_types(SCHEMA)
+
+    config_ = deepcopy(CONFIG)
+    mocker.patch('qvarnmr.testing.config', config_, create=True)
+
+    for i in range(1, 4):
+        qvarn.create('source', {'key': 1, 'value': i})
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+
+    config_['map_target']['source'] = {
+        'type': 'map',
+        'version': 2,
+        'handler': lambda resource: (resource['key'], resource['value'] * 2),
+    }
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+    reduced = get_reduced_data(qvarn, 'reduce_target', 1)
+    assert reduced[1]['_mr_value'] == 12
+
+    state = qvarn.search_one('qvarnmr_handlers', target='map_target', source='source')
+    assert state['version'] == 2
+    assert 'resync_version' not in state
+
+
+def test_parallel_sharded_resync(realqvarn, qvarn, mocker, config):
+    mocker.patch('qvarnmr.scripts.worker.set_config')
+    mocker.patch('qvarnmr.scripts.worker.setup_qvarn_client', return_value=qvarn.client)
+    mocker.patch('qvarnmr.resync.RESYNC_CHUNK_SIZE', 2)
+    config['qvarnmr']['resync_shards'] = '4'
+    config['qvarnmr']['resync_workers'] = '3'
+
+    realqvarn.add_resource_types(SCHEMA)
+
+    config_ = deepcopy(CONFIG)
+    mocker.patch('qvarnmr.testing.config', config_, create=True)
+
+    for i in range(10):
+        qvarn.create('source', {'key': i % 2, 'value': i})
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        (0, 20),
+        (1, 25),
+    ]
+
+    def new_map_handler(resource):
+        return resource['key'], resource['value'] * 2
+
+    config_['map_target']['source'] = {
+        'type': 'map',
+        'version': 2,
+        'handler': new_map_handler,
+    }
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        (0, 40),
+        (1, 50),
+    ]
+    assert get_resource_values(qvarn, 'map_target', '_mr_version') == [2] * 10
+
+
+def test_map_and_reduce_resync_reduces_each_key_once(realqvarn, qvarn, mocker, config):
+    mocker.patch('qvarnmr.scripts.worker.set_config')
+    mocker.patch('qvarnmr.scripts.worker.setup_qvarn_client', return_value=qvarn.client)
+    mocker.patch('qvarnmr.resync.RESYNC_CHUNK_SIZE', 2)
+
+    realqvarn.add_resource_types(SCHEMA)
+
+    config_ = deepcopy(CONFIG)
+    mocker.patch('qvarnmr.testing.config', config_, create=True)
+
+    for i in range(10):
+        qvarn.create('source', {'key': i % 2, 'value': i})
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+
+    def new_map_handler(resource):
+        return resource['key'], resource['value'] * 2
+
+    reduced = []
+
+    def new_reduce_handler(values):
+        values = list(values)
+        reduced.append(values)
+        return sum(values)
+
+    config_['map_target']['source'] = {
+        'type': 'map',
+        'version': 2,
+        'handler': new_map_handler,
+    }
+    config_['reduce_target']['map_target'] = {
+        'type': 'reduce',
+        'version': 2,
+        'handler': new_reduce_handler,
+        'map': value(),
+    }
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        (0, 40),
+        (1, 50),
+    ]
+    assert sorted(map(sorted, reduced)) == [[0, 4, 8, 12, 16], [2, 6, 10, 14, 18]]
+
+
+def test_resync_skips_current_resources_using_version_index(realqvarn, qvarn, mocker, config):
+    mocker.patch('qvarnmr.scripts.worker.set_config')
+    mocker.patch('qvarnmr.scripts.worker.setup_qvarn_client', return_value=qvarn.client)
+
+    realqvarn.add_resource_types(SCHEMA)
+
+    config_ = deepcopy(CONFIG)
+    mocker.patch('qvarnmr.testing.config', config_, create=True)
+
+    for i in range(10):
+        qvarn.create('source', {'key': i % 2, 'value': i})
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+
+    # Handler versions are lost, but all mapped and reduced resources are already current.
+    update_resource(qvarn, 'qvarnmr_handlers', target='map_target', source='source')(version=0)
+    update_resource(qvarn, 'qvarnmr_handlers', target='reduce_target', source='map_target')(
+        version=0,
+    )
+    process_map = mocker.spy(processor, '_process_map')
+    process_reduce = mocker.spy(processor, '_process_reduce')
+    worker.main(['qvarnmr.testing.config', '-c', 'qvarnmr.cfg'])
+    assert process_map.call_count == 0
+    assert process_reduce.call_count == 0
+
+    state = qvarn.search_one('qvarnmr_handlers', target='map_target', source='source')
+    assert state['version'] == 1
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        (0, 20),
+        (1, 25),
+    ]
+
+
 def test_check_for_running_workers(realqvarn, qvarn, mocker, config):
     mocker.patch('qvarnmr.scripts.worker.set_config')
     mocker.patch('qvarnmr.scripts.worker.setup_qvarn_client', return_value=qvarn.client)
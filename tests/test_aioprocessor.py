@@ -0,0 +1,113 @@
+import asyncio
+
+from qvarnmr.aioprocessor import process_changes_async
+from qvarnmr.func import item, value
+from qvarnmr.listeners import get_or_create_listeners
+from qvarnmr.processor import MapReduceEngine, get_changes
+from qvarnmr.testing.utils import get_resource_values
+
+
+SCHEMA = {
+    'source': {
+        'path': '/source',
+        'type': 'source',
+        'versions': [
+            {
+                'version': 'v1',
+                'prototype': {
+                    'type': '',
+                    'id': '',
+                    'revision': '',
+                    'key': '',
+                    'value': 0,
+                },
+            },
+        ],
+    },
+    'map_target': {
+        'path': '/map_target',
+        'type': 'map_target',
+        'versions': [
+            {
+                'version': 'v1',
+                'prototype': {
+                    'type': '',
+                    'id': '',
+                    'revision': '',
+                    '_mr_key': '',
+                    '_mr_value': 0,
+                    '_mr_source_id': '',
+                    '_mr_source_type': '',
+                    '_mr_version': 0,
+                    '_mr_deleted': False,
+                },
+            },
+        ],
+    },
+    'reduce_target': {
+        'path': '/reduce_target',
+        'type': 'reduce_target',
+        'versions': [
+            {
+                'version': 'v1',
+                'prototype': {
+                    'type': '',
+                    'id': '',
+                    'revision': '',
+                    '_mr_key': '',
+                    '_mr_value': 0,
+                    '_mr_version': 0,
+                    '_mr_timestamp': 0,
+                },
+            },
+        ],
+    },
+}
+
+
+def test_process_changes_async(realqvarn, qvarn):
+    realqvarn.add_resource_types(SCHEMA)
+
+    config = {
+        'map_target': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key', 'value'),
+            },
+        },
+        'reduce_target': {
+            'map_target': {
+                'type': 'reduce',
+                'version': 1,
+                'handler': sum,
+                'map': value(),
+            },
+        },
+    }
+
+    engine = MapReduceEngine(qvarn, config, raise_errors=True, batch_size=2)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+
+    data = [qvarn.create('source', {'key': str(i % 2), 'value': i}) for i in range(5)]
+    qvarn.delete('source', data[4]['id'])
+
+    loop = asyncio.new_event_loop()
+    try:
+        changes = list(get_changes(qvarn, listeners))
+        assert len(changes) == 6
+        loop.run_until_complete(process_changes_async(engine, changes))
+        # Notifications of mapped resources written by the engine are just acknowledged.
+        changes = list(get_changes(qvarn, listeners))
+        loop.run_until_complete(process_changes_async(engine, changes))
+        assert list(get_changes(qvarn, listeners)) == []
+    finally:
+        loop.close()
+
+    assert get_resource_values(qvarn, 'map_target', ('_mr_key', '_mr_value')) == [
+        ('0', 0), ('0', 2), ('1', 1), ('1', 3),
+    ]
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        ('0', 2),
+        ('1', 4),
+    ]
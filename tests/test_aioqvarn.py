@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from qvarnmr.clients.aioqvarn import AsyncQvarnApi
+from qvarnmr.clients.qvarn import QvarnResourceNotFound
+
+
+@pytest.fixture
+def run():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+def test_crud(qvarn, run):
+    aqvarn = AsyncQvarnApi(qvarn)
+
+    org = run(aqvarn.create('orgs', {'names': ['Orgtra']}))
+    assert run(aqvarn.get('orgs', org['id']))['names'] == ['Orgtra']
+
+    # Revision is taken from the revision cache of the wrapped QvarnApi.
+    updated = run(aqvarn.update('orgs', org['id'], {'names': ['Orgtra 2']}))
+    assert updated['revision'] != org['revision']
+    assert qvarn.get('orgs', org['id'])['names'] == ['Orgtra 2']
+
+    assert run(aqvarn.search('orgs', names='Orgtra 2')) == [org['id']]
+    result = run(aqvarn.search('orgs', names='Orgtra 2', show=('names',)))
+    assert [(x['id'], x['names']) for x in result] == [(org['id'], ['Orgtra 2'])]
+
+    run(aqvarn.delete('orgs', org['id']))
+    with pytest.raises(QvarnResourceNotFound):
+        run(aqvarn.get('orgs', org['id']))
+
+
+def test_get_multiple(qvarn, run):
+    aqvarn = AsyncQvarnApi(qvarn)
+    orgs = [qvarn.create('orgs', {'names': ['Orgtra %d' % i]}) for i in range(3)]
+    ids = [x['id'] for x in orgs]
+
+    assert [x['names'] for x in run(aqvarn.get_multiple('orgs', ids))] == [
+        ['Orgtra 0'], ['Orgtra 1'], ['Orgtra 2'],
+    ]
+
+    result = run(aqvarn.get_multiple('orgs', [ids[0], 'missing'], return_exceptions=True))
+    assert result[0]['id'] == ids[0]
+    assert isinstance(result[1], QvarnResourceNotFound)
+
+    with pytest.raises(QvarnResourceNotFound):
+        run(aqvarn.get_multiple('orgs', [ids[0], 'missing']))
+
+
+def test_cache_scope(qvarn, run, mocker):
+    aqvarn = AsyncQvarnApi(qvarn)
+    org = qvarn.create('orgs', {'names': ['Orgtra']})
+
+    send = mocker.spy(qvarn, '_send')
+    with qvarn.cache_scope():
+        run(aqvarn.get('orgs', org['id']))
+        assert qvarn.get('orgs', org['id'])['names'] == ['Orgtra']
+        assert send.call_count == 1
+
+        # Writes invalidate cached responses.
+        run(aqvarn.update('orgs', org['id'], {'names': ['Orgtra 2']}))
+        assert run(aqvarn.get('orgs', org['id']))['names'] == ['Orgtra 2']
+        assert send.call_count == 3
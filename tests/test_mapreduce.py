@@ -4,10 +4,14 @@ from functools import reduce
 from operator import mul
 from unittest import mock
 
-from qvarnmr.func import join, item, count, value, mr_func
-from qvarnmr.testing.utils import cleaned, get_resource_values, get_reduced_data, process
+from qvarnmr.func import join, item, count, value, mr_func, count_combiner, sum_combiner
+from qvarnmr.testing.utils import (
+    cleaned, get_resource_values, get_reduced_data, process, update_resource,
+)
 from qvarnmr.listeners import get_or_create_listeners
-from qvarnmr.processor import MapReduceEngine
+from qvarnmr import processor
+from qvarnmr.processor import MapReduceEngine, get_changes
+from qvarnmr.retry import RetryScheduler
 
 
 SCHEMA = {
@@ -190,7 +194,8 @@ def test_mapreduce(realqvarn, qvarn):
             '_mr_value': None,
             '_mr_version': 1,
             'org_id': org['id'],
-            'report_id': reports[1]['id'],
+            # Source with the greatest id wins, whatever the order of mapped resources is.
+            'report_id': max(report['id'] for report in reports),
         }
     }
 
@@ -497,6 +502,81 @@ def test_reduce_handler_error(realqvarn, qvarn, mocker):
     assert len(qvarn.get_list('mapped/listeners/' + listenerid['mapped'] + '/notifications')) == 0
 
 
+def test_dead_letters(realqvarn, qvarn, mocker):
+    realqvarn.add_resource_types(SCHEMA)
+
+    config = {
+        'mapped': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': mock.Mock(side_effect=[
+                    ValueError('fake error 1'),
+                    ValueError('fake error 2'),
+                    ValueError('fake error 3'),
+                    iter([(1, 1)]),
+                ]),
+            },
+        },
+    }
+
+    engine = MapReduceEngine(qvarn, config)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+    notifications = 'source/listeners/' + listeners[0].listener['id'] + '/notifications'
+
+    source = qvarn.create('source', {'key': 1, 'value': 1})
+
+    # After all retries are exhausted, notification is moved to dead letters.
+    for now in (1.0, 2.0, 3.0):
+        mocker.patch('time.time', return_value=now)
+        process(qvarn, listeners, engine, raise_errors=False)
+    assert qvarn.get_list(notifications) == []
+    assert get_resource_values(qvarn, 'mapped', ('_mr_key', '_mr_value')) == []
+    assert get_resource_values(qvarn, processor.DEAD_LETTERS, (
+        'resource_type', 'resource_change', 'resource_id', 'retries', 'failed_at', 'error',
+    )) == [
+        ('source', 'created', source['id'], 2, '1970-01-01T00:00:01',
+         repr(ValueError('fake error 3'))),
+    ]
+
+    # Dead letters can be replayed.
+    assert engine.process_changes(processor.get_dead_letter_changes(qvarn)) == 1
+    assert qvarn.get_list(processor.DEAD_LETTERS) == []
+    assert get_resource_values(qvarn, 'mapped', ('_mr_key', '_mr_value')) == [(1, 1)]
+
+
+def test_dead_letters_when_retry_scheduler_is_full(realqvarn, qvarn, mocker):
+    realqvarn.add_resource_types(SCHEMA)
+
+    config = {
+        'mapped': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': mock.Mock(side_effect=ValueError('fake error')),
+            },
+        },
+    }
+
+    engine = MapReduceEngine(qvarn, config, retry_scheduler=RetryScheduler(max_entries=1))
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+    notifications = 'source/listeners/' + listeners[0].listener['id'] + '/notifications'
+
+    sources = [qvarn.create('source', {'key': 1, 'value': i}) for i in range(3)]
+
+    mocker.patch('time.time', return_value=1.0)
+    process(qvarn, listeners, engine, raise_errors=False)
+
+    # One notification waits for a retry, others, that did not fit into the scheduler, are moved
+    # to dead letters instead of being retried on each cycle without any backoff.
+    assert len(engine.retry_scheduler) == 1
+    assert len(qvarn.get_list(notifications)) == 1
+    dead_letters = get_resource_values(qvarn, processor.DEAD_LETTERS, ('resource_id', 'retries'))
+    assert len(dead_letters) == 2
+    assert {resource_id for resource_id, _ in dead_letters} < {x['id'] for x in sources}
+    assert {retries for _, retries in dead_letters} == {0}
+
+
 def test_map_outputs_dict_value(realqvarn, qvarn):
     realqvarn.add_resource_types({
         'data': {
@@ -745,3 +825,163 @@ def test_single_source_multiple_targets(realqvarn, qvarn):
     assert get_resource_values(qvarn, 'reduce2', ('_mr_key', '_mr_value')) == [
         ('1', 8),
     ]
+
+
+def test_map_fingerprint(realqvarn, qvarn):
+    realqvarn.add_resource_types(SCHEMA)
+    realqvarn.add_resource_types({
+        'fingerprinted': {
+            'path': '/fingerprinted',
+            'type': 'fingerprinted',
+            'versions': [
+                {
+                    'version': 'v1',
+                    'prototype': {
+                        'id': '',
+                        'type': '',
+                        'revision': '',
+                        '_mr_key': 0,
+                        '_mr_value': 0,
+                        '_mr_source_id': '',
+                        '_mr_source_type': '',
+                        '_mr_version': 0,
+                        '_mr_deleted': 0,
+                        '_mr_fingerprint': '',
+                    },
+                },
+            ],
+        },
+    })
+
+    config = {
+        'fingerprinted': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key'),
+                'fingerprint': True,
+            },
+        },
+    }
+
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+
+    source = qvarn.create('source', {'key': 1, 'value': 1})
+    process(qvarn, listeners, config)
+    mapped = qvarn.get('fingerprinted', qvarn.get_list('fingerprinted')[0])
+    assert (mapped['_mr_key'], mapped['_mr_source_id']) == (1, source['id'])
+
+    # Mapped output does not change, so mapped resource should not be touched at all.
+    source = qvarn.update('source', source['id'], dict(source, value=2))
+    process(qvarn, listeners, config)
+    assert qvarn.get_list('fingerprinted') == [mapped['id']]
+    assert qvarn.get('fingerprinted', mapped['id'])['revision'] == mapped['revision']
+
+    # Mapped output changes, existing mapped resource should be updated in place.
+    source = qvarn.update('source', source['id'], dict(source, key=2))
+    process(qvarn, listeners, config)
+    assert qvarn.get_list('fingerprinted') == [mapped['id']]
+    assert get_resource_values(qvarn, 'fingerprinted', '_mr_key') == [2]
+
+    # Source is deleted, mapped resource should be marked as deleted.
+    qvarn.delete('source', source['id'])
+    process(qvarn, listeners, config)
+    assert get_resource_values(qvarn, 'fingerprinted', ('_mr_key', '_mr_deleted')) == [(2, True)]
+
+
+def test_incremental_reduce(realqvarn, qvarn, mocker):
+    realqvarn.add_resource_types(SCHEMA)
+
+    config = {
+        'mapped': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key', 'value'),
+            },
+        },
+        'reduced': {
+            'mapped': {
+                'type': 'reduce',
+                'version': 1,
+                'handler': sum,
+                'map': value(),
+                'combine': sum_combiner,
+            },
+        },
+    }
+
+    engine = MapReduceEngine(qvarn, config, raise_errors=True)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+    full_reduce = mocker.spy(processor, '_iter_reduce_resource_ids')
+
+    resources = [
+        qvarn.create('source', {'key': 1, 'value': 1}),
+        qvarn.create('source', {'key': 1, 'value': 2}),
+        qvarn.create('source', {'key': 2, 'value': 3}),
+    ]
+    process(qvarn, listeners, engine)
+    assert get_resource_values(qvarn, 'reduced', ('_mr_key', '_mr_value')) == [(1, 3), (2, 3)]
+
+    # Update a source resource, old value should be retracted and new value merged.
+    update_resource(qvarn, 'source', resources[0]['id'])(value=5)
+    process(qvarn, listeners, engine)
+    assert get_resource_values(qvarn, 'reduced', ('_mr_key', '_mr_value')) == [(1, 7), (2, 3)]
+
+    # Move a source resource to another key.
+    update_resource(qvarn, 'source', resources[1]['id'])(key=2)
+    process(qvarn, listeners, engine)
+    assert get_resource_values(qvarn, 'reduced', ('_mr_key', '_mr_value')) == [(1, 5), (2, 5)]
+
+    # Delete a source resource.
+    qvarn.delete('source', resources[2]['id'])
+    process(qvarn, listeners, engine)
+    assert get_resource_values(qvarn, 'reduced', ('_mr_key', '_mr_value')) == [(1, 5), (2, 2)]
+
+    # Reduce values were never fully recomputed and all deleted mapped resources are cleaned up.
+    assert full_reduce.call_count == 0
+    assert get_resource_values(qvarn, 'mapped', ('_mr_key', '_mr_value', '_mr_deleted')) == [
+        (1, 5, False),
+        (2, 2, False),
+    ]
+
+
+def test_incremental_reduce_after_restart(realqvarn, qvarn):
+    realqvarn.add_resource_types(SCHEMA)
+
+    config = {
+        'mapped': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key', 'value'),
+            },
+        },
+        'reduced': {
+            'mapped': {
+                'type': 'reduce',
+                'version': 1,
+                'handler': count,
+                'combine': count_combiner,
+            },
+        },
+    }
+
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+    for i in range(3):
+        qvarn.create('source', {'key': 1, 'value': i})
+
+    # Written mapped resources are reduced immediately, then engine is restarted, before
+    # notifications of the written resources are received.
+    engine = MapReduceEngine(qvarn, config, raise_errors=True)
+    engine.process_changes(get_changes(qvarn, listeners))
+    assert get_resource_values(qvarn, 'reduced', ('_mr_key', '_mr_value')) == [(1, 3)]
+
+    # New engine does not know, that these notifications are already reduced, so they must not
+    # be merged again.
+    process(qvarn, listeners, MapReduceEngine(qvarn, config, raise_errors=True))
+    assert get_resource_values(qvarn, 'reduced', ('_mr_key', '_mr_value')) == [(1, 3)]
+
+    qvarn.create('source', {'key': 1, 'value': 3})
+    process(qvarn, listeners, MapReduceEngine(qvarn, config, raise_errors=True))
+    assert get_resource_values(qvarn, 'reduced', ('_mr_key', '_mr_value')) == [(1, 4)]
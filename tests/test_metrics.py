@@ -0,0 +1,30 @@
+from qvarnmr.metrics import RequestMetrics, latency_quantile, summarize
+
+
+def test_request_metrics():
+    metrics = RequestMetrics()
+    metrics.record('get', 'orgs', 200, 0.02, 100, None)
+    metrics.record('get', 'orgs', 404, 0.2, 10, '404')
+    metrics.record('search', 'orgs', None, 3, 0, 'ConnectionError')
+
+    snapshot = metrics.snapshot()
+    stats = snapshot[('get', 'orgs')]
+    assert stats['count'] == 2
+    assert stats['bytes'] == 110
+    assert stats['latency_max'] == 0.2
+    assert stats['errors'] == {'404': 1}
+    assert stats['latency_buckets'][0.025] == 1
+    assert stats['latency_buckets'][0.25] == 1
+    assert latency_quantile(stats['latency_buckets'], 0.5) == 0.025
+    assert latency_quantile(stats['latency_buckets'], 0.95) == 0.25
+
+    assert summarize(snapshot) == {
+        'requests': 3,
+        'errors': 2,
+        'bytes': 110,
+        'latency': 3.22,
+        'latency_max': 3,
+    }
+
+    assert metrics.snapshot(reset=True) == snapshot
+    assert metrics.snapshot() == {}
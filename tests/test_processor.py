@@ -1,8 +1,12 @@
+import threading
+import time
+
 from qvarnmr.processor import UPDATED
-from qvarnmr.processor import _process_map, MapReduceEngine
+from qvarnmr.processor import _process_map, MapReduceEngine, get_changes
 from qvarnmr.func import item, value
 from qvarnmr.handlers import get_handlers
 from qvarnmr.listeners import get_or_create_listeners, check_and_update_listeners_state
+from qvarnmr.resync import iter_map_resync_changes
 from qvarnmr.testing.utils import get_mapped_data, get_resource_values, update_resource, process
 
 
@@ -304,3 +308,381 @@ def test_reduce_multiple_resources_for_signle_key(realqvarn, qvarn, mocker, free
     assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
         ('k1', 1),
     ]
+
+
+def test_map_sources_are_fetched_in_batches(realqvarn, qvarn, mocker):
+    realqvarn.add_resource_types(SCHEMA)
+
+    config = {
+        'map_target': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key', 'value'),
+            },
+        },
+    }
+
+    engine = MapReduceEngine(qvarn, config, raise_errors=False)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+
+    # Freeze time, to make sure, that failed notification is not retried.
+    mocker.patch('time.time', return_value=1.0)
+
+    data = [
+        qvarn.create('source', {'key': '1', 'value': 1}),
+        qvarn.create('source', {'key': '2', 'value': 2}),
+        qvarn.create('source', {'key': '3', 'value': 3}),
+    ]
+
+    # Source resource deleted before notifications are processed should not fail the whole batch.
+    # Deletion notification is dropped, otherwise created and deleted notifications cancel out.
+    qvarn.delete('source', data[1]['id'])
+    path = 'source/listeners/' + listeners[0].listener['id'] + '/notifications'
+    qvarn.delete(path, qvarn.get_list(path)[-1])
+
+    get = mocker.spy(qvarn, 'get')
+    get_multiple = mocker.spy(qvarn, 'get_multiple')
+
+    process(qvarn, listeners, engine)
+    assert get_resource_values(qvarn, 'map_target', ('_mr_key', '_mr_value')) == [
+        ('1', 1),
+        ('3', 3),
+    ]
+
+    # All source resources should be fetched with a single request batch.
+    assert [c for c in get.call_args_list if c[0][0] == 'source'] == []
+    assert [c[0][1] for c in get_multiple.call_args_list if c[0][0] == 'source'] == [
+        [x['id'] for x in data],
+    ]
+
+
+def test_map_handlers_with_worker_pool(realqvarn, qvarn):
+    realqvarn.add_resource_types(SCHEMA)
+
+    config = {
+        'map_target': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key', 'value'),
+            },
+        },
+        'reduce_target': {
+            'map_target': {
+                'type': 'reduce',
+                'version': 1,
+                'handler': sum,
+                'map': value(),
+            },
+        },
+    }
+
+    engine = MapReduceEngine(qvarn, config, raise_errors=True, batch_size=5, workers=4)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+
+    data = [qvarn.create('source', {'key': str(i % 3), 'value': i}) for i in range(12)]
+    update_resource(qvarn, 'source', data[0]['id'])(value=20)
+    update_resource(qvarn, 'source', data[0]['id'])(value=30)
+
+    process(qvarn, listeners, engine)
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        ('0', 30 + 3 + 6 + 9),
+        ('1', 1 + 4 + 7 + 10),
+        ('2', 2 + 5 + 8 + 11),
+    ]
+
+
+def _reduce_config(handler):
+    return {
+        'map_target': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key', 'value'),
+            },
+        },
+        'reduce_target': {
+            'map_target': {
+                'type': 'reduce',
+                'version': 1,
+                'handler': handler,
+                # Handler gets (key, value) pairs, so that it knows which key it reduces.
+                'map': item('_mr_key', '_mr_value'),
+            },
+        },
+    }
+
+
+def test_reduce_groups_are_processed_concurrently(realqvarn, qvarn):
+    realqvarn.add_resource_types(SCHEMA)
+
+    # Both keys have to be reduced at the same time to get through the barrier.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def reduce_handler(values):
+        values = list(values)
+        barrier.wait()
+        return sum(value for key, value in values)
+
+    config = _reduce_config(reduce_handler)
+    engine = MapReduceEngine(qvarn, config, raise_errors=True, workers=2)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+
+    for i in range(4):
+        qvarn.create('source', {'key': str(i % 2), 'value': i})
+
+    process(qvarn, listeners, engine)
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        ('0', 0 + 2),
+        ('1', 1 + 3),
+    ]
+
+
+def test_each_key_is_reduced_by_one_worker_at_a_time(realqvarn, qvarn):
+    realqvarn.add_resource_types(SCHEMA)
+
+    lock = threading.Lock()
+    active = set()
+    calls = []
+
+    def reduce_handler(values):
+        values = list(values)
+        key = values[0][0]
+        with lock:
+            assert key not in active
+            active.add(key)
+            calls.append(key)
+        time.sleep(0.01)
+        with lock:
+            active.remove(key)
+        return sum(value for key, value in values)
+
+    config = _reduce_config(reduce_handler)
+    engine = MapReduceEngine(qvarn, config, raise_errors=True, batch_size=20, workers=4)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+
+    for i in range(12):
+        qvarn.create('source', {'key': str(i % 3), 'value': i})
+
+    # All changes of a key are reduced at once.
+    process(qvarn, listeners, engine)
+    assert sorted(calls) == ['0', '1', '2']
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        ('0', 0 + 3 + 6 + 9),
+        ('1', 1 + 4 + 7 + 10),
+        ('2', 2 + 5 + 8 + 11),
+    ]
+
+
+def test_reduce_group_cleanup_when_other_group_fails(realqvarn, qvarn):
+    realqvarn.add_resource_types(SCHEMA)
+
+    failing_keys = set()
+
+    def reduce_handler(values):
+        values = list(values)
+        if values and values[0][0] in failing_keys:
+            raise ValueError('fake error')
+        return sum(value for key, value in values)
+
+    config = _reduce_config(reduce_handler)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+
+    data = [qvarn.create('source', {'key': str(i % 2), 'value': i}) for i in range(4)]
+    process(qvarn, listeners, MapReduceEngine(qvarn, config, workers=2))
+
+    failing_keys.add('1')
+    engine = MapReduceEngine(qvarn, config, workers=2)
+    qvarn.delete('source', data[0]['id'])
+    qvarn.delete('source', data[1]['id'])
+    process(qvarn, listeners, engine)
+
+    # Mapped resource of the successfully reduced key is deleted, the failed key keeps its
+    # mapped resource marked for deletion, until the reduce is retried.
+    assert get_resource_values(qvarn, 'map_target', ('_mr_key', '_mr_value', '_mr_deleted')) == [
+        ('0', 2, False),
+        ('1', 1, True),
+        ('1', 3, False),
+    ]
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        ('0', 2),
+        ('1', 1 + 3),
+    ]
+    assert len(engine.retry_scheduler) == 1
+
+
+def test_written_resources_are_reduced_in_same_cycle(realqvarn, qvarn, mocker):
+    realqvarn.add_resource_types(SCHEMA)
+
+    reduce_handler = mocker.Mock(side_effect=lambda resources: len(list(resources)))
+
+    config = {
+        'map_target': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key', 'value'),
+            },
+        },
+        'reduce_target': {
+            'map_target': {
+                'type': 'reduce',
+                'version': 1,
+                'handler': reduce_handler,
+            },
+        },
+    }
+
+    engine = MapReduceEngine(qvarn, config, raise_errors=True)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+    listener_id = {x.source_resource_type: x.listener['id'] for x in listeners}
+
+    qvarn.create('source', {'key': '1', 'value': 1})
+    qvarn.create('source', {'key': '1', 'value': 2})
+
+    # Reduce handlers are processed in the same cycle as map handlers.
+    engine.process_changes(get_changes(qvarn, [x for x in listeners
+                                               if x.source_resource_type == 'source']))
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [('1', 2)]
+    assert reduce_handler.call_count == 1
+
+    # Notifications of written mapped resources are just acknowledged.
+    search_one = mocker.spy(qvarn, 'search_one')
+    notifications = 'map_target/listeners/' + listener_id['map_target'] + '/notifications'
+    assert len(qvarn.get_list(notifications)) == 2
+    assert engine.process_changes(get_changes(qvarn, listeners)) == 2
+    assert len(qvarn.get_list(notifications)) == 0
+    assert reduce_handler.call_count == 1
+    assert search_one.call_count == 0
+
+
+def test_notifications_are_fetched_and_deleted_in_bulk(realqvarn, qvarn, mocker):
+    realqvarn.add_resource_types(SCHEMA)
+
+    config = {
+        'map_target': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key', 'value'),
+            },
+        },
+    }
+
+    engine = MapReduceEngine(qvarn, config, raise_errors=True)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+    notifications = 'source/listeners/' + listeners[0].listener['id'] + '/notifications'
+
+    for i in range(5):
+        qvarn.create('source', {'key': str(i), 'value': i})
+
+    get = mocker.spy(qvarn, 'get')
+    delete = mocker.spy(qvarn, 'delete')
+    delete_multiple = mocker.spy(qvarn, 'iter_delete_multiple')
+
+    changes = list(get_changes(qvarn, listeners, batch_size=2))
+    assert len(changes) == 5
+    assert get.call_count == 0
+
+    assert engine.process_changes(changes) == 5
+    assert qvarn.get_list(notifications) == []
+    assert delete.call_count == 0
+    assert [c[0] for c in delete_multiple.call_args_list if c[0][0] == notifications] == [
+        (notifications, [x.notification_id for x in changes]),
+    ]
+
+
+def test_notifications_are_coalesced(realqvarn, qvarn):
+    realqvarn.add_resource_types(SCHEMA)
+
+    calls = []
+
+    def handler(resource):
+        calls.append(resource['id'])
+        yield resource['key'], resource['value']
+
+    config = {
+        'map_target': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': handler,
+            },
+        },
+    }
+
+    engine = MapReduceEngine(qvarn, config, raise_errors=True)
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+    notifications = 'source/listeners/' + listeners[0].listener['id'] + '/notifications'
+
+    # Created and updated many times.
+    a = qvarn.create('source', {'key': 'a', 'value': 0})
+    for i in range(1, 20):
+        update_resource(qvarn, 'source', a['id'])(value=i)
+
+    # Created and deleted.
+    b = qvarn.create('source', {'key': 'b', 'value': 0})
+    qvarn.delete('source', b['id'])
+
+    changes = list(get_changes(qvarn, listeners))
+    assert len(changes) == 22
+
+    assert engine.process_changes(changes) == 22
+    assert calls == [a['id']]
+    assert get_resource_values(qvarn, 'map_target', ('_mr_key', '_mr_value')) == [('a', 19)]
+
+    # All superseded notifications are acknowledged too.
+    assert qvarn.get_list(notifications) == []
+
+
+def test_defer_reduce_of_resync_writes(realqvarn, qvarn):
+    realqvarn.add_resource_types(SCHEMA)
+
+    config = {
+        'map_target': {
+            'source': {
+                'type': 'map',
+                'version': 1,
+                'handler': item('key', 'value'),
+            },
+        },
+        'reduce_target': {
+            'map_target': {
+                'type': 'reduce',
+                'version': 1,
+                'handler': sum,
+                'map': value(),
+            },
+        },
+    }
+
+    listeners = get_or_create_listeners(qvarn, 'test', config)
+    qvarn.create('source', {'key': 'a', 'value': 1})
+    process(qvarn, listeners, config)
+
+    def new_map_handler(resource):
+        return resource['key'], resource['value'] * 10
+
+    config['map_target']['source'] = {'type': 'map', 'version': 2, 'handler': new_map_handler}
+    engine = MapReduceEngine(qvarn, config, raise_errors=True)
+    engine.defer_reduce({'map_target'})
+
+    # Mapped resources written by resync are not reduced, only their keys are collected.
+    engine.process_changes(iter_map_resync_changes(qvarn, 'source'), resync=True)
+    engine.collect_deferred_reduce(engine)
+
+    # Other changes are reduced as usual, notifications of resources written by resync are just
+    # acknowledged.
+    qvarn.create('source', {'key': 'b', 'value': 2})
+    process(qvarn, listeners, engine)
+    assert get_resource_values(qvarn, 'reduce_target', ('_mr_key', '_mr_value')) == [
+        ('a', 1),
+        ('b', 20),
+    ]
+    assert list(get_changes(qvarn, listeners)) == []
+
+    keys = engine.pop_deferred_reduce()
+    assert list(keys) == [['map_target', 'a']]
+    keys.close()
+    assert engine.deferred_reduce_sources == set()
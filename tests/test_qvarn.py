@@ -0,0 +1,382 @@
+import time
+import threading
+from concurrent.futures import Future
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from qvarnmr.clients.qvarn import (
+    CircuitBreaker, ConcurrencyLimiter, QvarnApi, QvarnError, QvarnResourceConflict,
+    QvarnResourceNotFound, QvarnResultDict, QvarnResultList, QvarnUnavailable, RequestCache,
+)
+
+VERSION = {
+    'status_code': 200,
+    'headers': {'content-type': 'application/json'},
+    'json': {'api': {'version': '1.0'}},
+}
+
+
+def test_update_uses_cached_revision(qvarn, mocker):
+    org = qvarn.create('orgs', {'names': ['Orgtra']})
+
+    get = mocker.spy(qvarn, '_get')
+    updated = qvarn.update('orgs', org['id'], {'names': ['Orgtra 2']})
+    assert get.call_count == 0
+    assert updated['revision'] != org['revision']
+
+    # Revision of updated resource is cached too.
+    qvarn.update('orgs', org['id'], {'names': ['Orgtra 3']})
+    assert get.call_count == 0
+    assert qvarn.get('orgs', org['id'])['names'] == ['Orgtra 3']
+
+
+def test_update_with_outdated_cached_revision(qvarn, mocker):
+    org = qvarn.create('orgs', {'names': ['Orgtra']})
+
+    # Resource is changed by someone else.
+    other = QvarnApi(qvarn.client, revision_cache_size=0)
+    other.update('orgs', org['id'], {'revision': org['revision'], 'names': ['Other']})
+
+    get = mocker.spy(qvarn, '_get')
+    qvarn.update('orgs', org['id'], {'names': ['Orgtra 2']})
+    assert get.call_count == 1
+    assert qvarn.get('orgs', org['id'])['names'] == ['Orgtra 2']
+
+    # Conflicts are not retried, if revision is given explicitly.
+    with pytest.raises(QvarnResourceConflict):
+        qvarn.update('orgs', org['id'], {'revision': org['revision'], 'names': ['Orgtra 3']})
+
+
+def test_revision_cache_is_bounded(qvarn):
+    qvarn.revision_cache_size = 2
+    orgs = [qvarn.create('orgs', {'names': ['Orgtra %d' % i]}) for i in range(3)]
+    assert qvarn._get_revision('orgs', orgs[0]['id']) is None
+    assert qvarn._get_revision('orgs', orgs[2]['id']) == orgs[2]['revision']
+
+    qvarn.delete('orgs', orgs[2]['id'])
+    assert qvarn._get_revision('orgs', orgs[2]['id']) is None
+
+
+def test_create_multiple(qvarn):
+    qvarn.max_in_flight = 2
+    created = qvarn.create_multiple('orgs', [{'names': ['Orgtra %d' % i]} for i in range(5)])
+    assert [x['names'] for x in qvarn.get_multiple('orgs', [x['id'] for x in created])] == [
+        ['Orgtra %d' % i] for i in range(5)
+    ]
+
+    result = qvarn.create_multiple('orgs', [
+        {'names': ['Orgtra']},
+        {'unknown': 'field'},
+    ], return_exceptions=True)
+    assert result[0]['names'] == ['Orgtra']
+    assert isinstance(result[1], QvarnError)
+
+    with pytest.raises(QvarnError):
+        qvarn.create_multiple('orgs', [{'unknown': 'field'}])
+
+
+def test_update_multiple(qvarn, mocker):
+    orgs = [qvarn.create('orgs', {'names': ['Orgtra %d' % i]}) for i in range(3)]
+
+    # Second resource is changed by someone else, so its cached revision is outdated.
+    other = QvarnApi(qvarn.client, revision_cache_size=0)
+    other.update('orgs', orgs[1]['id'], {'revision': orgs[1]['revision'], 'names': ['Other']})
+
+    get = mocker.spy(qvarn, 'get')
+    result = qvarn.update_multiple('orgs', [x['id'] for x in orgs] + ['missing'], [
+        {'names': ['Updated 0']},
+        {'names': ['Updated 1']},
+        # Explicitly given revisions are not retried.
+        {'revision': orgs[1]['revision'], 'names': ['Updated 2']},
+        {'names': ['Missing']},
+    ], return_exceptions=True)
+    assert get.call_count == 0
+    assert [x['names'] for x in result[:2]] == [['Updated 0'], ['Updated 1']]
+    assert isinstance(result[2], QvarnResourceConflict)
+    assert isinstance(result[3], QvarnResourceNotFound)
+    assert [x['names'] for x in qvarn.get_multiple('orgs', [x['id'] for x in orgs])] == [
+        ['Updated 0'],
+        ['Updated 1'],
+        ['Orgtra 2'],
+    ]
+
+
+def test_iter_get_multiple(qvarn, mocker):
+    orgs = [qvarn.create('orgs', {'names': ['Orgtra %d' % i]}) for i in range(5)]
+    ids = [x['id'] for x in orgs]
+
+    # Ids are consumed lazily, at most window requests are pending.
+    consumed = []
+
+    def iter_ids():
+        for id in ids:
+            consumed.append(id)
+            yield id
+
+    result = qvarn.iter_get_multiple('orgs', iter_ids(), window=2)
+    assert next(result)['id'] == ids[0]
+    assert consumed == ids[:2]
+    assert [x['id'] for x in result] == ids[1:]
+
+    result = list(qvarn.iter_get_multiple('orgs', [ids[0], 'missing'], return_exceptions=True))
+    assert result[0]['id'] == ids[0]
+    assert isinstance(result[1], QvarnResourceNotFound)
+
+    with pytest.raises(QvarnResourceNotFound):
+        list(qvarn.iter_get_multiple('orgs', ['missing'] + ids))
+
+
+def test_iter_delete_multiple(qvarn):
+    orgs = [qvarn.create('orgs', {'names': ['Orgtra %d' % i]}) for i in range(3)]
+    ids = [x['id'] for x in orgs]
+
+    assert len(list(qvarn.iter_delete_multiple('orgs', iter(ids[:2]), window=1))) == 2
+    assert qvarn.get_list('orgs') == ids[2:]
+    assert qvarn._get_revision('orgs', ids[0]) is None
+
+
+def test_transient_errors_are_retried(qvarn, mock_requests):
+    qvarn.retry_backoff = 0
+    version = mock_requests.get('/version', [{'status_code': 503}, {'status_code': 502}, VERSION])
+    assert qvarn.get_version() == {'api': {'version': '1.0'}}
+    assert version.call_count == 3
+
+    # Number of retries is limited.
+    qvarn.retries = 1
+    version = mock_requests.get('/version', status_code=504)
+    with pytest.raises(QvarnUnavailable):
+        qvarn.get_version()
+    assert version.call_count == 2
+
+
+def test_post_is_not_retried(realqvarn, qvarn, mock_requests):
+    qvarn.retry_backoff = 0
+    create = mock_requests.post(realqvarn.base_url + '/orgs', status_code=503)
+    with pytest.raises(QvarnUnavailable):
+        qvarn.create('orgs', {'names': ['Orgtra']})
+    assert create.call_count == 1
+
+
+def test_circuit_breaker(qvarn, mock_requests):
+    qvarn.retries = 0
+    qvarn.circuit_breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+    mock_requests.get('/version', [{'status_code': 503}, {'status_code': 503}, VERSION])
+    for _ in range(2):
+        with pytest.raises(QvarnUnavailable):
+            qvarn.get_version()
+    assert qvarn.circuit_breaker.is_open()
+
+    # Requests fail immediately, while circuit is open.
+    with pytest.raises(QvarnUnavailable):
+        qvarn.get_version()
+
+    # Circuit is closed after the first successful request.
+    time.sleep(0.05)
+    assert qvarn.get_version() == {'api': {'version': '1.0'}}
+    assert not qvarn.circuit_breaker.is_open()
+
+
+def test_circuit_breaker_opened_while_sending(realqvarn, qvarn, mock_requests):
+    qvarn.circuit_breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+
+    def post(request, context):
+        # Another request fails, while this one is being sent.
+        qvarn.circuit_breaker.record_failure()
+        return {'id': 'org-id', 'revision': 'rev', 'names': ['Orgtra']}
+
+    create = mock_requests.post(realqvarn.base_url + '/orgs', status_code=201, json=post,
+                                headers={'content-type': 'application/json'})
+    assert qvarn.create('orgs', {'names': ['Orgtra']})['id'] == 'org-id'
+    assert create.call_count == 1
+
+
+def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter(min_limit=1, max_limit=4, latency_target=0.05)
+    futs = []
+
+    def request():
+        futs.append(Future())
+        return futs[-1]
+
+    for _ in range(4):
+        limiter.submit(request)
+    assert limiter.in_flight == 4
+
+    # Non-blocking submit does not send a request over the limit.
+    assert limiter.submit(request, block=False) is None
+    assert (limiter.in_flight, len(futs)) == (4, 4)
+
+    # A burst of failures of requests sent at once decreases the limit only once.
+    for fut in futs[:2]:
+        fut.set_result(SimpleNamespace(status_code=503))
+    assert limiter.limit == 2
+    assert limiter.in_flight == 2
+
+    # Slow responses decrease the limit too.
+    futs[2].set_result(SimpleNamespace(status_code=200))
+    limiter.submit(request)
+    time.sleep(0.05)
+    futs[-1].set_result(SimpleNamespace(status_code=200))
+    assert limiter.limit == 1
+
+    # Fast responses increase the limit, up to max_limit.
+    futs[3].set_result(SimpleNamespace(status_code=200))
+    assert limiter.in_flight == 0
+    for _ in range(20):
+        limiter.submit(request).set_result(SimpleNamespace(status_code=200))
+    assert limiter.limit == 4
+
+    # Time spent waiting for a free thread is not counted in response time.
+    limiter.submit(request)
+    time.sleep(0.05)
+    futs[-1].set_result(SimpleNamespace(status_code=200, elapsed=timedelta(seconds=0.01)))
+    assert limiter.limit == 4
+
+
+def test_max_in_flight_defaults_to_number_of_threads(qvarn):
+    assert qvarn.max_in_flight == 1
+    assert QvarnApi(qvarn.client, max_in_flight=5).max_in_flight == 5
+
+
+def test_cache_scope(qvarn, mocker):
+    org = qvarn.create('orgs', {'names': ['Orgtra']})
+    get = mocker.spy(qvarn, '_get')
+    search = mocker.spy(qvarn, '_search')
+
+    with qvarn.cache_scope():
+        assert qvarn.get('orgs', org['id'])['names'] == ['Orgtra']
+        # Cached responses are copies, so they can be changed by the caller.
+        qvarn.get('orgs', org['id'])['names'].append('Changed')
+        assert qvarn.get_multiple('orgs', [org['id']])[0]['names'] == ['Orgtra']
+        assert get.call_count == 1
+
+        assert qvarn.search('orgs', names='Orgtra') == [org['id']]
+        assert qvarn.search('orgs', names='Orgtra') == [org['id']]
+        assert search.call_count == 1
+
+        # Writes invalidate cached responses of written resource type.
+        qvarn.update('orgs', org['id'], {'names': ['Orgtra 2']})
+        assert qvarn.search('orgs', names='Orgtra') == []
+        assert qvarn.get('orgs', org['id'])['names'] == ['Orgtra 2']
+
+    # Nothing is cached outside of the scope.
+    qvarn.get('orgs', org['id'])
+    qvarn.get('orgs', org['id'])
+    assert get.call_count == 4
+
+
+def test_update_in_cache_scope_uses_current_revision(qvarn):
+    org = qvarn.create('orgs', {'names': ['Orgtra']})
+    api = QvarnApi(qvarn.client, revision_cache_size=0)
+
+    with api.cache_scope():
+        api.get('orgs', org['id'])
+        # Resource is changed by someone else, cached response is outdated now.
+        qvarn.update('orgs', org['id'], {'names': ['Orgtra 2']})
+        api.update('orgs', org['id'], {'names': ['Orgtra 3']})
+
+    assert qvarn.get('orgs', org['id'])['names'] == ['Orgtra 3']
+
+
+def test_cache_scope_of_concurrent_copies(qvarn):
+    org = qvarn.create('orgs', {'names': ['Orgtra']})
+    barrier = threading.Barrier(2)
+    first_done = threading.Event()
+    results = []
+
+    def shard(api, first):
+        with api.cache_scope() as cache:
+            api.get('orgs', org['id'])
+            barrier.wait()
+            if not first:
+                # Scope of the other copy is already closed, but this one is still cached.
+                first_done.wait()
+                api.get('orgs', org['id'])
+                results.append((api._cache is cache, cache.hits))
+        if first:
+            first_done.set()
+
+    copies = [qvarn.copy(), qvarn.copy()]
+    assert copies[0].client is qvarn.client
+    assert copies[0].concurrency_limiter is qvarn.concurrency_limiter
+    threads = [threading.Thread(target=shard, args=(api, i == 0)) for i, api in enumerate(copies)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [(True, 1)]
+    assert qvarn._cache is None
+
+
+def test_request_cache_single_flight():
+    cache = RequestCache()
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.05)
+        return {'names': ['Orgtra']}
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get(('get', 'orgs', '1'), load)))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{'names': ['Orgtra']}] * 3
+
+
+def test_iter_search(qvarn, mocker):
+    orgs = [qvarn.create('orgs', {'names': ['Orgtra %d' % (i % 2)]}) for i in range(5)]
+    ids = sorted(x['id'] for x in orgs)
+
+    search = mocker.spy(qvarn, '_search')
+    assert list(qvarn.iter_list('orgs', page_size=2)) == ids
+    assert search.call_count == 3
+
+    assert [x['names'] for x in qvarn.iter_search('orgs', show=('names',), page_size=2)] == [
+        qvarn.get('orgs', id)['names'] for id in ids
+    ]
+
+    assert list(qvarn.iter_search('orgs', names='Orgtra 0', page_size=2)) == sorted(
+        x['id'] for x in orgs[::2]
+    )
+
+
+def test_request_metrics(qvarn):
+    qvarn.metrics.reset()
+    org = qvarn.create('orgs', {'names': ['Orgtra']})
+    qvarn.get('orgs', org['id'])
+    qvarn.search('orgs', names='Orgtra')
+    qvarn.get_list('orgs')
+    with pytest.raises(QvarnResourceNotFound):
+        qvarn.get('orgs', 'missing')
+
+    snapshot = qvarn.metrics.snapshot()
+    assert {key: stats['count'] for key, stats in snapshot.items()} == {
+        ('create', 'orgs'): 1,
+        ('get', 'orgs'): 2,
+        ('search', 'orgs'): 1,
+        ('list', 'orgs'): 1,
+    }
+    assert snapshot[('get', 'orgs')]['errors'] == {'404': 1}
+    assert snapshot[('get', 'orgs')]['bytes'] > 0
+
+
+def test_search_results_are_wrapped_lazily():
+    result = QvarnResultList([{'id': 'a'}, {'id': 'b'}])
+    assert type(list.__getitem__(result, 0)) is dict
+
+    row = result[0]
+    assert isinstance(row, QvarnResultDict)
+    # Wrapped rows are kept, so changes are not lost.
+    row['names'] = ['Orgtra']
+    assert result[0] is row
+    assert [type(x) for x in result] == [QvarnResultDict, QvarnResultDict]
+    assert result[:1] == [{'id': 'a', 'names': ['Orgtra']}]
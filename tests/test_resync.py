@@ -0,0 +1,76 @@
+from qvarnmr.resync import (
+    ResyncShard, VersionIndex, _iter_resync_tasks, get_id_prefix, iter_map_resync_changes,
+    split_id_range,
+)
+
+
+def test_split_id_range():
+    assert split_id_range(1) == [(None, None)]
+    assert split_id_range(4) == [
+        (None, '4000'),
+        ('4000', '8000'),
+        ('8000', 'c000'),
+        ('c000', None),
+    ]
+    assert split_id_range(2, '81c0-') == [(None, '81c0-8000'), ('81c0-8000', None)]
+
+
+def test_split_id_range_of_resource_type(qvarn):
+    ids = [qvarn.create('orgs', {'names': ['Orgtra %d' % i]})['id'] for i in range(40)]
+    prefix = get_id_prefix(qvarn, 'orgs')
+    assert prefix == ids[0][:5]
+
+    sizes = [
+        len(list(iter_map_resync_changes(qvarn, 'orgs', start=start, end=end)))
+        for start, end in split_id_range(4, prefix)
+    ]
+    assert sum(sizes) == 40
+    # Each shard gets a roughly even share of random ids, 10 on average.
+    assert all(2 <= size <= 20 for size in sizes), sizes
+
+
+def test_resync_shard_state():
+    shard = ResyncShard('4000', None, cursor='4abc')
+    assert shard.to_state() == {'start': '4000', 'end': '', 'cursor': '4abc', 'done': False}
+    shard = ResyncShard.from_state(shard.to_state())
+    assert (shard.start, shard.end, shard.cursor, shard.done) == ('4000', None, '4abc', False)
+
+
+def test_only_independent_handlers_are_resynced_in_parallel():
+    class Resync:
+        def __init__(self, source, target, shards=1):
+            self.source = source
+            self.target = target
+            self.shards = [ResyncShard() for _ in range(shards)]
+            self.finished = False
+
+    a = Resync('source', 'map_target', shards=2)
+    b = Resync('source', 'other_target')
+    c = Resync('other_source', 'other_target')
+    d = Resync('third_source', 'third_target')
+
+    tasks = _iter_resync_tasks([a, b, c, d], 10)
+    assert [(resync, shard) for resync, shard in tasks] == [
+        (a, a.shards[0]),
+        (a, a.shards[1]),
+        (c, c.shards[0]),
+        (d, d.shards[0]),
+    ]
+    assert len(_iter_resync_tasks([a, b, c, d], 3)) == 3
+
+    a.finished = True
+    assert [resync for resync, _ in _iter_resync_tasks([a, b, c, d], 10)] == [b, d]
+
+
+def test_version_index():
+    index = VersionIndex(2)
+    index.add('a', 2)
+    index.add('b', 1)
+    index.add('c', 2)
+    index.add('c', 2)
+    index.add([1, 'd'], 2)
+    # Only ids with a single target resource of the given version are current.
+    assert ['a' in index, 'b' in index, 'c' in index, 'x' in index, [1, 'd'] in index] == [
+        True, False, False, False, True,
+    ]
+    index.close()
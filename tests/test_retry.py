@@ -0,0 +1,46 @@
+from qvarnmr.retry import RetryScheduler
+
+
+def test_retry_scheduler():
+    retries = RetryScheduler(max_retries=2, backoff=0.25, factor=6, max_entries=2)
+
+    assert retries.schedule('a', 'A', 0, 1.0) is True
+    assert retries.schedule('b', 'B', 1, 1.0) is True
+    assert 'a' in retries
+    assert len(retries) == 2
+
+    # Scheduler is full.
+    assert retries.schedule('c', 'C', 0, 1.0) is False
+    assert 'c' not in retries
+
+    assert retries.next_due() == 1.25
+    assert retries.pop_due(1.2) == []
+    assert retries.pop_due(1.3) == ['A']
+    assert retries.pop_due(2.0) == []
+    assert retries.pop_due(2.5) == ['B']
+    assert retries.next_due() is None
+    assert len(retries) == 0
+
+
+def test_retry_scheduler_reschedule_and_cancel():
+    retries = RetryScheduler()
+
+    retries.schedule('a', 'A0', 0, 1.0)
+    retries.schedule('a', 'A1', 1, 1.0)
+    retries.schedule('b', 'B', 0, 1.0)
+    retries.cancel('b')
+
+    assert retries.pop_due(2.0) == []
+    assert retries.pop_due(3.0) == ['A1']
+
+
+def test_retry_scheduler_exhausted():
+    retries = RetryScheduler(max_retries=2)
+    assert retries.exhausted(1) is False
+    assert retries.exhausted(2) is True
+
+
+def test_retry_scheduler_jitter():
+    retries = RetryScheduler(backoff=1, factor=2, jitter=0.5)
+    for _ in range(100):
+        assert 1 <= retries.delay(1) <= 3
@@ -1,5 +1,5 @@
 from qvarnmr.func import item, count
-from qvarnmr.utils import get_handler_identifier, chunks, is_empty
+from qvarnmr.utils import get_handler_identifier, chunks, is_empty, KeySet
 
 
 def test_get_handler_identifier():
@@ -23,3 +23,22 @@ def test_is_empty():
     iterable, empty = is_empty(iter([]))
     assert list(iterable) == []
     assert empty is True
+
+
+def test_key_set():
+    keys = KeySet(memory_limit=2)
+    assert keys.add(1) is True
+    assert keys.add(1) is False
+    assert keys.add('a') is True
+    assert (1 in keys, 2 in keys, len(keys)) == (True, False, 2)
+
+    # Keys are moved to disk, when memory limit is exceeded.
+    assert keys.add(['a', 1]) is True
+    assert keys._db is not None
+    assert keys.add(1) is False
+    assert keys.add(['a', 1]) is False
+    assert keys.add(2) is True
+    assert (1 in keys, 'a' in keys, 3 in keys, len(keys)) == (True, True, False, 4)
+
+    keys.close()
+    assert len(keys) == 0